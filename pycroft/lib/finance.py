@@ -3,7 +3,7 @@
 # This file is part of the Pycroft project and licensed under the terms of
 # the Apache License, Version 2.0. See the LICENSE file for details.
 from abc import ABCMeta, abstractmethod
-from collections import namedtuple
+from collections import Counter, defaultdict, namedtuple
 import csv
 from datetime import datetime, date, timedelta
 from decimal import Decimal
@@ -14,18 +14,21 @@ from io import StringIO
 import operator
 import re
 
-from sqlalchemy import or_, and_, literal_column, literal, select, exists, not_
+from sqlalchemy import or_, and_, literal_column, literal, select, exists, not_, \
+    null
 from sqlalchemy.orm import aliased, contains_eager, joinedload
 from sqlalchemy.orm.exc import NoResultFound
-from sqlalchemy import func, between, Integer, cast
+from sqlalchemy import func, between, Date, Integer, Text, cast
+from sqlalchemy.dialects.postgresql import ARRAY
 
 from pycroft import config, model
 from pycroft.helpers.i18n import deferred_gettext, gettext, Message
-from pycroft.lib.logging import log_user_event
-from pycroft.lib.membership import make_member_of, remove_member_of
+from pycroft.lib.logging import log_user_events
+from pycroft.lib.membership import make_members_of, remove_members_of
 from pycroft.model import session
 from pycroft.model.finance import (
-    Account, BankAccount, BankAccountActivity, Split, Transaction, MembershipFee)
+    Account, AccountBalance, BankAccount, BankAccountActivity, Split,
+    Transaction, MembershipFee, account_balance_query, in_default_days_query)
 from pycroft.helpers.interval import (
     closed, single, Bound, Interval, IntervalSet, UnboundedInterval, closedopen,
     PositiveInfinity)
@@ -385,11 +388,13 @@ def import_bank_account_activities_csv(csv_file, expected_balance,
     # Convert to MT940Record and enumerate
     reader = csv.reader(csv_file, dialect=MT940Dialect)
     records = enumerate((MT940Record._make(r) for r in reader), 1)
+    bank_account_ids = {}
     try:
         # Skip first record (header)
         next(records)
         activities = tuple(
-            process_record(index, record, imported_at=imported_at)
+            process_record(index, record, imported_at=imported_at,
+                           bank_account_ids=bank_account_ids)
             for index, record in records)
     except StopIteration:
         raise CSVImportError(gettext(u"No data present."))
@@ -407,48 +412,66 @@ def import_bank_account_activities_csv(csv_file, expected_balance,
     ).filter(
         BankAccountActivity.posted_on < first_posted_on
     ).scalar()
-    a = tuple(session.session.query(
+    # Multiset of the activities already imported, an activity of the
+    # file is new if all equal ones are used up
+    unmatched = Counter(tuple(row) for row in session.session.query(
         BankAccountActivity.amount, BankAccountActivity.bank_account_id,
-        BankAccountActivity.reference, BankAccountActivity.reference,
+        BankAccountActivity.reference,
         BankAccountActivity.other_account_number,
         BankAccountActivity.other_routing_number,
-        BankAccountActivity.other_name, BankAccountActivity.imported_at,
+        BankAccountActivity.other_name,
         BankAccountActivity.posted_on, BankAccountActivity.valid_on
     ).filter(
         BankAccountActivity.posted_on >= first_posted_on)
     )
-    b = tuple(reversed(activities))
-    matcher = difflib.SequenceMatcher(a=a, b=b)
-    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
-        if 'equal' == tag:
-            continue
-        elif 'insert' == tag:
-            balance += sum(a[0] for a in islice(activities, j1, j2))
-            session.session.add_all(
-                BankAccountActivity(
-                    amount=e[0], bank_account_id=e[1], reference=e[3],
-                    other_account_number=e[4],
-                    other_routing_number=e[5], other_name=e[6],
-                    imported_at=e[7], posted_on=e[8], valid_on=e[9]
-                ) for e in islice(activities, j1, j2)
-            )
-        elif 'delete' == tag:
-            continue
-        elif 'replace' == tag:
-            raise CSVImportError(
-                gettext(u"Import conflict:\n"
-                        u"Database bank account activities:\n{0}\n"
-                        u"File bank account activities:\n{1}").format(
-                    u'\n'.join(str(x) for x in islice(activities, i1, i2)),
-                    u'\n'.join(str(x) for x in islice(activities, j1, j2))))
+    new_activities = []
+    for activity in reversed(activities):
+        key = activity_key(activity)
+        if unmatched[key] > 0:
+            unmatched[key] -= 1
         else:
-            raise AssertionError()
+            new_activities.append(activity)
+    # Activities missing from the file are only a conflict if the file
+    # has new activities posted on the same day
+    conflicting_days = ({key[6] for key in +unmatched} &
+                        {a[8] for a in new_activities})
+    if conflicting_days:
+        raise CSVImportError(
+            gettext(u"Import conflict:\n"
+                    u"Database bank account activities:\n{0}\n"
+                    u"File bank account activities:\n{1}").format(
+                u'\n'.join(str(key) for key in sorted(+unmatched)
+                           if key[6] in conflicting_days),
+                u'\n'.join(str(a) for a in new_activities
+                           if a[8] in conflicting_days)))
+    if new_activities:
+        session.session.execute(BankAccountActivity.__table__.insert(), [
+            dict(amount=e[0], bank_account_id=e[1], reference=e[3],
+                 other_account_number=e[4], other_routing_number=e[5],
+                 other_name=e[6], imported_at=e[7], posted_on=e[8],
+                 valid_on=e[9])
+            for e in new_activities
+        ])
+    balance += sum(a[0] for a in activities)
     if balance != expected_balance:
         message = gettext(u"Balance after does not equal expected balance: "
                           u"{0} != {1}.")
         raise CSVImportError(message.format(balance, expected_balance))
 
 
+def activity_key(activity):
+    """The fields identifying an activity returned by :func:`process_record`
+
+    These are all fields but the cleaned up reference and the time of
+    the import, in the order of the corresponding columns of
+    :py:class:`BankAccountActivity`.
+    """
+    (amount, bank_account_id, _, reference, other_account_number,
+     other_routing_number, other_name, _, posted_on, valid_on) = activity
+    return (amount, bank_account_id, reference, other_account_number,
+            other_routing_number, other_name, posted_on, valid_on)
+
+
 def remove_space_characters(field):
     """Remove every 28th character if it is a space character."""
     if field is None:
@@ -487,21 +510,37 @@ def restore_record(record):
     return restored_record
 
 
-def process_record(index, record, imported_at):
+def process_record(index, record, imported_at, bank_account_ids=None):
+    """Convert a MT940 record into a tuple of bank account activity fields.
+
+    :param int index: the index of the record in the file
+    :param MT940Record record: the record
+    :param datetime imported_at: the time of the import
+    :param dict|None bank_account_ids: A cache mapping account numbers to
+        bank account ids, filled as bank accounts are looked up.  Pass
+        the same dict for all records of an import.
+    :raises CSVImportError: if the record is invalid
+    """
     if record.currency != u"EUR":
         message = gettext(u"Unsupported currency {0}. Record {1}: {2}")
         raw_record = restore_record(record)
         raise CSVImportError(message.format(record.currency, index, raw_record))
-    try:
-        bank_account = BankAccount.q.filter_by(
-            account_number=record.our_account_number
-        ).one()
-    except NoResultFound as e:
-        message = gettext(u"No bank account with account number {0}. "
-                          u"Record {1}: {2}")
-        raw_record = restore_record(record)
-        raise CSVImportError(
-            message.format(record.our_account_number, index, raw_record), e)
+    if bank_account_ids is None:
+        bank_account_ids = {}
+    bank_account_id = bank_account_ids.get(record.our_account_number)
+    if bank_account_id is None:
+        try:
+            bank_account_id, = session.session.query(BankAccount.id).filter_by(
+                account_number=record.our_account_number
+            ).one()
+        except NoResultFound as e:
+            message = gettext(u"No bank account with account number {0}. "
+                              u"Record {1}: {2}")
+            raw_record = restore_record(record)
+            raise CSVImportError(
+                message.format(record.our_account_number, index, raw_record),
+                e)
+        bank_account_ids[record.our_account_number] = bank_account_id
 
     try:
         valid_on = datetime.strptime(record.valid_on, u"%d.%m.%y").date()
@@ -519,7 +558,7 @@ def process_record(index, record, imported_at):
         raise CSVImportError(
             message.format(record.amount, index, raw_record), e)
 
-    return (amount, bank_account.id, cleanup_description(record.reference),
+    return (amount, bank_account_id, cleanup_description(record.reference),
             record.reference, record.other_account_number,
             record.other_routing_number, record.other_name, imported_at,
             posted_on, valid_on)
@@ -529,6 +568,54 @@ def user_has_paid(user):
     return user.account.balance <= 0
 
 
+AccountBalanceDrift = namedtuple('AccountBalanceDrift',
+                                 ['account_id', 'stored', 'actual'])
+
+
+@with_transaction
+def refresh_account_balances(account_ids=None):
+    """Recompute the balances of accounts from their splits.
+
+    The ``account_balance`` table is kept up to date by triggers, so
+    this is only needed to fill it initially or to repair it.
+
+    :param iterable[int]|None account_ids: The ids of the accounts to
+        refresh.  If ``None``, the balances of all accounts are recomputed.
+    """
+    if account_ids is None:
+        account_ids_array = cast(null(), ARRAY(Integer))
+    else:
+        account_ids_array = literal(list(account_ids), ARRAY(Integer))
+    session.session.execute(select([
+        func.refresh_account_balance(account_ids_array)
+    ]))
+
+
+@with_transaction
+def verify_account_balances(repair=False):
+    """Compare the stored balances of all accounts with their splits.
+
+    :param bool repair: Whether to recompute the balances that drifted
+    :return: the accounts whose stored balance differs from the sum of
+        their splits.  ``stored`` is ``None`` if the account has no
+        balance row at all.
+    :rtype: list[AccountBalanceDrift]
+    """
+    actual = account_balance_query().alias('actual')
+    drifts = [AccountBalanceDrift(*row) for row in session.session.execute(
+        select([actual.c.account_id, AccountBalance.balance,
+                actual.c.balance])
+        .select_from(actual.outerjoin(
+            AccountBalance.__table__,
+            AccountBalance.account_id == actual.c.account_id))
+        .where(AccountBalance.balance.is_distinct_from(actual.c.balance))
+        .order_by(actual.c.account_id)
+    )]
+    if repair and drifts:
+        refresh_account_balances(drift.account_id for drift in drifts)
+    return drifts
+
+
 def get_typed_splits(splits):
     splits = sorted(splits, key=lambda s: s.transaction.posted_at, reverse=True)
     return zip_longest(
@@ -549,77 +636,153 @@ def get_transaction_type(transaction):
         return (cd_accs[0][0].type, cd_accs[1][0].type)
 
 
+def _users_with_property(property_name):
+    return exists().where(and_(
+        CurrentProperty.user_id == User.id,
+        CurrentProperty.property_name == property_name,
+        not_(CurrentProperty.denied)))
+
+
 @with_transaction
-def end_payment_in_default_memberships():
+def end_payment_in_default_memberships(dry_run=False):
+    """End the payment in default memberships of users who have paid.
+
+    :param bool dry_run: Whether to only report the users without
+        changing their memberships
+    :return: the users whose payment in default membership ends
+    :rtype: list[User]
+    """
     processor = User.q.get(0)
 
-    users = User.q.join(User.current_properties) \
-                .filter(CurrentProperty.property_name == 'payment_in_default') \
+    users = User.q.filter(_users_with_property('payment_in_default')) \
                 .join(Account).filter(Account.balance <= 0).all()
 
-    for user in users:
-        remove_member_of(user, config.payment_in_default_group, processor,
-                             closedopen(session.utcnow(), None))
+    if not dry_run:
+        remove_members_of(users, config.payment_in_default_group, processor,
+                          closedopen(session.utcnow(), None))
 
     return users
 
 
-@with_transaction
-def handle_payments_in_default():
-    processor = User.q.get(0)
-
-    # Add memberships and end "member" membership if threshold met
-    users = User.q.join(User.current_properties)\
-                  .filter(CurrentProperty.property_name == 'membership_fee') \
-                  .join(Account).filter(Account.balance > 0).all()
+def payments_in_default_query(now):
+    """Build a query yielding the users with membership fees in default.
 
-    users_pid_membership = []
-    users_membership_terminated = []
+    The query yields the :py:class:`User`, the days their account has
+    been in default, the applicable :py:class:`MembershipFee` and
+    whether they already have the ``payment_in_default`` property.
+    The fee is the one containing the day the account went into
+    default or, if there is none, the last applied fee.  Users whose
+    payment in default membership ended during the last seven days are
+    left out.
 
-    ts_now = session.utcnow()
-    for user in users:
-        last_pid_membership = Membership.q.filter(Membership.user_id == user.id) \
-            .filter(Membership.group_id == config.payment_in_default_group.id) \
-            .order_by(Membership.ends_at.desc()) \
-            .first()
-
-        if last_pid_membership is not None:
-            if last_pid_membership.ends_at is not None and \
-               last_pid_membership.ends_at >= ts_now - timedelta(days=7):
-                continue
+    :param datetime now: the current point in time
+    :rtype: Query
+    """
+    # Only user accounts with a positive balance can be in default
+    in_default = in_default_days_query(Split.account_id.in_(
+        select([User.account_id])
+        .select_from(User.__table__.join(
+            AccountBalance.__table__,
+            AccountBalance.account_id == User.account_id))
+        .where(AccountBalance.balance > 0)
+    )).alias('in_default')
+    fee_for_date = select([MembershipFee.id]).where(between(
+        func.current_date() - in_default.c.in_default_days,
+        MembershipFee.begins_on, MembershipFee.ends_on
+    )).as_scalar()
+    last_applied_fee = select([MembershipFee.id]).where(
+        MembershipFee.ends_on <= func.current_timestamp()
+    ).order_by(MembershipFee.ends_on.desc()).limit(1).as_scalar()
+    candidates = select([
+        in_default.c.account_id, in_default.c.in_default_days,
+        func.coalesce(fee_for_date, last_applied_fee).label('fee_id'),
+    ]).alias('candidates')
+
+    def pid_membership(*criteria):
+        return exists().where(and_(
+            Membership.user_id == User.id,
+            Membership.group_id == config.payment_in_default_group.id,
+            *criteria))
+
+    return (
+        session.session.query(
+            User, candidates.c.in_default_days, MembershipFee,
+            _users_with_property('payment_in_default')
+            .label('payment_in_default'))
+        .join(Account, User.account)
+        .join(candidates, candidates.c.account_id == Account.id)
+        .join(MembershipFee, MembershipFee.id == candidates.c.fee_id)
+        .filter(_users_with_property('membership_fee'))
+        .filter(or_(
+            pid_membership(Membership.ends_at.is_(None)),
+            not_(pid_membership(
+                Membership.ends_at >= now - timedelta(days=7))),
+        ))
+        .order_by(User.id)
+    )
 
-        in_default_days = user.account.in_default_days
 
-        try:
-            fee = get_membership_fee_for_date(
-                date.today() - timedelta(days=in_default_days))
-        except NoResultFound:
-            fee = get_last_applied_membership_fee()
+@with_transaction
+def handle_payments_in_default(dry_run=False):
+    """Move users with membership fees in default to the payment in
+    default group and end the membership of those exceeding the final
+    deadline.
+
+    The users and their state are determined by a single query (see
+    :py:func:`payments_in_default_query`), the memberships are changed
+    in bulk.
+
+    :param bool dry_run: Whether to only report the users without
+        changing their memberships
+    :return: the users added to the payment in default group and the
+        users whose membership ends
+    :rtype: tuple[list[User], list[User]]
+    """
+    processor = User.q.get(0)
+    ts_now = session.utcnow()
 
-        if not fee:
-            return [], []
+    users_pid_membership = []
+    users_membership_terminated = []
+    terminated_by_fee = defaultdict(list)
 
-        if not user.has_property('payment_in_default'):
+    for user, in_default_days, fee, payment_in_default in \
+            payments_in_default_query(ts_now):
+        if not payment_in_default:
             if in_default_days >= fee.payment_deadline.days:
-                make_member_of(user, config.payment_in_default_group,
-                               processor, closed(ts_now, None))
                 users_pid_membership.append(user)
 
         if in_default_days >= fee.payment_deadline_final.days:
-            remove_member_of(user, config.member_group, processor,
-                             closedopen(ts_now, None))
-            log_user_event("Mitgliedschaftsende wegen Zahlungsrückstand ({})"
-                           .format(fee.name),
-                           processor, user)
             users_membership_terminated.append(user)
+            terminated_by_fee[fee.name].append(user.id)
+
+    if dry_run:
+        return users_pid_membership, users_membership_terminated
+
+    make_members_of(users_pid_membership, config.payment_in_default_group,
+                    processor, closed(ts_now, None))
+    remove_members_of(users_membership_terminated, config.member_group,
+                      processor, closedopen(ts_now, None))
+    for fee_name, user_ids in terminated_by_fee.items():
+        log_user_events("Mitgliedschaftsende wegen Zahlungsrückstand ({})"
+                        .format(fee_name), processor, user_ids)
 
     return users_pid_membership, users_membership_terminated
 
 
 def process_transactions(bank_account, statement):
-    transactions = []  # new transactions which would be imported
-    old_transactions = []  # transactions which are already imported
+    """Split the lines of a FinTS statement into new and imported ones.
 
+    All lines are checked against the existing activities of the bank
+    account with a single query.
+
+    :param BankAccount bank_account: the bank account of the statement
+    :param statement: the transactions of the statement
+    :return: the new and the already imported activities (not added to
+        the session)
+    :rtype: tuple[list[BankAccountActivity], list[BankAccountActivity]]
+    """
+    imported_at = session.utcnow()
+    activities = []
     for transaction in statement:
         iban = transaction.data['applicant_iban'] if \
             transaction.data['applicant_iban'] is not None else ''
@@ -629,33 +792,58 @@ def process_transactions(bank_account, statement):
             transaction.data['applicant_name'] is not None else ''
         prupose = transaction.data['purpose'] if \
             transaction.data['purpose'] is not None else ''
-        new_activity = BankAccountActivity(
+        activities.append(BankAccountActivity(
             bank_account_id=bank_account.id,
             amount=transaction.data['amount'].amount,
             reference=prupose,
             other_account_number=iban,
             other_routing_number=bic,
             other_name=other_name,
-            imported_at=session.utcnow(),
+            imported_at=imported_at,
             posted_on=transaction.data['entry_date'],
             valid_on=transaction.data['date'],
-        )
-        if BankAccountActivity.q.filter(and_(
-                BankAccountActivity.bank_account_id ==
-                new_activity.bank_account_id,
-                BankAccountActivity.amount == new_activity.amount,
-                BankAccountActivity.reference == new_activity.reference,
-                BankAccountActivity.other_account_number ==
-                new_activity.other_account_number,
-                BankAccountActivity.other_routing_number ==
-                new_activity.other_routing_number,
-                BankAccountActivity.other_name == new_activity.other_name,
-                BankAccountActivity.posted_on == new_activity.posted_on,
-                BankAccountActivity.valid_on == new_activity.valid_on
-        )).first() is None:
-            transactions.append(new_activity)
+        ))
+    if not activities:
+        return [], []
+
+    def column(attribute, type_):
+        return func.unnest(literal([getattr(a, attribute) for a in activities],
+                                   ARRAY(type_))).label(attribute)
+
+    # Unnesting several arrays in the select list zips them
+    lines = select([
+        func.unnest(literal(list(range(len(activities))), ARRAY(Integer)))
+        .label('index'),
+        column('amount', Money),
+        column('reference', Text),
+        column('other_account_number', Text),
+        column('other_routing_number', Text),
+        column('other_name', Text),
+        column('posted_on', Date),
+        column('valid_on', Date),
+    ]).alias('lines')
+    imported = exists().where(and_(
+        BankAccountActivity.bank_account_id == bank_account.id,
+        BankAccountActivity.amount == lines.c.amount,
+        BankAccountActivity.reference == lines.c.reference,
+        BankAccountActivity.other_account_number ==
+        lines.c.other_account_number,
+        BankAccountActivity.other_routing_number ==
+        lines.c.other_routing_number,
+        BankAccountActivity.other_name == lines.c.other_name,
+        BankAccountActivity.posted_on == lines.c.posted_on,
+        BankAccountActivity.valid_on == lines.c.valid_on,
+    ))
+    imported_indices = {index for index, in session.session.execute(
+        select([lines.c.index]).where(imported))}
+
+    transactions = []  # new transactions which would be imported
+    old_transactions = []  # transactions which are already imported
+    for index, activity in enumerate(activities):
+        if index in imported_indices:
+            old_transactions.append(activity)
         else:
-            old_transactions.append(new_activity)
+            transactions.append(activity)
 
     return (transactions, old_transactions)
 
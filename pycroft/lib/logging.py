@@ -2,10 +2,16 @@
 # This file is part of the Pycroft project and licensed under the terms of
 # the Apache License, Version 2.0. See the LICENSE file for details.
 from datetime import datetime
+
+from sqlalchemy import func, literal, select, Integer
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.sql import ClauseElement
+
 from pycroft.model import session
 from pycroft.model.facilities import Room
-from pycroft.model.logging import UserLogEntry, RoomLogEntry
+from pycroft.model.logging import LogEntry, UserLogEntry, RoomLogEntry
 from pycroft.model.session import with_transaction
+from pycroft.model.types import DateTimeTz
 from pycroft.model.user import User
 
 
@@ -47,6 +53,76 @@ def log_user_event(message, author, user, created_at=None):
                              user=user)
 
 
+def user_log_entries_cte(message, author, user_ids, created_at=None,
+                         name='user_log_entries'):
+    """
+    Build a CTE creating a UserLogEntry with the same message for each of
+    the given users.
+
+    The CTE has to be used by the statement executed, e.g. by selecting
+    from it, and yields the ``id`` and ``user_id`` of the new entries.
+    This allows logging events for many users with a single statement.
+
+    :param unicode message: the log message text
+    :param User author: user responsible for the entries
+    :param user_ids: a selectable with the user ids as its only column
+        or an iterable of user ids
+    :param datetime|None created_at: Creation time of the entries.
+        Defaults to current database time if None.
+    :param str name: the name of the CTE.  The auxiliary CTEs are named
+        after it.
+    :return: the CTE
+    """
+    if not isinstance(user_ids, ClauseElement):
+        user_ids = select([func.unnest(literal(list(user_ids),
+                                               ARRAY(Integer)))])
+    if created_at is None:
+        created_at = func.current_timestamp()
+    else:
+        created_at = literal(created_at, DateTimeTz)
+    users = user_ids.alias('{}_users'.format(name))
+    # The ids are drawn up front, so that the entries of both tables
+    # can be matched up.
+    ids = select([
+        func.nextval('log_entry_id_seq').label('id'),
+        list(users.c)[0].label('user_id')
+    ]).cte('{}_ids'.format(name))
+    log_entry = LogEntry.__table__
+    log_entries = log_entry.insert().from_select(
+        [log_entry.c.id, log_entry.c.type, log_entry.c.message,
+         log_entry.c.author_id, log_entry.c.created_at],
+        select([ids.c.id, literal('user_log_entry'), literal(message),
+                literal(author.id), created_at])
+    ).returning(log_entry.c.id).cte('{}_base'.format(name))
+    user_log_entry = UserLogEntry.__table__
+    return user_log_entry.insert().from_select(
+        [user_log_entry.c.id, user_log_entry.c.user_id],
+        select([ids.c.id, ids.c.user_id])
+        .select_from(ids.join(log_entries, log_entries.c.id == ids.c.id))
+    ).returning(user_log_entry.c.id, user_log_entry.c.user_id).cte(name)
+
+
+@with_transaction
+def log_user_events(message, author, user_ids, created_at=None):
+    """
+    This method will create a UserLogEntry with the same message for each
+    of the given users using a single statement.
+
+    :param unicode message: the log message text
+    :param User author: user responsible for the entries
+    :param user_ids: a selectable with the user ids as its only column
+        or an iterable of user ids
+    :param datetime|None created_at: Creation time of the entries.
+        Defaults to current database time if None.
+    :return: the number of created entries
+    :rtype: int
+    """
+    entries = user_log_entries_cte(message, author, user_ids, created_at)
+    return session.session.execute(
+        select([func.count()]).select_from(entries)
+    ).scalar()
+
+
 def log_room_event(message, author, room, created_at=None):
     """
     This method will create a new RoomLogEntry.
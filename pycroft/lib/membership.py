@@ -10,11 +10,17 @@ This module contains functions concerning groups, membership, and property
 management.
 
 """
+from sqlalchemy import (
+    and_, any_, case, cast, func, literal, not_, null, select, union,
+    union_all, Integer)
+from sqlalchemy.dialects.postgresql import ARRAY, TSTZRANGE
+
 from pycroft.helpers.i18n import deferred_gettext
 from pycroft.helpers.interval import UnboundedInterval, IntervalSet, closed
-from pycroft.lib.logging import log_user_event
+from pycroft.lib.logging import log_user_event, log_user_events
 from pycroft.model import session
 from pycroft.model.session import with_transaction
+from pycroft.model.types import DateTimeTz
 from pycroft.model.user import Membership
 
 
@@ -90,6 +96,26 @@ def make_member_of(user, group, processor, during=UnboundedInterval):
                    user=user, author=processor)
 
 
+def overlapping_memberships(membership, during):
+    """Return the other memberships in the same group overlapping with an
+    interval.
+
+    Memberships of a user in a group must not overlap.  As the
+    ``membership_exclusive_excl`` constraint is only checked on commit,
+    changes of a membership's interval should be validated with this
+    beforehand.
+
+    :param Membership membership: the membership to be changed
+    :param Interval during: the new interval of the membership
+    :rtype: list[Membership]
+    """
+    return session.session.query(Membership).filter(
+        Membership.user_id == membership.user_id,
+        Membership.group_id == membership.group_id,
+        Membership.id != membership.id,
+        Membership.active(during)).all()
+
+
 @with_transaction
 def remove_member_of(user, group, processor, during=UnboundedInterval):
     """Remove a user from a group in a given interval.
@@ -120,4 +146,250 @@ def remove_member_of(user, group, processor, during=UnboundedInterval):
     message = deferred_gettext(u"Removed from group {group} during {during}.")
     log_user_event(message=message.format(group=group.name,
                                           during=during).to_json(),
-                   user=user, author=processor)
\ No newline at end of file
+                   user=user, author=processor)
+
+
+def _tstzrange(begin, end, bounds='[]'):
+    return func.tstzrange(literal(begin, DateTimeTz),
+                          literal(end, DateTimeTz), bounds, type_=TSTZRANGE)
+
+
+def _delete_memberships(user_ids, group, during):
+    """Build a CTE deleting the memberships of users in a group that
+    overlap with a given interval.
+
+    The CTE yields the ``user_id`` and ``active_during`` range of the
+    deleted memberships.
+    """
+    membership = Membership.__table__
+    return membership.delete().where(and_(
+        membership.c.group_id == group.id,
+        membership.c.user_id == any_(user_ids),
+        Membership.active(during)
+    )).returning(
+        membership.c.user_id,
+        Membership.active_during.label('active_during')
+    ).cte('deleted_memberships')
+
+
+def _insert_memberships(group, ranges):
+    """Build a statement inserting memberships of a group from a
+    selectable with ``user_id`` and ``begins_at``/``ends_at`` columns.
+    """
+    membership = Membership.__table__
+    return membership.insert().from_select(
+        [membership.c.user_id, membership.c.group_id,
+         membership.c.begins_at, membership.c.ends_at],
+        select([ranges.c.user_id, literal(group.id),
+                ranges.c.begins_at, ranges.c.ends_at])
+    )
+
+
+def _prepare_bulk_membership_change(users):
+    users = list(users)
+    # The statements below bypass the unit of work
+    session.session.flush()
+    return users, literal([u.id for u in users], ARRAY(Integer))
+
+
+def _expire_memberships(users, group):
+    for user in users:
+        session.session.expire(user, ['memberships'])
+    session.session.expire(group, ['memberships'])
+
+
+@with_transaction
+def make_members_of(users, group, processor, during=UnboundedInterval):
+    """Make several users members of a group in a given interval.
+
+    This is the set-based variant of :py:func:`make_member_of`: The
+    overlapping memberships of all users are merged with the interval
+    in the database, which takes a constant number of statements
+    regardless of the number of users.
+
+    :param iterable[User] users: the users
+    :param Group group: the group
+    :param User processor: User issuing the addition
+    :param Interval during:
+    """
+    users, user_ids = _prepare_bulk_membership_change(users)
+    if not users:
+        return
+    deleted = _delete_memberships(user_ids, group, during)
+    ranges = union_all(
+        select([deleted.c.user_id, deleted.c.active_during]),
+        select([func.unnest(user_ids), _tstzrange(during.begin, during.end)])
+    ).alias('ranges')
+    # All ranges of a user overlap with ``during``, so their union is a
+    # single range
+    active_during = ranges.c.active_during
+    merged = select([
+        ranges.c.user_id,
+        case([(func.bool_or(func.lower_inf(active_during)), null())],
+             else_=func.min(func.lower(active_during))).label('begins_at'),
+        case([(func.bool_or(func.upper_inf(active_during)), null())],
+             else_=func.max(func.upper(active_during))).label('ends_at'),
+    ]).group_by(ranges.c.user_id).alias('merged')
+    session.session.execute(_insert_memberships(group, merged))
+    _expire_memberships(users, group)
+    message = deferred_gettext(u"Added to group {group} during {during}.")
+    log_user_events(message=message.format(group=group.name,
+                                           during=during).to_json(),
+                    author=processor, user_ids=[u.id for u in users])
+
+
+@with_transaction
+def remove_members_of(users, group, processor, during=UnboundedInterval):
+    """Remove several users from a group in a given interval.
+
+    This is the set-based variant of :py:func:`remove_member_of`: The
+    overlapping memberships of all users are cut by the interval in the
+    database, which takes a constant number of statements regardless of
+    the number of users.
+
+    :param iterable[User] users: the users
+    :param Group group: the group
+    :param User processor: User issuing the removal
+    :param Interval during:
+    """
+    users, user_ids = _prepare_bulk_membership_change(users)
+    if not users:
+        return
+    deleted = _delete_memberships(user_ids, group, during)
+    # The parts of the memberships before and after ``during`` remain
+    remaining = []
+    if during.begin is not None:
+        upper = ')' if during.lower_bound.closed else ']'
+        remaining.append(_tstzrange(None, during.begin, '[' + upper))
+    if during.end is not None:
+        lower = '(' if during.upper_bound.closed else '['
+        remaining.append(_tstzrange(during.end, None, lower + ']'))
+    if not remaining:
+        session.session.execute(select([func.count()]).select_from(deleted))
+    else:
+        parts = union_all(*(
+            select([deleted.c.user_id,
+                    deleted.c.active_during.op('*')(r).label('part')])
+            for r in remaining
+        )).alias('parts')
+        ranges = select([
+            parts.c.user_id,
+            func.lower(parts.c.part).label('begins_at'),
+            func.upper(parts.c.part).label('ends_at'),
+        ]).where(not_(func.isempty(parts.c.part))).alias('ranges')
+        session.session.execute(_insert_memberships(group, ranges))
+    _expire_memberships(users, group)
+    message = deferred_gettext(u"Removed from group {group} during {during}.")
+    log_user_events(message=message.format(group=group.name,
+                                           during=during).to_json(),
+                    author=processor, user_ids=[u.id for u in users])
+
+
+#: Hooks called with the ids of the users whose memberships began or ended
+#: (see :func:`process_membership_boundaries`).  ``None`` instead of a set
+#: of ids means that the state of all users has to be refreshed.
+membership_boundary_hooks = []
+
+
+def on_membership_boundary(hook):
+    """Register a hook to be called when memberships begin or end.
+
+    Can be used as a decorator.
+
+    :param callable hook: a callable taking the set of affected user ids
+        or ``None`` for all users
+    :return: the hook itself
+    """
+    membership_boundary_hooks.append(hook)
+    return hook
+
+
+@on_membership_boundary
+@with_transaction
+def refresh_current_properties(user_ids=None):
+    """Recompute the materialized current properties of users.
+
+    The ``current_property`` table is kept up to date by triggers
+    whenever memberships or properties change.  A membership beginning
+    or ending as time passes does not fire any trigger, though, so the
+    affected users have to be refreshed explicitly.
+
+    :param iterable[int]|None user_ids: The ids of the users to
+        refresh.  If ``None``, the properties of all users are
+        recomputed.
+    """
+    if user_ids is None:
+        user_ids_array = cast(null(), ARRAY(Integer))
+    else:
+        user_ids_array = literal(list(user_ids), ARRAY(Integer))
+    session.session.execute(
+        select([func.refresh_current_property(user_ids_array)])
+    )
+
+
+def users_with_membership_boundaries(after, until):
+    """Return the users whose memberships began or ended in a time span.
+
+    Memberships are closed intervals: a membership is active from
+    ``begins_at`` up to and including ``ends_at``.  Beginnings are
+    therefore taken from ``(after, until]`` and endings from
+    ``[after, until)``, so that consecutive spans neither miss nor
+    repeat a boundary and an ending is only reported once it passed.
+
+    :param datetime after: start of the time span
+    :param datetime until: end of the time span
+    :rtype: set[int]
+    """
+    began = select([Membership.user_id]).where(and_(
+        Membership.begins_at > after, Membership.begins_at <= until))
+    ended = select([Membership.user_id]).where(and_(
+        Membership.ends_at >= after, Membership.ends_at < until))
+    return {user_id for user_id,
+            in session.session.execute(union(began, ended))}
+
+
+def next_membership_boundary(after):
+    """Return the point in time of the next membership boundary.
+
+    :param datetime after: the point in time after which to look for a
+        boundary
+    :return: the earliest boundary not yet covered by
+        :func:`users_with_membership_boundaries` for spans starting at
+        ``after`` or ``None`` if there is none
+    :rtype: datetime|None
+    """
+    next_begin = (select([func.min(Membership.begins_at)])
+                  .where(Membership.begins_at > after).as_scalar())
+    next_end = (select([func.min(Membership.ends_at)])
+                .where(Membership.ends_at >= after).as_scalar())
+    return session.session.query(func.least(next_begin, next_end)).scalar()
+
+
+@with_transaction
+def process_membership_boundaries(after, until):
+    """Fire the membership boundary hooks for a time span.
+
+    Every registered hook is called once with the ids of the users
+    whose memberships began or ended in the time span, if there are any.
+
+    :param datetime after: start of the time span
+    :param datetime until: end of the time span
+    :return: the ids of the affected users
+    :rtype: set[int]
+    """
+    user_ids = users_with_membership_boundaries(after, until)
+    if user_ids:
+        for hook in membership_boundary_hooks:
+            hook(user_ids)
+    return user_ids
+
+
+@with_transaction
+def refresh_all_membership_boundaries():
+    """Call every registered membership boundary hook for all users.
+
+    This is needed whenever boundaries may have passed unnoticed, e.g.
+    when the scheduler has not been running for a while.
+    """
+    for hook in membership_boundary_hooks:
+        hook(None)
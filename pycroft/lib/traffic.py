@@ -10,20 +10,29 @@ This module contains functions concerning traffic group membership, credit
 granting, etc.
 
 """
-from datetime import datetime
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
 from operator import attrgetter, or_
 
-from sqlalchemy import not_
+from sqlalchemy import and_, case, cast, exists, func, literal, literal_column, \
+    not_, null, select, union, Integer, BigInteger, TEXT, TIMESTAMP
+from sqlalchemy.dialects.postgresql import ARRAY, insert
 
 from pycroft import config
 from pycroft.helpers.i18n import deferred_gettext
-from pycroft.helpers.interval import closedopen, closed
-from pycroft.lib.logging import log_user_event
+from pycroft.helpers.interval import closedopen, closed, single
+from pycroft.lib.logging import log_user_event, user_log_entries_cte
 from pycroft.lib.membership import remove_member_of, make_member_of
 from pycroft.model import session
+from pycroft.model.facilities import Room
+from pycroft.model.host import Host, Interface, IP
 from pycroft.model.logging import UserLogEntry
 from pycroft.model.property import CurrentProperty
-from pycroft.model.traffic import TrafficCredit, CurrentTrafficBalance
+from pycroft.model.traffic import TrafficBalance, TrafficCredit, \
+    TrafficVolume, CurrentTrafficBalance, MonthlyTrafficVolume, DailyTraffic, \
+    folding_traffic_volumes_setting
+from pycroft.model.types import DateTimeTz
 from pycroft.model.user import TrafficGroup, User, Membership, PropertyGroup
 from pycroft.model.session import with_transaction
 
@@ -134,6 +143,89 @@ def grant_regular_credit(user):
     session.session.add(credit)
 
 
+#: Origin of credit periods not consisting of whole months, a Monday
+credit_period_origin = datetime(1970, 1, 5, tzinfo=timezone.utc)
+
+
+def credit_period_start(credit_interval, when):
+    """Build an SQL expression for the beginning of the credit period
+    containing a point in time.
+
+    Intervals with a month part (like ``'1 month'``) divide the calendar
+    into periods of that many months, starting with January.  Other
+    intervals are counted from :py:data:`credit_period_origin`, so that
+    e.g. weekly periods start on Mondays.
+
+    :param credit_interval: SQL expression of the ``interval``
+    :param when: SQL expression of the point in time
+    """
+    months = cast(func.extract('year', credit_interval) * 12
+                  + func.extract('month', credit_interval), Integer)
+    month_start = func.date_trunc('month', when)
+    month_index = cast(func.extract('year', month_start) * 12
+                       + func.extract('month', month_start) - 1, Integer)
+    origin = literal(credit_period_origin, DateTimeTz)
+    seconds = func.extract('epoch', credit_interval)
+    elapsed = func.extract('epoch', when - origin)
+    return case(
+        [(months > 0,
+          month_start - func.mod(month_index, months)
+          * literal_column("interval '1 month'"))],
+        else_=origin + func.floor(elapsed / seconds) * seconds
+        * literal_column("interval '1 second'"),
+    )
+
+
+@with_transaction
+def grant_regular_credits(when=None):
+    """Grant the regular credit to all users in a traffic group
+
+    Like :py:func:`grant_regular_credit`, the relevant
+    :py:cls:`TrafficGroup` of a user is the one with the largest
+    ``credit_amount``, but it is determined for all users at once in the
+    database and all credits are inserted by a single statement.
+
+    The credit is dated to the beginning of the current period of the
+    group's ``credit_interval`` (see :py:func:`credit_period_start`).
+    Users who already have a credit at that point in time are skipped,
+    so that granting the credits repeatedly in the same period is safe.
+
+    :param datetime when: the point in time to grant the credits for.
+        Defaults to now.
+    :return: the number of granted credits
+    :rtype: int
+    """
+    if when is None:
+        when = session.utcnow()
+    effective_groups = (
+        select([Membership.user_id,
+                TrafficGroup.credit_amount,
+                credit_period_start(TrafficGroup.credit_interval,
+                                    literal(when, DateTimeTz))
+                .label('period_start')])
+        .select_from(Membership.__table__.join(
+            TrafficGroup.__table__, TrafficGroup.id == Membership.group_id))
+        .where(Membership.active(single(when)))
+        .distinct(Membership.user_id)
+        .order_by(Membership.user_id, TrafficGroup.credit_amount.desc(),
+                  TrafficGroup.initial_credit_amount.desc())
+        .cte('effective_traffic_groups')
+    )
+
+    credit = TrafficCredit.__table__
+    existing = credit.alias('existing_credit')
+    stmt = credit.insert().from_select(
+        [credit.c.user_id, credit.c.amount, credit.c.timestamp],
+        select([effective_groups.c.user_id, effective_groups.c.credit_amount,
+                effective_groups.c.period_start])
+        .where(not_(exists().where(and_(
+            existing.c.user_id == effective_groups.c.user_id,
+            existing.c.timestamp == effective_groups.c.period_start,
+        ))))
+    )
+    return session.session.execute(stmt).rowcount
+
+
 @with_transaction
 def reset_credit(user, processor, target_amount=1*1024**3):
     """Compensate a user's traffic credit to a target amount
@@ -158,36 +250,431 @@ def reset_credit(user, processor, target_amount=1*1024**3):
                    user=user)
 
 
+@with_transaction
+def refresh_current_traffic_balances(user_ids=None):
+    """Recompute the current traffic balance of users from scratch.
+
+    The ``current_traffic_balance`` table is kept up to date by
+    triggers, so this is only needed to repair it, e.g. after the
+    triggers have been disabled during a bulk import.
+
+    :param iterable[int]|None user_ids: The ids of the users to
+        refresh.  If ``None``, the balances of all users are recomputed.
+    """
+    session.session.execute(select([
+        func.refresh_current_traffic_balance(_user_ids_array(user_ids))
+    ]))
+
+
+@with_transaction
+def refresh_daily_traffic(user_ids=None):
+    """Recompute the daily traffic rollup of users from scratch.
+
+    The ``daily_traffic`` table is kept up to date by triggers, so this
+    is only needed to fill it initially or to repair it.
+
+    :param iterable[int]|None user_ids: The ids of the users to
+        refresh.  If ``None``, the rollup of all users is recomputed.
+    """
+    session.session.execute(select([
+        func.refresh_daily_traffic(_user_ids_array(user_ids))
+    ]))
+
+
+def _user_ids_array(user_ids):
+    if user_ids is None:
+        return cast(null(), ARRAY(Integer))
+    return literal(list(user_ids), ARRAY(Integer))
+
+
+@with_transaction
+def checkpoint_traffic_balances(cutoff):
+    """Roll the traffic balances of all users forward to a cutoff.
+
+    For every user with traffic credits or volumes between their
+    current :py:cls:`TrafficBalance` (if any) and ``cutoff``, the
+    balance is replaced by one at ``cutoff`` which incorporates these
+    events.  Afterwards, computing the balance or the traffic history
+    only has to consider events not older than ``cutoff``.
+
+    All balances are written by a single ``INSERT … ON CONFLICT``.
+
+    :param datetime cutoff: the point in time to roll forward to.
+        Events at or after it are not incorporated.
+    :return: the number of users whose balance has been rolled forward
+    :rtype: int
+    """
+    cutoff = literal(cutoff, DateTimeTz)
+
+    def events_since_balance(event):
+        return (select([func.sum(event.amount)])
+                .where(and_(event.user_id == User.id,
+                            event.timestamp < cutoff,
+                            or_(TrafficBalance.timestamp.is_(None),
+                                event.timestamp >= TrafficBalance.timestamp)))
+                .as_scalar())
+
+    sums = (select([User.id.label('user_id'),
+                    func.coalesce(TrafficBalance.amount, 0).label('balance'),
+                    events_since_balance(TrafficCredit).label('credit'),
+                    events_since_balance(TrafficVolume).label('volume')])
+            .select_from(User.__table__.outerjoin(TrafficBalance.__table__))
+            .where(or_(TrafficBalance.timestamp.is_(None),
+                       TrafficBalance.timestamp < cutoff))
+            .cte('traffic_balance_sums'))
+
+    stmt = insert(TrafficBalance.__table__).from_select(
+        [TrafficBalance.user_id, TrafficBalance.amount,
+         TrafficBalance.timestamp],
+        select([sums.c.user_id,
+                cast(sums.c.balance + func.coalesce(sums.c.credit, 0)
+                     - func.coalesce(sums.c.volume, 0), BigInteger),
+                cutoff])
+        .where(or_(sums.c.credit.isnot(None), sums.c.volume.isnot(None)))
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[TrafficBalance.user_id],
+        set_={'amount': stmt.excluded.amount,
+              'timestamp': stmt.excluded.timestamp},
+    )
+    return session.session.execute(stmt).rowcount
+
+
+@with_transaction
+def create_traffic_volume_partitions(months_ahead=1):
+    """Create the ``traffic_volume`` partitions of the upcoming months.
+
+    Partitions already existing are left alone.  Volumes inserted for a
+    month without a partition end up in the default partition, from
+    where they are moved once the partition is created.
+
+    :param int months_ahead: the number of months following the
+        current one to create partitions for
+    """
+    month = literal_column("interval '1 month'")
+    for i in range(months_ahead + 1):
+        session.session.execute(select([func.traffic_volume_create_partition(
+            func.current_timestamp() + month * i
+        )]))
+
+
+@with_transaction
+def fold_traffic_volumes(keep_months):
+    """Fold traffic volumes older than a retention period into
+    :py:cls:`MonthlyTrafficVolume` and drop them.
+
+    The traffic balances are rolled forward to the beginning of the
+    retention period first (see :py:func:`checkpoint_traffic_balances`),
+    so that dropping the volumes does not change them.  The traffic
+    history before that point in time is not accurate anymore, though.
+
+    Partitions lying completely before the retention period are
+    dropped, remaining volumes (e.g. in the default partition) are
+    deleted.  Either way, the volumes stay in :py:cls:`DailyTraffic`.
+
+    :param int keep_months: the number of months before the current
+        one whose volumes are retained
+    :return: the beginning of the retention period
+    :rtype: datetime
+    """
+    cutoff = session.session.query(
+        func.date_trunc('month', func.current_timestamp())
+        - literal_column("interval '1 month'") * keep_months
+    ).scalar()
+    checkpoint_traffic_balances(cutoff)
+
+    month = func.date_trunc('month', TrafficVolume.timestamp)
+    stmt = insert(MonthlyTrafficVolume.__table__).from_select(
+        [MonthlyTrafficVolume.user_id, MonthlyTrafficVolume.type,
+         MonthlyTrafficVolume.month, MonthlyTrafficVolume.amount,
+         MonthlyTrafficVolume.packets],
+        select([TrafficVolume.user_id, TrafficVolume.type, month,
+                func.sum(TrafficVolume.amount),
+                func.sum(TrafficVolume.packets)])
+        .where(and_(TrafficVolume.timestamp < cutoff,
+                    TrafficVolume.user_id.isnot(None)))
+        .group_by(TrafficVolume.user_id, TrafficVolume.type, month)
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[MonthlyTrafficVolume.user_id,
+                        MonthlyTrafficVolume.type,
+                        MonthlyTrafficVolume.month],
+        set_={
+            'amount': MonthlyTrafficVolume.amount + stmt.excluded.amount,
+            'packets': MonthlyTrafficVolume.packets + stmt.excluded.packets,
+        },
+    )
+    session.session.execute(stmt)
+
+    session.session.execute(
+        select([func.traffic_volume_drop_partitions(cutoff)]))
+    # Dropping partitions does not fire any triggers, so the deleted
+    # volumes have to be kept in daily_traffic as well
+    def set_folding(value):
+        session.session.execute(select([func.set_config(
+            folding_traffic_volumes_setting, value, True)]))
+    set_folding('on')
+    session.session.execute(TrafficVolume.__table__.delete().where(
+        TrafficVolume.timestamp < cutoff))
+    set_folding('off')
+    return cutoff
+
+
+PmacctRecord = namedtuple('PmacctRecord',
+                          'type address stamp bytes packets')
+PmacctRecord.__doc__ = """A record exported by pmacct
+
+:param str type: the direction, either ``'Ingress'`` or ``'Egress'``
+:param str address: the IP address of the record (``ip_dst`` for
+    ingress, ``ip_src`` for egress)
+:param datetime stamp: ``stamp_inserted`` of the record
+:param int bytes: the number of bytes
+:param int packets: the number of packets
+"""
+
+
+def aggregate_pmacct_records(records, aggregate=None):
+    """Sum up pmacct records by IP address, direction and day.
+
+    :param iterable[PmacctRecord] records: the records to add
+    :param dict aggregate: an aggregate to add the records to.  If
+        ``None``, a new one is created.
+    :return: the aggregate, mapping ``(type, address, day)`` to a list
+        ``[bytes, packets]``
+    :rtype: dict
+    """
+    if aggregate is None:
+        aggregate = {}
+    for record in records:
+        day = record.stamp.replace(hour=0, minute=0, second=0, microsecond=0)
+        totals = aggregate.setdefault((record.type, record.address, day),
+                                      [0, 0])
+        totals[0] += record.bytes
+        totals[1] += record.packets
+    return aggregate
+
+
+@with_transaction
+def write_pmacct_aggregate(aggregate):
+    """Add aggregated pmacct records to the traffic volumes.
+
+    The aggregate is passed to ``pmacct_traffic_insert_batch`` as
+    arrays, which resolves the owners of the IP addresses and upserts
+    the volumes in a single statement.  Addresses not belonging to any
+    host are ignored, like records inserted into the pmacct views.
+
+    :param dict aggregate: an aggregate as returned by
+        :py:func:`aggregate_pmacct_records`
+    """
+    if not aggregate:
+        return
+    keys = list(aggregate)
+    session.session.execute(select([func.pmacct_traffic_insert_batch(
+        cast(literal([type_ for type_, _, _ in keys]), ARRAY(TEXT)),
+        cast(literal([str(address) for _, address, _ in keys]), ARRAY(TEXT)),
+        cast(literal([day for _, _, day in keys]),
+             ARRAY(TIMESTAMP(timezone=True))),
+        cast(literal([aggregate[key][0] for key in keys]), ARRAY(BigInteger)),
+        cast(literal([aggregate[key][1] for key in keys]), ARRAY(BigInteger)),
+    )]))
+
+
+def ingest_pmacct_records(records):
+    """Add a batch of pmacct records to the traffic volumes.
+
+    Unlike inserting into the ``pmacct_traffic_ingress`` and
+    ``pmacct_traffic_egress`` views, which resolves and upserts every
+    record on its own, the batch is aggregated first and written by a
+    single statement.
+
+    :param iterable[PmacctRecord] records: the records
+    :return: the number of aggregated volumes written
+    :rtype: int
+    """
+    aggregate = aggregate_pmacct_records(records)
+    write_pmacct_aggregate(aggregate)
+    return len(aggregate)
+
+
+def _utc_day(time, ceil=False):
+    """Round a point in time to the beginning of its day in UTC
+
+    :param datetime time: the point in time.  Naive ones are taken as
+        UTC.
+    :param bool ceil: round up instead of down
+    :rtype: datetime
+    """
+    if time.tzinfo is None:
+        time = time.replace(tzinfo=timezone.utc)
+    time = time.astimezone(timezone.utc)
+    day = time.replace(hour=0, minute=0, second=0, microsecond=0)
+    if ceil and day != time:
+        day += timedelta(days=1)
+    return day
+
+
+def top_traffic_consumers(start, end, type='Egress', by='user', limit=10,
+                          building=None, subnet=None):
+    """Determine the users, hosts or IPs with the most traffic in a
+    window.
+
+    Traffic volumes are recorded per day, so the window is extended to
+    whole days (starting at midnight UTC, like the days of the
+    :py:class:`DailyTraffic` rollup).  The totals of users are read from
+    the daily rollup unless restricted to a subnet, all other totals
+    from the traffic volumes.  As the volumes are only retained for a
+    limited time (see :py:func:`fold_traffic_volumes`), rankings other
+    than the one of users without a subnet are empty for older windows.
+
+    :param datetime start: the beginning of the window (inclusive)
+    :param datetime end: the end of the window (exclusive)
+    :param str type: either ``'Ingress'`` or ``'Egress'``
+    :param str by: what to rank, one of ``'user'``, ``'host'`` and
+        ``'ip'``
+    :param int limit: the number of consumers to return
+    :param Building building: only rank users (for ``by='user'``) or
+        hosts living in this building
+    :param Subnet subnet: only count the traffic of IPs in this subnet
+    :return: pairs of a consumer and its traffic in bytes, the biggest
+        consumer first
+    :rtype: list[(User|Host|IP, int)]
+    :raises ValueError: if ``type`` or ``by`` is invalid
+    """
+    if type not in ('Ingress', 'Egress'):
+        raise ValueError("Invalid traffic type {!r}".format(type))
+    entities = {'user': User, 'host': Host, 'ip': IP}
+    if by not in entities:
+        raise ValueError("Cannot rank traffic by {!r}".format(by))
+    entity = entities[by]
+    start, end = _utc_day(start), _utc_day(end, ceil=True)
+
+    if by == 'user' and subnet is None:
+        key = DailyTraffic.user_id
+        amount = func.sum(getattr(DailyTraffic, type.lower()))
+        totals = select([key.label('id'), amount.label('amount')])\
+            .where(and_(DailyTraffic.day >= start, DailyTraffic.day < end))
+    else:
+        key = {'user': TrafficVolume.user_id, 'host': Host.id,
+               'ip': TrafficVolume.ip_id}[by]
+        amount = func.sum(TrafficVolume.amount)
+        needs_host = by == 'host' or (by == 'ip' and building is not None)
+        volumes = TrafficVolume.__table__
+        if needs_host or subnet is not None:
+            volumes = volumes.join(IP.__table__, IP.id == TrafficVolume.ip_id)
+        if needs_host:
+            volumes = volumes.join(
+                Interface.__table__, Interface.id == IP.interface_id
+            ).join(Host.__table__, Host.id == Interface.host_id)
+        totals = select([key.label('id'), amount.label('amount')])\
+            .select_from(volumes)\
+            .where(and_(TrafficVolume.type == type,
+                        TrafficVolume.timestamp >= start,
+                        TrafficVolume.timestamp < end))
+        if subnet is not None:
+            totals = totals.where(IP.subnet_id == subnet.id)
+
+    if building is not None:
+        room_id = User.room_id if by == 'user' else Host.room_id
+        if by == 'user':
+            totals = totals.where(key == User.id)
+        totals = totals.where(and_(room_id == Room.id,
+                                   Room.building_id == building.id))
+
+    totals = totals.where(key.isnot(None)).group_by(key)\
+        .order_by(amount.desc()).limit(limit).alias('totals')
+
+    return session.session.query(entity, totals.c.amount)\
+        .join(totals, entity.id == totals.c.id)\
+        .order_by(totals.c.amount.desc()).all()
+
+
 @with_transaction
 def sync_exceeded_traffic_limits():
     """Adds and removes memberships of the 'traffic_limit_exceeded group.'
 
-    """
+    Users with a negative traffic balance become members from now on,
+    unless they have the ``traffic_limit_disabled`` or already have the
+    ``traffic_limit_exceeded`` property, or a membership from now on
+    already exists.  The memberships of users with the
+    ``traffic_limit_exceeded`` property end now, if their balance is not
+    negative anymore or they have the ``traffic_limit_disabled``
+    property.  Memberships not begun yet are deleted.
 
+    Memberships and log entries are written set-based, so the number of
+    statements does not depend on the number of users.
+
+    :return: the number of ``added`` and ``ended`` memberships and the
+        ``timings`` of both steps in seconds
+    :rtype: dict
+    """
     processor = User.q.get(0)
+    group = config.traffic_limit_exceeded_group
+    now = session.utcnow()
+    during = closed(now, None)
+    membership = Membership.__table__
+    balance = CurrentTrafficBalance.__table__
+    timings = {}
+
+    def has_property(name):
+        return exists().where(and_(CurrentProperty.user_id == balance.c.user_id,
+                                   CurrentProperty.property_name == name,
+                                   not_(CurrentProperty.denied)))
+
+    # A user whose property is denied by another group may still be a
+    # member, adding them again would overlap with that membership.
+    is_member = exists().where(and_(membership.c.user_id == balance.c.user_id,
+                                    membership.c.group_id == group.id,
+                                    Membership.active(during)))
 
     # Add memberships
-    users = User.q.join(User._current_traffic_balance) \
-                  .filter(CurrentTrafficBalance.amount < 0) \
-                  .except_(User.q.join(User.current_properties)\
-                  .filter(or_(CurrentProperty.property_name == 'traffic_limit_disabled',\
-                              CurrentProperty.property_name == 'traffic_limit_exceeded')))\
-                  .all()
-
-    for user in users:
-        make_member_of(user, config.traffic_limit_exceeded_group,
-                       processor, closed(session.utcnow(), None))
-        print("Traffic-Limit exceeded: " + user.name)
+    start = time.monotonic()
+    added_memberships = membership.insert().from_select(
+        [membership.c.begins_at, membership.c.ends_at, membership.c.user_id,
+         membership.c.group_id],
+        select([literal(now, DateTimeTz), null(), balance.c.user_id,
+                literal(group.id)])
+        .where(and_(balance.c.amount < 0,
+                    not_(has_property('traffic_limit_disabled')),
+                    not_(has_property('traffic_limit_exceeded')),
+                    not_(is_member)))
+    ).returning(membership.c.user_id).cte('traffic_limit_exceeded_added')
+    message = deferred_gettext(u"Added to group {group} during {during}.")
+    log_entries = user_log_entries_cte(
+        message.format(group=group.name, during=during).to_json(),
+        processor, added_memberships, created_at=now,
+        name='traffic_limit_exceeded_added_log')
+    added = session.session.execute(
+        select([func.count()]).select_from(log_entries)).scalar()
+    timings['add'] = time.monotonic() - start
 
     # End memberships
-    users = User.q.join(User.current_properties) \
-                  .filter(CurrentProperty.property_name == 'traffic_limit_exceeded') \
-                  .join(User._current_traffic_balance) \
-                  .filter(or_(CurrentTrafficBalance.amount >= 0,
-                              CurrentProperty.property_name == 'traffic_limit_disabled')) \
-                  .all()
-
-    for user in users:
-        remove_member_of(user, config.traffic_limit_exceeded_group,
-                         processor, closed(session.utcnow(), None))
-        print("Traffic-Limit no longer exceeded: " + user.name)
\ No newline at end of file
+    start = time.monotonic()
+    ending_users = select([balance.c.user_id]).where(and_(
+        has_property('traffic_limit_exceeded'),
+        or_(balance.c.amount >= 0, has_property('traffic_limit_disabled'))))
+    ended_memberships = membership.update().where(and_(
+        membership.c.group_id == group.id,
+        membership.c.user_id.in_(ending_users),
+        or_(membership.c.begins_at.is_(None), membership.c.begins_at < now),
+        or_(membership.c.ends_at.is_(None), membership.c.ends_at > now),
+    )).values(ends_at=now).returning(membership.c.user_id) \
+        .cte('traffic_limit_exceeded_ended')
+    # Like remove_member_of, memberships not begun yet are removed as well
+    deleted_memberships = membership.delete().where(and_(
+        membership.c.group_id == group.id,
+        membership.c.user_id.in_(ending_users),
+        membership.c.begins_at >= now,
+    )).returning(membership.c.user_id) \
+        .cte('traffic_limit_exceeded_deleted')
+    message = deferred_gettext(u"Removed from group {group} during {during}.")
+    log_entries = user_log_entries_cte(
+        message.format(group=group.name, during=during).to_json(),
+        processor,
+        union(select([ended_memberships.c.user_id]),
+              select([deleted_memberships.c.user_id])),
+        created_at=now, name='traffic_limit_exceeded_ended_log')
+    ended = session.session.execute(
+        select([func.count()]).select_from(log_entries)).scalar()
+    timings['end'] = time.monotonic() - start
+
+    return {'added': added, 'ended': ended, 'timings': timings}
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2018 The Pycroft Authors. See the AUTHORS file.
+# This file is part of the Pycroft project and licensed under the terms of
+# the Apache License, Version 2.0. See the LICENSE file for details.
+"""
+pycroft.lib.traffic_collector
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+This module contains an asyncio based collector receiving pmacct records,
+aggregating them in memory and flushing them to the traffic volumes in
+bulk.
+
+The collector reads JSON lines as written by pmacct's print plugin
+(``print_output: json``).  A record with an ``ip_src`` is counted as
+egress of that address, a record with an ``ip_dst`` as ingress.
+
+"""
+import asyncio
+import ipaddress
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from pycroft.lib.traffic import PmacctRecord, aggregate_pmacct_records, \
+    write_pmacct_aggregate
+from pycroft.model import session
+
+logger = logging.getLogger('pycroft.traffic_collector')
+
+
+def parse_pmacct_line(line):
+    """Parse a line of pmacct's JSON output.
+
+    ``stamp_inserted`` is written by pmacct in local time.  The stamps
+    of the records are converted to UTC, records without one are stamped
+    with the current time in UTC.
+
+    :param str line: the line
+    :return: the records contained in the line
+    :rtype: list[PmacctRecord]
+    :raises ValueError: if the line is not a valid pmacct record
+    """
+    data = json.loads(line)
+    try:
+        if 'stamp_inserted' in data:
+            stamp = datetime.strptime(data['stamp_inserted'],
+                                      '%Y-%m-%d %H:%M:%S')
+            stamp = stamp.astimezone(timezone.utc)
+        else:
+            stamp = datetime.now(timezone.utc)
+        bytes_, packets = int(data['bytes']), int(data['packets'])
+        # The addresses are cast to inet when flushed, so that a single
+        # malformed one would make every flush fail
+        addresses = [(type_, str(ipaddress.ip_address(str(data[key]))))
+                     for type_, key in (('Egress', 'ip_src'),
+                                        ('Ingress', 'ip_dst'))
+                     if key in data]
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError("Invalid pmacct record: {!r}".format(line)) from e
+    return [PmacctRecord(type_, address, stamp, bytes_, packets)
+            for type_, address in addresses]
+
+
+class TrafficCollector(object):
+    def __init__(self, flush_interval=60, max_buffer_size=10000, loop=None):
+        """Aggregate pmacct records in memory and flush them periodically
+
+        The aggregate is flushed every ``flush_interval`` seconds or as
+        soon as it holds ``max_buffer_size`` volumes, whatever happens
+        first.  Flushes are executed in a separate thread, one at a
+        time, so that receiving records is not blocked by the database.
+
+        The aggregate never holds more than ``max_buffer_size`` volumes.
+        Records that would add a volume to a full aggregate, e.g. while
+        the database is unavailable, are dropped and logged.
+
+        :param float flush_interval: maximum time between two flushes in
+            seconds
+        :param int max_buffer_size: maximum number of aggregated volumes
+            to keep in memory
+        :param loop: the event loop to use.  Defaults to the current
+            event loop.
+        """
+        self.flush_interval = flush_interval
+        self.max_buffer_size = max_buffer_size
+        self.loop = loop or asyncio.get_event_loop()
+        self.aggregate = {}
+        self.records_received = 0
+        self.volumes_dropped = 0
+        self.last_flush_latency = None
+        self.last_flush_size = 0
+        self._flush_lock = asyncio.Lock()
+        self._pending_flush = None
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    @property
+    def buffer_size(self):
+        """The number of aggregated volumes not yet flushed"""
+        return len(self.aggregate)
+
+    def _merge(self, aggregate):
+        """Add an aggregate to the buffered one.
+
+        Volumes not yet buffered are dropped if the buffer is full.
+
+        :param dict aggregate: an aggregate as returned by
+            :py:func:`aggregate_pmacct_records`
+        """
+        dropped = {}
+        for key, (bytes_, packets) in aggregate.items():
+            totals = self.aggregate.get(key)
+            if totals is None:
+                if self.buffer_size >= self.max_buffer_size:
+                    dropped[key] = (bytes_, packets)
+                    continue
+                totals = self.aggregate[key] = [0, 0]
+            totals[0] += bytes_
+            totals[1] += packets
+        if dropped:
+            self.volumes_dropped += len(dropped)
+            logger.warning("Buffer is full, dropping %d volumes (%d bytes)",
+                           len(dropped),
+                           sum(bytes_ for bytes_, _ in dropped.values()))
+            logger.debug("Dropped volumes: %r", dropped)
+
+    def _schedule_flush(self):
+        if self._pending_flush is None or self._pending_flush.done():
+            self._pending_flush = self.loop.create_task(self.flush())
+
+    def add(self, records):
+        """Add records to the aggregate.
+
+        Schedules a flush if the aggregate reaches ``max_buffer_size``
+        and none is pending yet.
+
+        :param iterable[PmacctRecord] records: the records
+        """
+        records = list(records)
+        self.records_received += len(records)
+        self._merge(aggregate_pmacct_records(records))
+        if self.buffer_size >= self.max_buffer_size:
+            self._schedule_flush()
+
+    def _write(self, aggregate):
+        try:
+            write_pmacct_aggregate(aggregate)
+            session.session.commit()
+        except Exception:
+            session.session.rollback()
+            raise
+
+    async def flush(self):
+        """Write the current aggregate to the database."""
+        async with self._flush_lock:
+            aggregate, self.aggregate = self.aggregate, {}
+            if not aggregate:
+                return
+            start = time.monotonic()
+            try:
+                await self.loop.run_in_executor(self._executor, self._write,
+                                                aggregate)
+            except Exception:
+                logger.exception("Flushing %d volumes failed, keeping them",
+                                 len(aggregate))
+                self._merge(aggregate)
+                return
+            self.last_flush_latency = time.monotonic() - start
+            self.last_flush_size = len(aggregate)
+            logger.info("Flushed %d volumes in %.3fs, buffer size is %d",
+                        self.last_flush_size, self.last_flush_latency,
+                        self.buffer_size)
+
+    async def flush_periodically(self):
+        """Flush the aggregate every ``flush_interval`` seconds."""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def consume(self, reader):
+        """Add the records read line by line from a stream.
+
+        Invalid lines are logged and skipped.
+
+        :param asyncio.StreamReader reader: the stream
+        """
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            line = line.decode('utf-8').strip()
+            if not line:
+                continue
+            try:
+                self.add(parse_pmacct_line(line))
+            except ValueError:
+                logger.warning("Skipping invalid pmacct record %r", line)
+
+    async def handle_connection(self, reader, writer):
+        """Consume the records sent over a connection.
+
+        Can be used as callback of :py:func:`asyncio.start_unix_server`.
+        """
+        try:
+            await self.consume(reader)
+        finally:
+            writer.close()
+
+    def stats(self):
+        """Return the current statistics of the collector.
+
+        :rtype: dict
+        """
+        return {
+            'records_received': self.records_received,
+            'volumes_dropped': self.volumes_dropped,
+            'buffer_size': self.buffer_size,
+            'last_flush_size': self.last_flush_size,
+            'last_flush_latency': self.last_flush_latency,
+        }
@@ -16,9 +16,10 @@ import re
 from base64 import b64encode, b64decode
 
 from datetime import datetime, timedelta
+from itertools import groupby
 
 from sqlalchemy import and_, or_, func, literal, literal_column, union_all, \
-    select
+    select, true
 
 from pycroft import config, property
 from pycroft.helpers import user as user_helper, AttrDict
@@ -26,7 +27,6 @@ from pycroft.helpers.errorcode import Type1Code, Type2Code
 from pycroft.helpers.i18n import deferred_gettext
 from pycroft.helpers.interval import closed, closedopen, single
 from pycroft.helpers.printing import generate_user_sheet as generate_pdf
-from pycroft.lib.finance import user_has_paid
 from pycroft.lib.logging import log_user_event
 from pycroft.lib.membership import make_member_of, remove_member_of
 from pycroft.lib.net import get_free_ip, MacExistsException, \
@@ -38,7 +38,7 @@ from pycroft.model.facilities import Room
 from pycroft.model.finance import Account
 from pycroft.model.host import Host, IP, Host, Interface, Interface
 from pycroft.model.session import with_transaction
-from pycroft.model.traffic import TrafficHistoryEntry
+from pycroft.model.traffic import CurrentTrafficBalance, TrafficHistoryEntry
 from pycroft.model.user import User, UnixAccount
 from pycroft.model.webstorage import WebStorage
 
@@ -481,6 +481,31 @@ def traffic_history(user_id, start, interval, step):
     return [TrafficHistoryEntry(**dict(row.items())) for row in result]
 
 
+def traffic_histories(user_ids, start, interval, step):
+    """Compute the traffic histories of several users at once.
+
+    :param iterable[int] user_ids: The ids of the users
+    :param datetime start: The start of the histories
+    :param timedelta interval: The length of the histories
+    :param timedelta step: The length of a single entry
+    :return: Pairs of a user id and the traffic history entries of that
+        user, ordered by user id
+    :rtype: iterator[(int, list[TrafficHistoryEntry])]
+    """
+    user_ids = list(user_ids)
+    if not user_ids:
+        return
+    result = session.session.execute(
+        select(['*']).select_from(
+            func.traffic_histories(user_ids, start, interval, step)))
+    for user_id, rows in groupby(result, lambda row: row['user_id']):
+        yield user_id, [
+            TrafficHistoryEntry(**{k: v for k, v in row.items()
+                                   if k != 'user_id'})
+            for row in rows
+        ]
+
+
 def has_balance_of_at_least(user, amount):
     """Check whether the given user's balance is at least the given
     amount.
@@ -624,37 +649,58 @@ def move_out(user, comment, processor, when, end_membership=True):
 admin_properties = property.property_categories[u"Nutzerverwaltung"].keys()
 
 
+status_flags = ('member', 'traffic_exceeded', 'network_access',
+                'account_balanced', 'violation', 'ldap', 'admin')
+
+
 def status(user):
     """
     :param user: User whose status we want to look at
     :return: dict of boolean status codes
     """
-    return AttrDict({
-        'member': user.member_of(config.member_group),
-        'traffic_exceeded': user.current_credit < 0,
-        'network_access': user.has_property('network_access'),
-        'account_balanced': user_has_paid(user),
-        'violation': user.has_property('violation'),
-        'ldap': user.has_property('ldap'),
-        'admin': any(user.has_property(prop) for prop in admin_properties),
-    })
+    return statuses([user.id])[user.id]
+
+
+def statuses(user_ids):
+    """Determine the status of several users with a single query.
+
+    :param iterable[int] user_ids: The ids of the users
+    :return: dicts of boolean status codes (see :py:func:`status`) by
+        user id
+    :rtype: dict[int, AttrDict]
+    """
+    rows = status_query().filter(User.id.in_(list(user_ids)))
+    return {row.User.id: AttrDict({flag: getattr(row, flag)
+                                   for flag in status_flags})
+            for row in rows}
 
 
 def status_query():
+    """Build a query yielding users along with their status flags.
+
+    The property flags are read from ``current_property``, which drops
+    the properties of a membership as soon as it ends (see
+    :py:func:`pycroft.model.property.current_property_query`).
+
+    :rtype: Query
+    """
     now = single(session.utcnow())
+    properties = User.property_set_lateral()
+    property_set = properties.c.property_set
     return session.session.query(
         User,
         User.member_of(config.member_group, now).label('member'),
-        # traffic ignored due to pending traffic rework
-        literal_column("false").label('traffic_exceeded'),
+        (func.coalesce(CurrentTrafficBalance.amount, 0) < 0)
+            .label('traffic_exceeded'),
         (Account.balance <= 0).label('account_balanced'),
 
-        # a User.properties hybrid attribute would be preferrable
-        (User.has_property('network_access', now)).label('network_access'),
-        (User.has_property('violation', now)).label('violation'),
-        (User.has_property('ldap', now)).label('ldap'),
-        or_(*(User.has_property(prop, now) for prop in admin_properties)).label('admin')
-    ).join(Account)
+        property_set.contains(['network_access']).label('network_access'),
+        property_set.contains(['violation']).label('violation'),
+        property_set.contains(['ldap']).label('ldap'),
+        property_set.overlap(list(admin_properties)).label('admin')
+    ).join(Account).outerjoin(
+        CurrentTrafficBalance, CurrentTrafficBalance.user_id == User.id
+    ).join(properties, true())
 
 
 def generate_user_sheet(user, plain_password, generation_purpose=''):
@@ -0,0 +1,30 @@
+"""add account_in_default_days
+
+Revision ID: 4abe10d7b18c
+Revises: 757eedac79b3
+Create Date: 2026-10-17 11:34:52.281604
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+import pycroft
+from pycroft.model.ddl import CreateFunction, DropFunction
+from pycroft.model import finance
+
+
+# revision identifiers, used by Alembic.
+revision = '4abe10d7b18c'
+down_revision = '757eedac79b3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute(CreateFunction(finance.account_in_default_days_function,
+                              or_replace=True))
+
+
+def downgrade():
+    op.execute(DropFunction(finance.account_in_default_days_function,
+                            if_exists=True))
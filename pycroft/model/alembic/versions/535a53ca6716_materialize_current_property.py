@@ -0,0 +1,87 @@
+"""materialize current_property
+
+Revision ID: 535a53ca6716
+Revises: 6f1a37baa574
+Create Date: 2026-10-17 09:12:40.118263
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+import pycroft
+from pycroft.model.ddl import CreateFunction, CreateTrigger, CreateView, \
+    DropFunction, DropTrigger, DropView
+from pycroft.model import hades
+from pycroft.model import property as property_model
+
+
+# revision identifiers, used by Alembic.
+revision = '535a53ca6716'
+down_revision = '6f1a37baa574'
+branch_labels = None
+depends_on = None
+
+# The hades views reading current_property
+dependent_views = (hades.radusergroup, hades.dhcphost, hades.alternative_dns)
+
+functions = (
+    property_model.evaluate_properties_function,
+    property_model.evaluate_properties_for_user_function,
+    property_model.evaluate_properties_for_users_function,
+    property_model.refresh_current_property_function,
+    property_model.membership_refresh_function,
+    property_model.property_refresh_function,
+)
+
+triggers = (
+    property_model.membership_refresh_trigger,
+    property_model.property_refresh_trigger,
+)
+
+
+def upgrade():
+    for view in dependent_views:
+        op.execute(DropView(view, if_exists=True))
+    op.execute('DROP VIEW current_property')
+
+    op.create_table(
+        'current_property',
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('property_name', sa.String(length=255), nullable=False),
+        sa.Column('denied', sa.Boolean(), nullable=False),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('user_id', 'property_name'),
+    )
+    op.create_index(op.f('ix_current_property_property_name'),
+                    'current_property', ['property_name'], unique=False)
+
+    for function in functions:
+        op.execute(CreateFunction(function, or_replace=True))
+    for trigger in triggers:
+        op.execute(CreateTrigger(trigger))
+
+    op.execute('SELECT refresh_current_property(NULL)')
+
+    for view in dependent_views:
+        op.execute(CreateView(view, or_replace=True))
+
+
+def downgrade():
+    for view in dependent_views:
+        op.execute(DropView(view, if_exists=True))
+
+    for trigger in triggers:
+        op.execute(DropTrigger(trigger, if_exists=True))
+    # evaluate_properties already existed before
+    for function in reversed(functions[1:]):
+        op.execute(DropFunction(function, if_exists=True))
+
+    op.drop_index(op.f('ix_current_property_property_name'),
+                  table_name='current_property')
+    op.drop_table('current_property')
+    op.execute('CREATE VIEW current_property AS '
+               'SELECT user_id, property_name, denied '
+               'FROM evaluate_properties(current_timestamp)')
+
+    for view in dependent_views:
+        op.execute(CreateView(view, or_replace=True))
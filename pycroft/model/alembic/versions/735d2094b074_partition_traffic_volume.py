@@ -0,0 +1,142 @@
+"""partition traffic_volume by month
+
+Revision ID: 735d2094b074
+Revises: cb22f3fa3a92
+Create Date: 2026-10-17 09:48:22.907135
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+import pycroft
+from pycroft.model.ddl import CreateFunction, CreatePartition, \
+    CreateTrigger, CreateView, DropFunction, DropView, Partition
+from pycroft.model import traffic
+
+
+# revision identifiers, used by Alembic.
+revision = '735d2094b074'
+down_revision = 'cb22f3fa3a92'
+branch_labels = None
+depends_on = None
+
+traffic_direction = postgresql.ENUM('Ingress', 'Egress',
+                                    name='traffic_direction',
+                                    create_type=False)
+
+functions = (
+    traffic.traffic_volume_create_partition_function,
+    traffic.traffic_volume_drop_partitions_function,
+)
+
+columns = ('"timestamp"', 'amount', 'type', 'ip_id', 'user_id', 'packets')
+
+
+def drop_pmacct_views():
+    # The INSTEAD OF triggers are dropped along with the views, their
+    # functions stay in place.
+    op.execute(DropView(traffic.pmacct_traffic_egress, if_exists=True))
+    op.execute(DropView(traffic.pmacct_traffic_ingress, if_exists=True))
+
+
+def create_pmacct_views():
+    op.execute(CreateView(traffic.pmacct_traffic_egress, or_replace=True))
+    op.execute(CreateTrigger(traffic.pmacct_egress_upsert_trigger))
+    op.execute(CreateView(traffic.pmacct_traffic_ingress, or_replace=True))
+    op.execute(CreateTrigger(traffic.pmacct_ingress_upsert_trigger))
+
+
+def create_traffic_volume(**kw):
+    op.create_table(
+        'traffic_volume',
+        sa.Column('timestamp', pycroft.model.types.DateTimeTz(),
+                  server_default=sa.text('CURRENT_TIMESTAMP'),
+                  nullable=False),
+        sa.Column('amount', sa.BigInteger(), nullable=False),
+        sa.Column('type', traffic_direction, nullable=False),
+        sa.Column('ip_id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=True),
+        sa.Column('packets', sa.Integer(), nullable=False),
+        sa.CheckConstraint('amount >= 0'),
+        sa.CheckConstraint('packets >= 0'),
+        sa.ForeignKeyConstraint(['ip_id'], ['ip.id'], ondelete='CASCADE'),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('ip_id', 'type', 'timestamp'),
+        **kw
+    )
+    op.create_index(op.f('ix_traffic_volume_ip_id'), 'traffic_volume',
+                    ['ip_id'], unique=False)
+    op.create_index(op.f('ix_traffic_volume_user_id'), 'traffic_volume',
+                    ['user_id'], unique=False)
+
+
+def move_old_traffic_volume():
+    op.rename_table('traffic_volume', 'traffic_volume_old')
+    # Free the names of the indexes for the new table
+    op.execute('ALTER TABLE traffic_volume_old '
+               'DROP CONSTRAINT traffic_volume_pkey')
+    op.drop_index('ix_traffic_volume_ip_id', table_name='traffic_volume_old')
+    op.drop_index('ix_traffic_volume_user_id',
+                  table_name='traffic_volume_old')
+
+
+def copy_old_traffic_volume():
+    op.execute('INSERT INTO traffic_volume ({columns}) '
+               'SELECT {columns} FROM traffic_volume_old'
+               .format(columns=', '.join(columns)))
+    op.drop_table('traffic_volume_old')
+
+
+def upgrade():
+    drop_pmacct_views()
+    move_old_traffic_volume()
+
+    create_traffic_volume(info={'partition_by': 'RANGE ("timestamp")'})
+    op.execute(CreatePartition(Partition(
+        'traffic_volume_default', traffic.TrafficVolume.__table__)))
+    for function in functions:
+        op.execute(CreateFunction(function, or_replace=True))
+
+    # Create the partitions of the existing months while the table is
+    # still empty, so that the rows don't have to be moved out of the
+    # default partition.
+    op.execute('SELECT traffic_volume_create_partition(month) '
+               'FROM (SELECT DISTINCT date_trunc(\'month\', "timestamp") '
+               '      AS month FROM traffic_volume_old) AS months')
+    # The rows are copied before the triggers exist, since neither the
+    # balances nor the other aggregates change.
+    copy_old_traffic_volume()
+    op.execute(CreateTrigger(traffic.current_traffic_balance_volume_trigger))
+    create_pmacct_views()
+
+    # Only volumes of dropped partitions are folded into this table, so
+    # there is nothing to fill it with yet.
+    op.create_table(
+        'monthly_traffic_volume',
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('type', traffic_direction, nullable=False),
+        sa.Column('month', pycroft.model.types.DateTimeTz(), nullable=False),
+        sa.Column('amount', sa.BigInteger(), nullable=False),
+        sa.Column('packets', sa.BigInteger(), nullable=False),
+        sa.CheckConstraint('amount >= 0'),
+        sa.CheckConstraint('packets >= 0'),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('user_id', 'type', 'month'),
+    )
+
+
+def downgrade():
+    # Volumes already folded into monthly_traffic_volume can't be
+    # restored.
+    op.drop_table('monthly_traffic_volume')
+
+    drop_pmacct_views()
+    move_old_traffic_volume()
+    for function in reversed(functions):
+        op.execute(DropFunction(function, if_exists=True))
+
+    create_traffic_volume()
+    copy_old_traffic_volume()
+    op.execute(CreateTrigger(traffic.current_traffic_balance_volume_trigger))
+    create_pmacct_views()
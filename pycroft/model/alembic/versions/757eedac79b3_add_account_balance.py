@@ -0,0 +1,60 @@
+"""add account_balance
+
+Revision ID: 757eedac79b3
+Revises: 8db860c22e70
+Create Date: 2026-10-17 11:20:37.514902
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+import pycroft
+from pycroft.model.ddl import CreateFunction, CreateTrigger, DropFunction, \
+    DropTrigger
+from pycroft.model import finance
+
+
+# revision identifiers, used by Alembic.
+revision = '757eedac79b3'
+down_revision = '8db860c22e70'
+branch_labels = None
+depends_on = None
+
+functions = (
+    finance.refresh_account_balance_function,
+    finance.account_balance_split_function,
+    finance.account_balance_account_function,
+)
+
+triggers = (
+    finance.account_balance_split_trigger,
+    finance.account_balance_account_trigger,
+)
+
+
+def upgrade():
+    op.create_table(
+        'account_balance',
+        sa.Column('account_id', sa.Integer(), nullable=False),
+        sa.Column('balance', pycroft.model.types.Money(), nullable=False),
+        sa.ForeignKeyConstraint(['account_id'], ['account.id'],
+                                ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('account_id'),
+    )
+
+    for function in functions:
+        op.execute(CreateFunction(function, or_replace=True))
+    for trigger in triggers:
+        op.execute(CreateTrigger(trigger))
+
+    # Every existing account gets its current balance
+    op.execute('SELECT refresh_account_balance(NULL)')
+
+
+def downgrade():
+    for trigger in triggers:
+        op.execute(DropTrigger(trigger, if_exists=True))
+    for function in reversed(functions):
+        op.execute(DropFunction(function, if_exists=True))
+
+    op.drop_table('account_balance')
@@ -0,0 +1,107 @@
+"""exclude overlapping memberships
+
+Revision ID: 8db860c22e70
+Revises: a17b962162b5
+Create Date: 2026-10-17 11:36:52.219487
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+import pycroft
+
+
+# revision identifiers, used by Alembic.
+revision = '8db860c22e70'
+down_revision = 'a17b962162b5'
+branch_labels = None
+depends_on = None
+
+
+def merge_overlapping_memberships():
+    """Merge the overlapping memberships of each user in a group
+
+    Ordered by their beginning, a membership starts a new island of
+    overlapping memberships if no earlier one reaches it.  Every island
+    is merged into its first membership, the others are deleted.
+    """
+    op.execute("""
+    CREATE TEMPORARY TABLE membership_island ON COMMIT DROP AS
+    WITH ordered AS (
+      SELECT id, user_id, group_id, begins_at, ends_at,
+             max(coalesce(ends_at, 'infinity')) OVER (
+               PARTITION BY user_id, group_id
+               ORDER BY coalesce(begins_at, '-infinity'), id
+               ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING
+             ) AS previous_end
+      FROM membership
+    ), numbered AS (
+      SELECT *,
+             sum(CASE WHEN previous_end < coalesce(begins_at, '-infinity')
+                        OR previous_end IS NULL
+                      THEN 1 ELSE 0 END) OVER (
+               PARTITION BY user_id, group_id
+               ORDER BY coalesce(begins_at, '-infinity'), id
+               ROWS UNBOUNDED PRECEDING
+             ) AS island
+      FROM ordered
+    )
+    SELECT min(id) AS id, array_agg(id) AS ids,
+           CASE WHEN bool_or(begins_at IS NULL) THEN NULL
+                ELSE min(begins_at) END AS begins_at,
+           CASE WHEN bool_or(ends_at IS NULL) THEN NULL
+                ELSE max(ends_at) END AS ends_at
+    FROM numbered
+    GROUP BY user_id, group_id, island
+    HAVING count(*) > 1
+    """)
+    op.execute("""
+    DELETE FROM membership USING membership_island
+    WHERE membership.id = ANY(membership_island.ids)
+      AND membership.id <> membership_island.id
+    """)
+    op.execute("""
+    UPDATE membership
+    SET begins_at = membership_island.begins_at,
+        ends_at = membership_island.ends_at
+    FROM membership_island
+    WHERE membership.id = membership_island.id
+    """)
+    op.execute('DROP TABLE membership_island')
+
+
+def repair_inverted_memberships():
+    """End memberships ending before their beginning at their beginning
+
+    This is what :py:meth:`Membership.disable` does for such an end.
+    The ranges of the index and the exclusion constraint could not be
+    built for them otherwise.
+    """
+    op.execute('UPDATE membership SET ends_at = begins_at '
+               'WHERE begins_at > ends_at')
+
+
+def upgrade():
+    repair_inverted_memberships()
+    # The check has been declared on the model all along, but was never
+    # created due to a misspelled ``__table_args__``.
+    op.execute('ALTER TABLE membership ADD CHECK ('
+               'begins_at IS NULL OR ends_at IS NULL OR begins_at <= ends_at)')
+    merge_overlapping_memberships()
+
+    op.execute('CREATE EXTENSION IF NOT EXISTS btree_gist')
+    op.create_index('ix_membership_active_during', 'membership',
+                    [sa.text("tstzrange(begins_at, ends_at, '[]')")],
+                    unique=False, postgresql_using='gist')
+    op.execute("ALTER TABLE membership ADD CONSTRAINT membership_exclusive_excl "
+               "EXCLUDE USING gist (user_id WITH =, group_id WITH =, "
+               "tstzrange(begins_at, ends_at, '[]') WITH &&) "
+               "DEFERRABLE INITIALLY DEFERRED")
+
+
+def downgrade():
+    op.drop_constraint('membership_exclusive_excl', 'membership')
+    op.drop_index('ix_membership_active_during', table_name='membership')
+    op.execute('ALTER TABLE membership DROP CONSTRAINT IF EXISTS '
+               'membership_check')
+    # btree_gist is kept, other objects might use it by now
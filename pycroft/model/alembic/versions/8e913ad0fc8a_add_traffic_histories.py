@@ -0,0 +1,34 @@
+"""add traffic_histories
+
+Revision ID: 8e913ad0fc8a
+Revises: 9954ecb77faf
+Create Date: 2026-10-17 10:40:12.330951
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+import pycroft
+from pycroft.model.ddl import CreateFunction
+from pycroft.model import traffic
+
+
+# revision identifiers, used by Alembic.
+revision = '8e913ad0fc8a'
+down_revision = '9954ecb77faf'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute(CreateFunction(traffic.traffic_histories_function,
+                              or_replace=True))
+    # traffic_history now delegates to traffic_histories
+    op.execute(CreateFunction(traffic.traffic_history_function,
+                              or_replace=True))
+
+
+def downgrade():
+    # The previous definition of traffic_history is not available
+    # anymore, so both functions are kept.
+    pass
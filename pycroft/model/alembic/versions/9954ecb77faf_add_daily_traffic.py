@@ -0,0 +1,64 @@
+"""add daily_traffic
+
+Revision ID: 9954ecb77faf
+Revises: 735d2094b074
+Create Date: 2026-10-17 10:21:37.514902
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+import pycroft
+from pycroft.model.ddl import CreateFunction, CreateTrigger, DropFunction, \
+    DropTrigger
+from pycroft.model import traffic
+
+
+# revision identifiers, used by Alembic.
+revision = '9954ecb77faf'
+down_revision = '735d2094b074'
+branch_labels = None
+depends_on = None
+
+functions = (
+    traffic.daily_traffic_add_function,
+    traffic.daily_traffic_event_function,
+    traffic.refresh_daily_traffic_function,
+)
+
+triggers = (
+    traffic.daily_traffic_volume_trigger,
+    traffic.daily_traffic_credit_trigger,
+)
+
+
+def upgrade():
+    op.create_table(
+        'daily_traffic',
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('day', pycroft.model.types.DateTimeTz(), nullable=False),
+        sa.Column('credit', sa.BigInteger(), server_default='0',
+                  nullable=False),
+        sa.Column('ingress', sa.BigInteger(), server_default='0',
+                  nullable=False),
+        sa.Column('egress', sa.BigInteger(), server_default='0',
+                  nullable=False),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('user_id', 'day'),
+    )
+
+    for function in functions:
+        op.execute(CreateFunction(function, or_replace=True))
+    for trigger in triggers:
+        op.execute(CreateTrigger(trigger))
+
+    op.execute('SELECT refresh_daily_traffic(NULL)')
+
+
+def downgrade():
+    for trigger in triggers:
+        op.execute(DropTrigger(trigger, if_exists=True))
+    for function in reversed(functions):
+        op.execute(DropFunction(function, if_exists=True))
+
+    op.drop_table('daily_traffic')
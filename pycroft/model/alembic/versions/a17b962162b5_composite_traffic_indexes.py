@@ -0,0 +1,49 @@
+"""composite traffic indexes
+
+Revision ID: a17b962162b5
+Revises: df1f0df6e6de
+Create Date: 2026-10-17 11:17:03.845126
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+import pycroft
+
+
+# revision identifiers, used by Alembic.
+revision = 'a17b962162b5'
+down_revision = 'df1f0df6e6de'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.drop_index('ix_traffic_volume_user_id', table_name='traffic_volume')
+    op.create_index('ix_traffic_volume_user_id_timestamp', 'traffic_volume',
+                    ['user_id', 'timestamp'], unique=False)
+    op.create_index('ix_traffic_volume_type_timestamp', 'traffic_volume',
+                    ['type', 'timestamp'], unique=False)
+
+    op.drop_index('ix_traffic_credit_user_id', table_name='traffic_credit')
+    op.create_index('ix_traffic_credit_user_id_timestamp', 'traffic_credit',
+                    ['user_id', 'timestamp'], unique=False)
+
+    op.create_index('ix_daily_traffic_day', 'daily_traffic', ['day'],
+                    unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_daily_traffic_day', table_name='daily_traffic')
+
+    op.drop_index('ix_traffic_credit_user_id_timestamp',
+                  table_name='traffic_credit')
+    op.create_index('ix_traffic_credit_user_id', 'traffic_credit',
+                    ['user_id'], unique=False)
+
+    op.drop_index('ix_traffic_volume_type_timestamp',
+                  table_name='traffic_volume')
+    op.drop_index('ix_traffic_volume_user_id_timestamp',
+                  table_name='traffic_volume')
+    op.create_index('ix_traffic_volume_user_id', 'traffic_volume',
+                    ['user_id'], unique=False)
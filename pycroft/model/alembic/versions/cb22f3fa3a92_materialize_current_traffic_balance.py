@@ -0,0 +1,71 @@
+"""materialize current_traffic_balance
+
+Revision ID: cb22f3fa3a92
+Revises: 535a53ca6716
+Create Date: 2026-10-17 09:31:05.642017
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+import pycroft
+from pycroft.model.ddl import CreateFunction, CreateTrigger, CreateView, \
+    DropFunction, DropTrigger, View
+from pycroft.model import traffic
+
+
+# revision identifiers, used by Alembic.
+revision = 'cb22f3fa3a92'
+down_revision = '535a53ca6716'
+branch_labels = None
+depends_on = None
+
+functions = (
+    traffic.refresh_current_traffic_balance_function,
+    traffic.current_traffic_balance_add_function,
+    traffic.current_traffic_balance_event_function,
+    traffic.current_traffic_balance_checkpoint_function,
+    traffic.current_traffic_balance_user_function,
+)
+
+triggers = (
+    traffic.current_traffic_balance_volume_trigger,
+    traffic.current_traffic_balance_credit_trigger,
+    traffic.current_traffic_balance_checkpoint_trigger,
+    traffic.current_traffic_balance_user_trigger,
+)
+
+
+def upgrade():
+    op.execute('DROP VIEW current_traffic_balance')
+
+    op.create_table(
+        'current_traffic_balance',
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('amount', sa.BigInteger(), nullable=False),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('user_id'),
+    )
+    op.create_index(op.f('ix_current_traffic_balance_amount'),
+                    'current_traffic_balance', ['amount'], unique=False)
+
+    for function in functions:
+        op.execute(CreateFunction(function, or_replace=True))
+    for trigger in triggers:
+        op.execute(CreateTrigger(trigger))
+
+    # Every existing user gets their current balance
+    op.execute('SELECT refresh_current_traffic_balance(NULL)')
+
+
+def downgrade():
+    for trigger in triggers:
+        op.execute(DropTrigger(trigger, if_exists=True))
+    for function in reversed(functions):
+        op.execute(DropFunction(function, if_exists=True))
+
+    op.drop_index(op.f('ix_current_traffic_balance_amount'),
+                  table_name='current_traffic_balance')
+    op.drop_table('current_traffic_balance')
+    op.execute(CreateView(View(name='current_traffic_balance',
+                               query=traffic.traffic_balance_query())))
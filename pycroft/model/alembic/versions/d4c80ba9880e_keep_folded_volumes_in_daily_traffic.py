@@ -0,0 +1,54 @@
+"""keep folded volumes in daily_traffic
+
+Revision ID: d4c80ba9880e
+Revises: f0f3be0f4a31
+Create Date: 2026-10-17 13:41:08.205176
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+import pycroft
+from pycroft.model.ddl import CreateFunction
+from pycroft.model import traffic
+
+
+# revision identifiers, used by Alembic.
+revision = 'd4c80ba9880e'
+down_revision = 'f0f3be0f4a31'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute(CreateFunction(traffic.daily_traffic_event_function,
+                              or_replace=True))
+
+
+def downgrade():
+    op.execute("""
+    CREATE OR REPLACE FUNCTION daily_traffic_event()
+    RETURNS trigger VOLATILE LANGUAGE plpgsql AS $$
+    BEGIN
+      IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        IF TG_ARGV[0] = 'credit' THEN
+          PERFORM daily_traffic_add(OLD.user_id, OLD."timestamp", 'Credit',
+                                    -OLD.amount);
+        ELSE
+          PERFORM daily_traffic_add(OLD.user_id, OLD."timestamp",
+                                    OLD.type::text, -OLD.amount);
+        END IF;
+      END IF;
+      IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        IF TG_ARGV[0] = 'credit' THEN
+          PERFORM daily_traffic_add(NEW.user_id, NEW."timestamp", 'Credit',
+                                    NEW.amount);
+        ELSE
+          PERFORM daily_traffic_add(NEW.user_id, NEW."timestamp",
+                                    NEW.type::text, NEW.amount);
+        END IF;
+      END IF;
+      RETURN NULL;
+    END;
+    $$
+    """)
@@ -0,0 +1,103 @@
+"""add ip_owner
+
+Revision ID: df1f0df6e6de
+Revises: 8e913ad0fc8a
+Create Date: 2026-10-17 10:58:49.072611
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+import pycroft
+from pycroft.model.ddl import CreateFunction, CreateTrigger, DropFunction, \
+    DropTrigger, Function
+from pycroft.model import traffic
+
+
+# revision identifiers, used by Alembic.
+revision = 'df1f0df6e6de'
+down_revision = '8e913ad0fc8a'
+branch_labels = None
+depends_on = None
+
+functions = (
+    traffic.ip_owner_refresh_function,
+    traffic.ip_owner_ip_function,
+    traffic.ip_owner_interface_function,
+    traffic.ip_owner_host_function,
+)
+
+triggers = (
+    traffic.ip_owner_ip_trigger,
+    traffic.ip_owner_interface_trigger,
+    traffic.ip_owner_host_trigger,
+)
+
+
+def previous_pmacct_function(type_, address_column):
+    """The pmacct trigger function resolving the owner by joins"""
+    return Function(
+        name="pmacct_traffic_{}_insert".format(type_.lower()), arguments=[],
+        language="plpgsql", rtype="trigger",
+        definition="""BEGIN
+        INSERT INTO traffic_volume (type, ip_id, "timestamp", amount, packets, user_id)
+        SELECT
+            '{type}',
+            ip.id,
+            date_trunc('day', NEW.stamp_inserted),
+            NEW.bytes,
+            NEW.packets,
+            host.owner_id
+        FROM ip
+        JOIN interface ON ip.interface_id = interface.id
+        JOIN host ON interface.host_id = host.id
+        WHERE NEW.{address_column} = ip.address
+        ON CONFLICT (ip_id, type, "timestamp")
+        DO UPDATE SET (amount, packets) = (traffic_volume.amount + NEW.bytes,
+                                           traffic_volume.packets + NEW.packets);
+    RETURN NULL;
+    END;""".format(type=type_, address_column=address_column),
+    )
+
+
+def upgrade():
+    op.create_table(
+        'ip_owner',
+        sa.Column('address', pycroft.model.types.IPAddress(), nullable=False),
+        sa.Column('ip_id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(['ip_id'], ['ip.id'], ondelete='CASCADE'),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('address'),
+        sa.UniqueConstraint('ip_id'),
+    )
+    op.create_index(op.f('ix_ip_owner_user_id'), 'ip_owner', ['user_id'],
+                    unique=False)
+
+    for function in functions:
+        op.execute(CreateFunction(function, or_replace=True))
+    for trigger in triggers:
+        op.execute(CreateTrigger(trigger))
+
+    op.execute('SELECT ip_owner_refresh(NULL)')
+
+    # Attribute pmacct traffic through the lookup table
+    op.execute(CreateFunction(traffic.pmacct_egress_upsert, or_replace=True))
+    op.execute(CreateFunction(traffic.pmacct_ingress_upsert, or_replace=True))
+    op.execute(CreateFunction(traffic.pmacct_insert_batch, or_replace=True))
+
+
+def downgrade():
+    op.execute(DropFunction(traffic.pmacct_insert_batch, if_exists=True))
+    op.execute(CreateFunction(previous_pmacct_function('Egress', 'ip_src'),
+                              or_replace=True))
+    op.execute(CreateFunction(previous_pmacct_function('Ingress', 'ip_dst'),
+                              or_replace=True))
+
+    for trigger in triggers:
+        op.execute(DropTrigger(trigger, if_exists=True))
+    for function in reversed(functions):
+        op.execute(DropFunction(function, if_exists=True))
+
+    op.drop_index(op.f('ix_ip_owner_user_id'), table_name='ip_owner')
+    op.drop_table('ip_owner')
@@ -0,0 +1,51 @@
+"""end current properties immediately
+
+Revision ID: f0f3be0f4a31
+Revises: 4abe10d7b18c
+Create Date: 2026-10-17 13:05:19.640873
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+import pycroft
+from pycroft.model.ddl import CreateFunction
+from pycroft.model import property as property_model
+
+
+# revision identifiers, used by Alembic.
+revision = 'f0f3be0f4a31'
+down_revision = '4abe10d7b18c'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute(CreateFunction(property_model.refresh_current_property_function,
+                              or_replace=True))
+    # Memberships which ended exactly at the last refresh of their user
+    op.execute('SELECT refresh_current_property(NULL)')
+
+
+def downgrade():
+    op.execute("""
+    CREATE OR REPLACE FUNCTION refresh_current_property(
+        arg_user_ids integer[]
+    ) RETURNS void VOLATILE LANGUAGE plpgsql AS $$
+    BEGIN
+      IF arg_user_ids IS NULL THEN
+        DELETE FROM current_property;
+        INSERT INTO current_property (user_id, property_name, denied)
+        SELECT user_id, property_name, denied
+        FROM evaluate_properties(current_timestamp);
+      ELSE
+        DELETE FROM current_property WHERE user_id = ANY(arg_user_ids);
+        INSERT INTO current_property (user_id, property_name, denied)
+        SELECT user_id, property_name, denied
+        FROM evaluate_properties_for_users(arg_user_ids, current_timestamp)
+        ON CONFLICT (user_id, property_name)
+        DO UPDATE SET denied = EXCLUDED.denied;
+      END IF;
+    END;
+    $$
+    """)
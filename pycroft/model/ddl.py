@@ -461,6 +461,94 @@ def visit_drop_view(element, compiler, **kw):
     )
 
 
+# noinspection PyUnusedLocal
+@compiles(schema.CreateTable, 'postgresql')
+def visit_create_table(element, compiler, **kw):
+    """
+    Compile a CREATE TABLE DDL statement for PostgreSQL
+
+    Tables with a ``partition_by`` entry in their ``info`` dictionary
+    are created as partitioned tables, e.g. ``info={'partition_by':
+    'RANGE ("timestamp")'}``.
+    """
+    create_table = compiler.visit_create_table(element)
+    partition_by = element.element.info.get('partition_by')
+    if partition_by is None:
+        return create_table
+    return "{} PARTITION BY {}\n\n".format(create_table.rstrip(),
+                                             partition_by)
+
+
+class Partition(schema.DDLElement):
+    def __init__(self, name, table, bounds=None):
+        """DDL Element representing a partition of a partitioned table
+
+        :param str name: The name of the partition
+        :param table: The partitioned table
+        :param str bounds: The partition bound specification, like
+            ``FROM ('2018-01-01') TO ('2018-02-01')``.  If ``None``,
+            the partition is the default partition.
+        """
+        self.name = name
+        self.table = table
+        self.bounds = bounds
+
+
+class CreatePartition(schema.DDLElement):
+    """
+    Represents a CREATE TABLE … PARTITION OF DDL statement
+    """
+    on = 'postgresql'
+
+    def __init__(self, partition, if_not_exists=False):
+        self.partition = partition
+        self.if_not_exists = if_not_exists
+
+
+class DropPartition(schema.DDLElement):
+    """
+    Represents a DROP TABLE DDL statement for a partition
+    """
+    on = 'postgresql'
+
+    def __init__(self, partition, if_exists=False, cascade=False):
+        self.partition = partition
+        self.if_exists = if_exists
+        self.cascade = cascade
+
+
+# noinspection PyUnusedLocal
+@compiles(CreatePartition, 'postgresql')
+def visit_create_partition(element, compiler, **kw):
+    """
+    Compile a CREATE TABLE … PARTITION OF DDL statement for PostgreSQL
+    """
+    partition = element.partition
+    opt_if_not_exists = "IF NOT EXISTS" if element.if_not_exists else None
+    partition_name = compiler.preparer.quote(partition.name)
+    table_name = compiler.preparer.format_table(partition.table)
+    if partition.bounds is None:
+        bounds = "DEFAULT"
+    else:
+        bounds = "FOR VALUES " + partition.bounds
+    return _join_tokens(
+        "CREATE TABLE", opt_if_not_exists, partition_name, "PARTITION OF",
+        table_name, bounds)
+
+
+# noinspection PyUnusedLocal
+@compiles(DropPartition, 'postgresql')
+def visit_drop_partition(element, compiler, **kw):
+    """
+    Compile a DROP TABLE DDL statement for a partition for PostgreSQL
+    """
+    opt_if_exists = "IF EXISTS" if element.if_exists else None
+    opt_drop_behavior = "CASCADE" if element.cascade else None
+    partition_name = compiler.preparer.quote(element.partition.name)
+    return _join_tokens("DROP TABLE", opt_if_exists, partition_name,
+                        opt_drop_behavior)
+
+
 class DDLManager(object):
     """
     Ensures that create DDL statements are registered with SQLAlchemy in the
@@ -500,6 +588,10 @@ class DDLManager(object):
         self.add(table, CreateView(view, or_replace=True),
                  DropView(view, if_exists=True), dialect=dialect)
 
+    def add_partition(self, table, partition, dialect=None):
+        self.add(table, CreatePartition(partition, if_not_exists=True),
+                 DropPartition(partition, if_exists=True), dialect=dialect)
+
     def register(self):
         for target, create_ddl, drop_ddl in self.objects:
             sqla_event.listen(target, 'after_create', create_ddl)
@@ -2,14 +2,15 @@
 # Copyright (c) 2016 The Pycroft Authors. See the AUTHORS file.
 # This file is part of the Pycroft project and licensed under the terms of
 # the Apache License, Version 2.0. See the LICENSE file for details.
-import datetime
 import operator
+from datetime import date
 
-from math import fabs
-
-from sqlalchemy import Column, ForeignKey, event, func, select
+from sqlalchemy import (
+    Column, ForeignKey, and_, case, event, func, literal_column, select)
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.ext.hybrid import hybrid_property
-from sqlalchemy.orm import relationship, backref, object_session
+from sqlalchemy.orm import Query, relationship, backref, object_session
+from sqlalchemy.orm.util import has_identity
 from sqlalchemy.schema import (
     CheckConstraint, ForeignKeyConstraint, UniqueConstraint)
 from sqlalchemy.types import (
@@ -19,7 +20,7 @@ from pycroft.helpers.i18n import gettext
 from pycroft.helpers.interval import closed
 from pycroft.model import ddl
 from pycroft.model.types import Money, DateTimeTz
-from .base import IntegerIdModel
+from .base import IntegerIdModel, ModelBase
 
 
 manager = ddl.DDLManager()
@@ -102,38 +103,61 @@ class Account(IntegerIdModel):
 
     @hybrid_property
     def balance(self):
-        return sum(s.amount for s in self.splits)
+        """The sum of the amounts of all splits of the account
+
+        Persistent accounts read it from the trigger-maintained
+        :py:class:`AccountBalance`.
+        """
+        session = object_session(self)
+        if session is None or not has_identity(self):
+            return sum(s.amount for s in self.splits)
+        # The query flushes pending splits first
+        return session.query(AccountBalance.balance).filter(
+            AccountBalance.account_id == self.id).scalar()
 
     @balance.expression
     def balance(cls):
         return select(
-            [func.coalesce(func.sum(Split.amount), 0)]
+            [AccountBalance.balance]
         ).where(
-            Split.account_id == cls.id
+            AccountBalance.account_id == cls.id
         ).label("balance")
 
     @hybrid_property
     def in_default_days(self):
-        first_overdue = False
-        split_sum = 0
-
-        splits = Split.q.filter(Split.account_id == self.id) \
-                        .join(Transaction) \
-                        .order_by(Transaction.valid_on)
-
-        for split in splits:
-            split_sum += split.amount
-
-            if split_sum > 0:
-                if not first_overdue:
-                    first_overdue = split.transaction.valid_on
-            else:
-                first_overdue = False
+        """The number of days since the balance turned positive
 
-        if not first_overdue:
-            return 0
+        The balance is accumulated over the splits ordered by the
+        ``valid_on`` date of their transactions.  If the current balance
+        is not positive, the account is not in default at all.
 
-        return fabs((first_overdue - datetime.date.today()).days)
+        See :py:func:`in_default_days_query` for computing the value of
+        many accounts at once.
+        """
+        session = object_session(self)
+        if session is None or not has_identity(self):
+            # Pending transactions are valid today by default.  Like in
+            # in_default_days_query, splits of a day are ordered by id,
+            # pending ones last in the order they were added.
+            today = date.today()
+            splits = sorted(self.splits, key=lambda s: (
+                s.transaction.valid_on or today, s.id is None, s.id or 0))
+            balance = 0
+            first_overdue = None
+            for split in splits:
+                balance += split.amount
+                if balance <= 0:
+                    first_overdue = None
+                elif first_overdue is None:
+                    first_overdue = split.transaction.valid_on or today
+            if first_overdue is None:
+                return 0
+            return abs((today - first_overdue).days)
+        return session.query(func.account_in_default_days(self.id)).scalar()
+
+    @in_default_days.expression
+    def in_default_days(cls):
+        return func.account_in_default_days(cls.id).label('in_default_days')
 
 
 manager.add_function(
@@ -229,6 +253,170 @@ manager.add_constraint_trigger(
 )
 
 
+def _compile_literally(stmt):
+    return str(stmt.compile(dialect=postgresql.dialect(),
+                            compile_kwargs={'literal_binds': True}))
+
+
+def account_balance_query(*criteria):
+    """Build a query computing the balance of accounts from their splits.
+
+    :param criteria: criteria the accounts have to fulfill
+    """
+    return (
+        Query([
+            Account.id.label('account_id'),
+            func.coalesce(func.sum(Split.amount), 0).label('balance'),
+        ])
+        .select_from(Account)
+        .outerjoin(Split)
+        .filter(*criteria)
+        .group_by(Account.id)
+        .statement
+    )
+
+
+def in_default_days_query(*criteria):
+    """Build a query computing the days accounts have been in default.
+
+    An account is in default since the ``valid_on`` date of the first
+    split after which the running balance stayed positive.  Accounts
+    without splits are omitted.
+
+    :param criteria: criteria the splits have to fulfill, e.g. on
+        ``Split.account_id``
+    :return: a select yielding ``account_id`` and ``in_default_days``
+    """
+    window = dict(partition_by=Split.account_id,
+                  order_by=(Transaction.valid_on, Split.id))
+    balances = select([
+        Split.account_id.label('account_id'),
+        Transaction.valid_on.label('valid_on'),
+        func.sum(Split.amount).over(**window).label('balance'),
+        func.row_number().over(**window).label('n'),
+    ]).select_from(
+        Split.__table__.join(Transaction.__table__)
+    ).where(and_(True, *criteria)).alias('balances')
+    # The number of the last split after which the balance was settled
+    settled = select([
+        balances.c.account_id, balances.c.valid_on, balances.c.n,
+        func.max(
+            case([(balances.c.balance <= 0, balances.c.n)], else_=0)
+        ).over(partition_by=balances.c.account_id).label('last_settled'),
+    ]).alias('settled')
+    first_overdue = func.min(settled.c.valid_on).filter(
+        settled.c.n > settled.c.last_settled)
+    return select([
+        settled.c.account_id,
+        func.coalesce(func.abs(func.current_date() - first_overdue), 0)
+        .label('in_default_days'),
+    ]).group_by(settled.c.account_id)
+
+
+class AccountBalance(ModelBase):
+    """The current balance of every account
+
+    The row of an account is created on insertion of the account.
+    Splits add their amount to it as they are inserted, updated or
+    deleted, so that the balance never has to be summed up from all
+    splits of an account.
+    """
+    account_id = Column(Integer, ForeignKey(Account.id, ondelete='CASCADE'),
+                        primary_key=True)
+    balance = Column(Money, nullable=False)
+
+
+account_balance = AccountBalance.__table__
+account_balance.add_is_dependent_on(Split.__table__)
+
+refresh_account_balance_function = ddl.Function(
+    'refresh_account_balance', ['arg_account_ids integer[]'], 'void',
+    """
+    BEGIN
+      IF arg_account_ids IS NULL THEN
+        DELETE FROM account_balance;
+        INSERT INTO account_balance (account_id, balance)
+        {all_accounts};
+      ELSE
+        DELETE FROM account_balance
+        WHERE account_id = ANY(arg_account_ids);
+        INSERT INTO account_balance (account_id, balance)
+        {some_accounts};
+      END IF;
+    END;
+    """.format(
+        all_accounts=_compile_literally(account_balance_query()),
+        some_accounts=_compile_literally(account_balance_query(
+            Account.id == func.any(literal_column('arg_account_ids')))),
+    ),
+    volatility='volatile', language='plpgsql',
+)
+
+manager.add_function(account_balance, refresh_account_balance_function)
+
+account_balance_split_function = ddl.Function(
+    'account_balance_split_event', [], 'trigger',
+    """
+    BEGIN
+      IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE account_balance SET balance = balance - OLD.amount
+        WHERE account_id = OLD.account_id;
+      END IF;
+      IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        UPDATE account_balance SET balance = balance + NEW.amount
+        WHERE account_id = NEW.account_id;
+      END IF;
+      RETURN NULL;
+    END;
+    """,
+    volatility='volatile', language='plpgsql',
+)
+
+manager.add_function(account_balance, account_balance_split_function)
+
+account_balance_split_trigger = ddl.Trigger(
+    'account_balance_split_trigger', Split.__table__,
+    ('INSERT', 'UPDATE OF amount, account_id', 'DELETE'),
+    'account_balance_split_event()',
+)
+
+manager.add_trigger(account_balance, account_balance_split_trigger)
+
+account_balance_account_function = ddl.Function(
+    'account_balance_account_insert', [], 'trigger',
+    """
+    BEGIN
+      INSERT INTO account_balance (account_id, balance)
+      VALUES (NEW.id, 0);
+      RETURN NULL;
+    END;
+    """,
+    volatility='volatile', language='plpgsql',
+)
+
+manager.add_function(account_balance, account_balance_account_function)
+
+account_balance_account_trigger = ddl.Trigger(
+    'account_balance_account_insert_trigger', Account.__table__,
+    ('INSERT',), 'account_balance_account_insert()',
+)
+
+manager.add_trigger(account_balance, account_balance_account_trigger)
+
+
+account_in_default_days_function = ddl.Function(
+    'account_in_default_days', ['arg_account_id integer'], 'integer',
+    "SELECT COALESCE(({}), 0)".format(_compile_literally(select([
+        in_default_days_query(
+            Split.account_id == literal_column('arg_account_id')
+        ).alias('in_default').c.in_default_days
+    ]))),
+    volatility='stable', strict=True,
+)
+
+manager.add_function(Split.__table__, account_in_default_days_function)
+
+
 class IllegalTransactionError(Exception):
     """Indicates an attempt to persist an illegal Transaction."""
     pass
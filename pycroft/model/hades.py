@@ -15,10 +15,10 @@ hades_view_ddl = DDLManager()
 
 network_access_subq = (
     # Select `user_id, 1` for all people with network_access
-    Query([current_property.table.c.user_id.label('user_id'),
+    Query([current_property.c.user_id.label('user_id'),
            literal(1).label('network_access')])
-    .filter(and_(current_property.table.c.property_name == 'network_access',
-                 ~current_property.table.c.denied))
+    .filter(and_(current_property.c.property_name == 'network_access',
+                 ~current_property.c.denied))
     .subquery('users_with_network_access')
 )
 
@@ -40,6 +40,7 @@ radius_property.add_is_dependent_on(Host.__table__)
 radius_property.add_is_dependent_on(VLAN.__table__)
 radius_property.add_is_dependent_on(Subnet.__table__)
 radius_property.add_is_dependent_on(User.__table__)
+radius_property.add_is_dependent_on(current_property)
 
 radusergroup = View(
     name='radusergroup',
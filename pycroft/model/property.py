@@ -12,56 +12,67 @@ This module contains model descriptions concerning properties, groups, and membe
 from sqlalchemy.dialects import postgresql
 
 from pycroft.model import ddl
-from sqlalchemy import null, and_, or_, func, Column, Integer, String, union, \
-    literal, literal_column, select
+from sqlalchemy import and_, or_, func, Column, Integer, String, union, \
+    literal, literal_column, Boolean, ForeignKey
 from sqlalchemy.orm import Query
 
 from .base import ModelBase
-from .ddl import View, DDLManager
+from .ddl import DDLManager
 from .user import User, Property, Membership, PropertyGroup
 
 manager = DDLManager()
 
-property_query_stmt = union(
-    Query([User.id.label('user_id'), Property.name.label('property_name'),
-           literal(False).label('denied')])
-    .select_from(Membership)
-    .join(PropertyGroup)
-    .join(User)
-    .filter(and_(
-        or_(Membership.begins_at == null(), Membership.begins_at <= literal_column('evaluation_time')),
-        or_(Membership.ends_at == null(), literal_column('evaluation_time') <= Membership.ends_at),
-    ))
-    .join(Property)
-    .group_by(User.id, Property.name)
-    .having(func.every(Property.granted))
-    .statement,
-
-    Query([User.id.label('user_id'), Property.name.label('property_name'),
-           literal(True).label('denied')])
-    .select_from(Membership)
-    .join(PropertyGroup)
-    .join(User)
-    .filter(and_(
-        or_(Membership.begins_at == null(), Membership.begins_at <= literal_column('evaluation_time')),
-        or_(Membership.ends_at == null(), literal_column('evaluation_time') <= Membership.ends_at),
-    ))
-    .join(Property)
-    .group_by(User.id, Property.name)
-    # granted by ≥1 membership, but also denied by ≥1 membership
-    .having(and_(func.bool_or(Property.granted), ~func.every(Property.granted)))
-    .statement,
-)
+
+def property_query(evaluation_time, *criteria):
+    """Build the statement evaluating the properties of users at a given time
+
+    A property is granted to a user if at least one of the memberships
+    active at ``evaluation_time`` grants it and none denies it.  If it
+    is granted and denied at the same time, it is returned with
+    ``denied=True``.
+
+    :param evaluation_time: SQL expression for the point in time
+    :param criteria: Additional filter criteria restricting the
+        considered memberships, e.g. to a set of users.
+    """
+    def evaluation_query(denied):
+        return (
+            Query([User.id.label('user_id'), Property.name.label('property_name'),
+                   literal(denied).label('denied')])
+            .select_from(Membership)
+            .join(PropertyGroup)
+            .join(User)
+            .filter(and_(
+                Membership.active_during.contains(evaluation_time),
+                *criteria
+            ))
+            .join(Property)
+            .group_by(User.id, Property.name)
+        )
+
+    return union(
+        evaluation_query(denied=False)
+        .having(func.every(Property.granted))
+        .statement,
+
+        evaluation_query(denied=True)
+        # granted by ≥1 membership, but also denied by ≥1 membership
+        .having(and_(func.bool_or(Property.granted), ~func.every(Property.granted)))
+        .statement,
+    )
+
+
+def _compile_literally(stmt):
+    return str(stmt.compile(dialect=postgresql.dialect(),
+                            compile_kwargs={'literal_binds': True}))
+
+
+property_query_stmt = property_query(literal_column('evaluation_time'))
 
 evaluate_properties_function = ddl.Function(
     'evaluate_properties', ['evaluation_time timestamp with time zone'],
     'TABLE (user_id INT, property_name VARCHAR(255), denied BOOLEAN)',
-    str(
-        property_query_stmt.compile(
-            dialect=postgresql.dialect(),
-            compile_kwargs={'literal_binds': True}
-        )
-    ),
+    _compile_literally(property_query_stmt),
     volatility='stable',
 )
 
@@ -70,24 +81,163 @@ manager.add_function(
     evaluate_properties_function
 )
 
-current_property = View(
-    name='current_property',
-    #metadata=ModelBase.metadata,
-    query=(
-        select([literal_column('user_id'), literal_column('property_name'),
-                literal_column('denied')])
-        .select_from(func.evaluate_properties(func.current_timestamp()))
+
+def current_property_query(*criteria):
+    """Build the statement evaluating the current properties of users
+
+    This is :py:func:`property_query` at ``current_timestamp``, except
+    that memberships ending exactly at that time are not considered.
+    Terminating a membership with ``closedopen(now, None)`` stores
+    ``ends_at = now``, and its properties have to be revoked right away.
+
+    :param criteria: Additional filter criteria restricting the
+        considered memberships, e.g. to a set of users.
+    """
+    now = func.current_timestamp()
+    return property_query(
+        now, or_(Membership.ends_at.is_(None), Membership.ends_at > now),
+        *criteria
+    )
+
+
+class CurrentProperty(ModelBase):
+    """The properties of every user at the current point in time
+
+    This is a materialization of :py:func:`current_property_query`.
+    The rows of a user are recomputed by triggers whenever one of their
+    memberships or a property of one of their groups changes.
+
+    Note that the mere passing of time (i.e. a membership beginning or
+    ending) does not fire any trigger.  Such users have to be refreshed
+    with :py:func:`pycroft.lib.membership.refresh_current_properties`.
+    """
+    user_id = Column(Integer, ForeignKey(User.id, ondelete='CASCADE'),
+                     primary_key=True)
+    property_name = Column(String(255), primary_key=True, index=True)
+    denied = Column(Boolean, nullable=False)
+
+
+current_property = CurrentProperty.__table__
+current_property.add_is_dependent_on(Membership.__table__)
+current_property.add_is_dependent_on(Property.__table__)
+
+
+evaluate_properties_for_user_function = ddl.Function(
+    'evaluate_properties_for_user',
+    ['arg_user_id integer', 'evaluation_time timestamp with time zone'],
+    'TABLE (user_id INT, property_name VARCHAR(255), denied BOOLEAN)',
+    _compile_literally(property_query(
+        literal_column('evaluation_time'),
+        Membership.user_id == literal_column('arg_user_id'),
+    )),
+    volatility='stable',
+)
+
+manager.add_function(
+    current_property,
+    evaluate_properties_for_user_function
+)
+
+evaluate_properties_for_users_function = ddl.Function(
+    'evaluate_properties_for_users',
+    ['arg_user_ids integer[]', 'evaluation_time timestamp with time zone'],
+    'TABLE (user_id INT, property_name VARCHAR(255), denied BOOLEAN)',
+    _compile_literally(property_query(
+        literal_column('evaluation_time'),
+        Membership.user_id == func.any(literal_column('arg_user_ids')),
+    )),
+    volatility='stable',
+)
+
+manager.add_function(
+    current_property,
+    evaluate_properties_for_users_function
+)
+
+
+refresh_current_property_function = ddl.Function(
+    'refresh_current_property', ['arg_user_ids integer[]'], 'void',
+    """
+    BEGIN
+      IF arg_user_ids IS NULL THEN
+        DELETE FROM current_property;
+        INSERT INTO current_property (user_id, property_name, denied)
+        {all_users};
+      ELSE
+        DELETE FROM current_property WHERE user_id = ANY(arg_user_ids);
+        INSERT INTO current_property (user_id, property_name, denied)
+        {some_users}
+        ON CONFLICT (user_id, property_name)
+        DO UPDATE SET denied = EXCLUDED.denied;
+      END IF;
+    END;
+    """.format(
+        all_users=_compile_literally(current_property_query()),
+        some_users=_compile_literally(current_property_query(
+            Membership.user_id == func.any(literal_column('arg_user_ids')))),
     ),
+    volatility='volatile', language='plpgsql',
 )
-manager.add_view(Membership.__table__, current_property)
 
+manager.add_function(current_property, refresh_current_property_function)
 
-class CurrentProperty(ModelBase):
-    __table__ = current_property.table
-    __mapper_args__ = {
-        'primary_key': (current_property.table.c.user_id,
-                        current_property.table.c.property_name),
-    }
+membership_refresh_function = ddl.Function(
+    'current_property_membership_refresh', [], 'trigger',
+    """
+    BEGIN
+      IF TG_OP = 'INSERT' THEN
+        PERFORM refresh_current_property(ARRAY[NEW.user_id]);
+      ELSIF TG_OP = 'DELETE' THEN
+        PERFORM refresh_current_property(ARRAY[OLD.user_id]);
+      ELSE
+        PERFORM refresh_current_property(ARRAY[OLD.user_id, NEW.user_id]);
+      END IF;
+      RETURN NULL;
+    END;
+    """,
+    volatility='volatile', language='plpgsql',
+)
+
+membership_refresh_trigger = ddl.Trigger(
+    'current_property_membership_refresh_trigger', Membership.__table__,
+    ('INSERT', 'UPDATE', 'DELETE'),
+    'current_property_membership_refresh()',
+)
+
+manager.add_function(current_property, membership_refresh_function)
+manager.add_trigger(current_property, membership_refresh_trigger)
+
+property_refresh_function = ddl.Function(
+    'current_property_property_refresh', [], 'trigger',
+    """
+    DECLARE
+      v_group_ids integer[];
+    BEGIN
+      IF TG_OP = 'INSERT' THEN
+        v_group_ids := ARRAY[NEW.property_group_id];
+      ELSIF TG_OP = 'DELETE' THEN
+        v_group_ids := ARRAY[OLD.property_group_id];
+      ELSE
+        v_group_ids := ARRAY[OLD.property_group_id, NEW.property_group_id];
+      END IF;
+      PERFORM refresh_current_property(ARRAY(
+          SELECT DISTINCT user_id FROM membership
+          WHERE group_id = ANY(v_group_ids)
+      ));
+      RETURN NULL;
+    END;
+    """,
+    volatility='volatile', language='plpgsql',
+)
+
+property_refresh_trigger = ddl.Trigger(
+    'current_property_property_refresh_trigger', Property.__table__,
+    ('INSERT', 'UPDATE', 'DELETE'),
+    'current_property_property_refresh()',
+)
+
+manager.add_function(current_property, property_refresh_function)
+manager.add_trigger(current_property, property_refresh_trigger)
 
 
 manager.register()
@@ -11,10 +11,13 @@
     :copyright: (c) 2011 by AG DSN.
 """
 
+from contextlib import contextmanager
+
 from werkzeug.local import LocalProxy
 import wrapt
 
-from sqlalchemy import func
+from sqlalchemy import event, func
+from sqlalchemy.orm import Session as _Session
 
 
 class NullScopedSession(object):
@@ -51,4 +54,48 @@ def with_transaction(wrapped, instance, args, kwargs):
 
 
 def utcnow():
-    return session.query(func.current_timestamp()).scalar()
+    """Return the current transaction timestamp of the database.
+
+    As ``current_timestamp`` does not change within a transaction, it is
+    only fetched once per transaction and cached in the session's
+    ``info`` until the transaction ends.  Within
+    :py:func:`override_utcnow`, the given time is returned instead.
+
+    :rtype: datetime
+    """
+    info = session.info
+    if 'utcnow_override' in info:
+        return info['utcnow_override']
+    if 'utcnow' not in info:
+        info['utcnow'] = session.query(func.current_timestamp()).scalar()
+    return info['utcnow']
+
+
+@event.listens_for(_Session, 'after_transaction_end')
+def _forget_utcnow(session_, transaction):
+    # Savepoints and subtransactions share the timestamp of the
+    # database transaction
+    if transaction.parent is None:
+        session_.info.pop('utcnow', None)
+
+
+@contextmanager
+def override_utcnow(when):
+    """Let :py:func:`utcnow` return a fixed point in time.
+
+    This is meant for tests and batch jobs which should act as of a
+    certain point in time, even across several transactions.  SQL
+    expressions using ``current_timestamp`` are not affected.
+
+    :param datetime when: the time :py:func:`utcnow` should return
+    """
+    info = session.info
+    previous = info.get('utcnow_override')
+    info['utcnow_override'] = when
+    try:
+        yield when
+    finally:
+        if previous is None:
+            info.pop('utcnow_override', None)
+        else:
+            info['utcnow_override'] = previous
@@ -2,23 +2,28 @@
 # Copyright (c) 2015 The Pycroft Authors. See the AUTHORS file.
 # This file is part of the Pycroft project and licensed under the terms of
 # the Apache License, Version 2.0. See the LICENSE file for details.
-from sqlalchemy import Column, ForeignKey, CheckConstraint, \
-    PrimaryKeyConstraint, func, or_, and_, true, literal, literal_column, \
-    union_all, select, cast, TIMESTAMP, TEXT
+from sqlalchemy import Column, ForeignKey, CheckConstraint, Index, \
+    PrimaryKeyConstraint, func, or_, and_, not_, true, literal, \
+    literal_column, union_all, select, cast, Numeric, TIMESTAMP, TEXT
 from sqlalchemy.dialects import postgresql
 from sqlalchemy.sql.expression import case
 from sqlalchemy.orm import relationship, backref, Query
 from sqlalchemy.types import BigInteger, Enum, Integer
 
 from pycroft.model.base import ModelBase, IntegerIdModel
-from pycroft.model.ddl import DDLManager, Function, Trigger, View
-from pycroft.model.types import DateTimeTz
+from pycroft.model.ddl import DDLManager, Function, Partition, Trigger, View
+from pycroft.model.types import DateTimeTz, IPAddress
 from pycroft.model.user import User
 from pycroft.model.host import IP, Host, Interface
 
 ddl = DDLManager()
 
 
+def _compile_literally(stmt):
+    return str(stmt.compile(dialect=postgresql.dialect(),
+                            compile_kwargs={'literal_binds': True}))
+
+
 class TrafficBalance(ModelBase):
     user_id = Column(Integer, ForeignKey(User.id, ondelete="CASCADE"),
                      primary_key=True)
@@ -35,8 +40,17 @@ class TrafficEvent(object):
 
 
 class TrafficVolume(TrafficEvent, ModelBase):
+    """Traffic of an IP in one direction on a day
+
+    The table is partitioned by month.  Partitions are created by
+    ``traffic_volume_create_partition``; volumes of months without a
+    partition end up in ``traffic_volume_default``.
+    """
     __table_args__ = (
         PrimaryKeyConstraint('ip_id', 'type', 'timestamp'),
+        Index('ix_traffic_volume_user_id_timestamp', 'user_id', 'timestamp'),
+        Index('ix_traffic_volume_type_timestamp', 'type', 'timestamp'),
+        {'info': {'partition_by': 'RANGE ("timestamp")'}},
     )
     type = Column(Enum("Ingress", "Egress", name="traffic_direction"),
                   nullable=False)
@@ -45,7 +59,7 @@ class TrafficVolume(TrafficEvent, ModelBase):
     ip = relationship(IP, backref=backref("traffic_volumes",
                                           cascade="all, delete-orphan"))
     user_id = Column(Integer, ForeignKey(User.id, ondelete='CASCADE'),
-                     nullable=True, index=True)
+                     nullable=True)
     user = relationship(User,
                         backref=backref("traffic_volumes",
                                         cascade="all, delete-orphan"),
@@ -55,6 +69,189 @@ class TrafficVolume(TrafficEvent, ModelBase):
 TrafficVolume.__table__.add_is_dependent_on(IP.__table__)
 TrafficBalance.__table__.add_is_dependent_on(TrafficVolume.__table__)
 
+ddl.add_partition(TrafficVolume.__table__, Partition(
+    'traffic_volume_default', TrafficVolume.__table__))
+
+traffic_volume_create_partition_function = Function(
+    'traffic_volume_create_partition', ['arg_month timestamptz'], 'void',
+    """
+    DECLARE
+      v_begin timestamptz := date_trunc('month', arg_month);
+      v_end timestamptz := v_begin + interval '1 month';
+      v_name text := 'traffic_volume_' || to_char(v_begin, 'YYYY_MM');
+    BEGIN
+      IF to_regclass(v_name) IS NOT NULL THEN
+        RETURN;
+      END IF;
+      -- A partition cannot be created while the default partition
+      -- contains rows belonging to it.  These rows are moved out of the
+      -- way and reinserted afterwards, both through traffic_volume, so
+      -- that its row triggers see the changes cancel each other out.
+      CREATE TEMPORARY TABLE traffic_volume_moved
+        (LIKE traffic_volume INCLUDING DEFAULTS);
+      WITH moved AS (
+        DELETE FROM traffic_volume
+        WHERE "timestamp" >= v_begin AND "timestamp" < v_end
+        RETURNING *
+      )
+      INSERT INTO traffic_volume_moved SELECT * FROM moved;
+      EXECUTE format('CREATE TABLE %%I PARTITION OF traffic_volume '
+                     'FOR VALUES FROM (%%L) TO (%%L)', v_name, v_begin, v_end);
+      INSERT INTO traffic_volume SELECT * FROM traffic_volume_moved;
+      DROP TABLE traffic_volume_moved;
+    END;
+    """,
+    volatility='volatile', language='plpgsql',
+)
+ddl.add_function(TrafficVolume.__table__,
+                 traffic_volume_create_partition_function)
+
+traffic_volume_drop_partitions_function = Function(
+    'traffic_volume_drop_partitions', ['arg_before timestamptz'], 'integer',
+    """
+    DECLARE
+      v_partition record;
+      v_count integer := 0;
+    BEGIN
+      FOR v_partition IN
+        SELECT child.relname
+        FROM pg_inherits
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE pg_inherits.inhparent = 'traffic_volume'::regclass
+          AND child.relname ~ '^traffic_volume_[0-9]{4}_[0-9]{2}$'
+          AND to_timestamp(substring(child.relname from '[0-9]{4}_[0-9]{2}$'),
+                           'YYYY_MM') + interval '1 month' <= arg_before
+      LOOP
+        EXECUTE format('DROP TABLE %%I', v_partition.relname);
+        v_count := v_count + 1;
+      END LOOP;
+      RETURN v_count;
+    END;
+    """,
+    volatility='volatile', language='plpgsql',
+)
+ddl.add_function(TrafficVolume.__table__,
+                 traffic_volume_drop_partitions_function)
+
+
+class MonthlyTrafficVolume(ModelBase):
+    """Traffic of a user in one direction in a month
+
+    Volumes older than the retention period are folded into this table
+    by :py:func:`pycroft.lib.traffic.fold_traffic_volumes` before their
+    partitions are dropped.
+    """
+    __table_args__ = (
+        PrimaryKeyConstraint('user_id', 'type', 'month'),
+    )
+    user_id = Column(Integer, ForeignKey(User.id, ondelete='CASCADE'),
+                     nullable=False)
+    user = relationship(User,
+                        backref=backref("monthly_traffic_volumes",
+                                        cascade="all, delete-orphan"))
+    type = Column(Enum("Ingress", "Egress", name="traffic_direction"),
+                  nullable=False)
+    month = Column(DateTimeTz, nullable=False)
+    amount = Column(BigInteger, CheckConstraint('amount >= 0'),
+                    nullable=False)
+    packets = Column(BigInteger, CheckConstraint('packets >= 0'),
+                     nullable=False)
+
+
+class IPOwner(ModelBase):
+    """The user traffic of an IP address is attributed to
+
+    Flattens the ip → interface → host → owner chain into a single
+    row per address, so that attributing traffic only needs one index
+    lookup.  The rows are maintained by triggers on ``ip``,
+    ``interface`` and ``host``.
+    """
+    address = Column(IPAddress, primary_key=True)
+    ip_id = Column(Integer, ForeignKey(IP.id, ondelete='CASCADE'),
+                   nullable=False, unique=True)
+    user_id = Column(Integer, ForeignKey(User.id, ondelete='CASCADE'),
+                     nullable=True, index=True)
+
+
+ip_owner = IPOwner.__table__
+ip_owner.add_is_dependent_on(Host.__table__)
+ip_owner.add_is_dependent_on(Interface.__table__)
+ip_owner.add_is_dependent_on(TrafficVolume.__table__)
+
+ip_owner_refresh_function = Function(
+    'ip_owner_refresh', ['arg_ip_ids integer[]'], 'void',
+    """
+    DELETE FROM ip_owner
+    WHERE arg_ip_ids IS NULL OR ip_id = ANY(arg_ip_ids);
+
+    INSERT INTO ip_owner (address, ip_id, user_id)
+    SELECT ip.address, ip.id, host.owner_id
+    FROM ip
+    JOIN interface ON ip.interface_id = interface.id
+    JOIN host ON interface.host_id = host.id
+    WHERE arg_ip_ids IS NULL OR ip.id = ANY(arg_ip_ids);
+    """,
+    volatility='volatile',
+)
+ddl.add_function(ip_owner, ip_owner_refresh_function)
+
+ip_owner_ip_function = Function(
+    'ip_owner_ip_event', [], 'trigger',
+    """
+    BEGIN
+      PERFORM ip_owner_refresh(ARRAY[NEW.id]);
+      RETURN NULL;
+    END;
+    """,
+    volatility='volatile', language='plpgsql',
+)
+ip_owner_ip_trigger = Trigger(
+    'ip_owner_ip_trigger', IP.__table__,
+    ('INSERT', 'UPDATE OF address, interface_id'), "ip_owner_ip_event()",
+)
+ddl.add_function(ip_owner, ip_owner_ip_function)
+ddl.add_trigger(ip_owner, ip_owner_ip_trigger)
+
+ip_owner_interface_function = Function(
+    'ip_owner_interface_event', [], 'trigger',
+    """
+    BEGIN
+      UPDATE ip_owner SET user_id = host.owner_id
+      FROM ip, host
+      WHERE ip.id = ip_owner.ip_id AND ip.interface_id = NEW.id
+        AND host.id = NEW.host_id;
+      RETURN NULL;
+    END;
+    """,
+    volatility='volatile', language='plpgsql',
+)
+ip_owner_interface_trigger = Trigger(
+    'ip_owner_interface_trigger', Interface.__table__,
+    ('UPDATE OF host_id',), "ip_owner_interface_event()",
+)
+ddl.add_function(ip_owner, ip_owner_interface_function)
+ddl.add_trigger(ip_owner, ip_owner_interface_trigger)
+
+ip_owner_host_function = Function(
+    'ip_owner_host_event', [], 'trigger',
+    """
+    BEGIN
+      UPDATE ip_owner SET user_id = NEW.owner_id
+      FROM ip, interface
+      WHERE ip.id = ip_owner.ip_id AND ip.interface_id = interface.id
+        AND interface.host_id = NEW.id;
+      RETURN NULL;
+    END;
+    """,
+    volatility='volatile', language='plpgsql',
+)
+ip_owner_host_trigger = Trigger(
+    'ip_owner_host_trigger', Host.__table__,
+    ('UPDATE OF owner_id',), "ip_owner_host_event()",
+)
+ddl.add_function(ip_owner, ip_owner_host_function)
+ddl.add_trigger(ip_owner, ip_owner_host_trigger)
+
 
 pmacct_traffic_egress = View(
     name='pmacct_traffic_egress',
@@ -91,6 +288,10 @@ pmacct_expression_replacements = dict(
     interface_tname=Interface.__tablename__,
     interface_id=str(Interface.id.expression),
     interface_host_id=str(Interface.host_id.expression),
+    ip_owner_tname=IPOwner.__tablename__,
+    ip_owner_address=str(IPOwner.address.expression),
+    ip_owner_ip_id=str(IPOwner.ip_id.expression),
+    ip_owner_user_id=str(IPOwner.user_id.expression),
 )
 pmacct_egress_upsert = Function(
     name="pmacct_traffic_egress_insert", arguments=[], language="plpgsql", rtype="trigger",
@@ -98,15 +299,13 @@ pmacct_egress_upsert = Function(
         INSERT INTO traffic_volume ({tv_type}, {tv_ip_id}, "{tv_timestamp}", {tv_amount}, {tv_packets}, {tv_user_id})
         SELECT
             'Egress',
-            {ip_id},
+            {ip_owner_ip_id},
             date_trunc('day', NEW.stamp_inserted),
             NEW.bytes,
             NEW.packets,
-            {host_owner_id}
-        FROM {ip_tname}
-        JOIN {interface_tname} ON {ip_interface_id} = {interface_id}
-        JOIN {host_tname} ON {interface_host_id} = {host_id}
-        WHERE NEW.ip_src = {ip_address}
+            {ip_owner_user_id}
+        FROM {ip_owner_tname}
+        WHERE NEW.ip_src = {ip_owner_address}
         ON CONFLICT ({tv_ip_id}, {tv_type}, "{tv_timestamp}")
         DO UPDATE SET ({tv_amount}, {tv_packets}) = ({tv_tname}.{tv_amount} + NEW.bytes,
                                                      {tv_tname}.{tv_packets} + NEW.packets);
@@ -146,15 +345,13 @@ pmacct_ingress_upsert = Function(
         INSERT INTO traffic_volume ({tv_type}, {tv_ip_id}, "{tv_timestamp}", {tv_amount}, {tv_packets}, {tv_user_id})
         SELECT
             'Ingress',
-            {ip_id},
+            {ip_owner_ip_id},
             date_trunc('day', NEW.stamp_inserted),
             NEW.bytes,
             NEW.packets,
-            {host_owner_id}
-        FROM {ip_tname}
-        JOIN {interface_tname} ON {ip_interface_id} = {interface_id}
-        JOIN {host_tname} ON {interface_host_id} = {host_id}
-        WHERE NEW.ip_dst = {ip_address}
+            {ip_owner_user_id}
+        FROM {ip_owner_tname}
+        WHERE NEW.ip_dst = {ip_owner_address}
         ON CONFLICT ({tv_ip_id}, {tv_type}, "{tv_timestamp}")
         DO UPDATE SET ({tv_amount}, {tv_packets}) = ({tv_tname}.{tv_amount} + NEW.bytes,
                                                      {tv_tname}.{tv_packets} + NEW.packets);
@@ -170,9 +367,43 @@ ddl.add_function(TrafficVolume.__table__, pmacct_ingress_upsert)
 ddl.add_trigger(TrafficVolume.__table__, pmacct_ingress_upsert_trigger)
 
 
+# Bulk variant of the pmacct triggers above: the records of a whole batch
+# are passed as parallel arrays, aggregated by ip, direction and day, and
+# upserted by a single statement.
+pmacct_insert_batch = Function(
+    name="pmacct_traffic_insert_batch",
+    arguments=["arg_types text[]", "arg_addresses text[]",
+               "arg_stamps timestamptz[]", "arg_bytes bigint[]",
+               "arg_packets bigint[]"],
+    rtype="void",
+    definition="""
+        INSERT INTO traffic_volume ({tv_type}, {tv_ip_id}, "{tv_timestamp}", {tv_amount}, {tv_packets}, {tv_user_id})
+        SELECT
+            CAST(batch.type AS traffic_direction),
+            {ip_owner_ip_id},
+            date_trunc('day', batch.stamp),
+            sum(batch.bytes),
+            sum(batch.packets),
+            {ip_owner_user_id}
+        FROM unnest(arg_types, arg_addresses, arg_stamps, arg_bytes, arg_packets)
+             AS batch(type, address, stamp, bytes, packets)
+        JOIN {ip_owner_tname} ON CAST(batch.address AS inet) = {ip_owner_address}
+        GROUP BY 1, 2, 3, 6
+        ON CONFLICT ({tv_ip_id}, {tv_type}, "{tv_timestamp}")
+        DO UPDATE SET ({tv_amount}, {tv_packets}) = ({tv_tname}.{tv_amount} + EXCLUDED.{tv_amount},
+                                                     {tv_tname}.{tv_packets} + EXCLUDED.{tv_packets});
+    """.format(**pmacct_expression_replacements),
+)
+
+ddl.add_function(ip_owner, pmacct_insert_batch)
+
+
 class TrafficCredit(TrafficEvent, IntegerIdModel):
+    __table_args__ = (
+        Index('ix_traffic_credit_user_id_timestamp', 'user_id', 'timestamp'),
+    )
     user_id = Column(Integer, ForeignKey(User.id, ondelete='CASCADE'),
-                     nullable=False, index=True)
+                     nullable=False)
     user = relationship(User,
                         backref=backref("traffic_credits",
                                         cascade="all, delete-orphan"),
@@ -180,29 +411,36 @@ class TrafficCredit(TrafficEvent, IntegerIdModel):
 TrafficBalance.__table__.add_is_dependent_on(TrafficCredit.__table__)
 
 
-recent_volume_q = (
-    Query([func.sum(TrafficVolume.amount).label('amount')])
-    .select_from(TrafficVolume)
-    .filter(and_(User.id==TrafficVolume.user_id,
-                 or_(TrafficBalance.user_id.is_(None),
-                     TrafficBalance.timestamp <= TrafficVolume.timestamp)))
-    .subquery()
-    .lateral('recent_volume')
-)
+def traffic_balance_query(*criteria):
+    """Build a query computing the traffic balance of users from scratch.
 
-recent_credit_q = (
-    Query([func.sum(TrafficCredit.amount).label('amount')])
-    .select_from(TrafficCredit)
-    .filter(and_(User.id==TrafficCredit.user_id,
-                 or_(TrafficBalance.user_id.is_(None),
-                     TrafficBalance.timestamp <= TrafficCredit.timestamp)))
-    .subquery()
-    .lateral('recent_credit')
-)
+    The balance is the last :py:class:`TrafficBalance` (or zero) plus
+    every :py:class:`TrafficCredit` minus every :py:class:`TrafficVolume`
+    not older than it.
 
-current_traffic_balance_view = View(
-    name='current_traffic_balance',
-    query=(
+    :param criteria: Additional criteria on the users to consider
+    """
+    recent_volume_q = (
+        Query([func.sum(TrafficVolume.amount).label('amount')])
+        .select_from(TrafficVolume)
+        .filter(and_(User.id==TrafficVolume.user_id,
+                     or_(TrafficBalance.user_id.is_(None),
+                         TrafficBalance.timestamp <= TrafficVolume.timestamp)))
+        .subquery()
+        .lateral('recent_volume')
+    )
+
+    recent_credit_q = (
+        Query([func.sum(TrafficCredit.amount).label('amount')])
+        .select_from(TrafficCredit)
+        .filter(and_(User.id==TrafficCredit.user_id,
+                     or_(TrafficBalance.user_id.is_(None),
+                         TrafficBalance.timestamp <= TrafficCredit.timestamp)))
+        .subquery()
+        .lateral('recent_credit')
+    )
+
+    return (
         Query([
             User.id.label('user_id'),
             (func.coalesce(TrafficBalance.amount, 0) +
@@ -213,46 +451,363 @@ current_traffic_balance_view = View(
         .outerjoin(TrafficBalance)
         .outerjoin(recent_credit_q, true())
         .outerjoin(recent_volume_q, true())
+        .filter(*criteria)
         .statement
     )
-)
-ddl.add_view(TrafficBalance.__table__, current_traffic_balance_view)
 
 
 class CurrentTrafficBalance(ModelBase):
-    __table__ = current_traffic_balance_view.table
-    __mapper_args__ = {
-        'primary_key': current_traffic_balance_view.table.c.user_id,
-    }
+    """The current traffic balance of every user
+
+    The row of a user is created on insertion of the user.  Traffic
+    volumes and credits add their amount to it as they are inserted,
+    updated or deleted (which includes the upserts done by the pmacct
+    views), unless they predate the user's :py:class:`TrafficBalance`.
+    Changing the :py:class:`TrafficBalance` of a user recomputes their
+    balance from scratch.
+    """
+    user_id = Column(Integer, ForeignKey(User.id, ondelete='CASCADE'),
+                     primary_key=True)
+    amount = Column(BigInteger, nullable=False, index=True)
+
+
+current_traffic_balance = CurrentTrafficBalance.__table__
+current_traffic_balance.add_is_dependent_on(TrafficBalance.__table__)
+
+
+refresh_current_traffic_balance_function = Function(
+    'refresh_current_traffic_balance', ['arg_user_ids integer[]'], 'void',
+    """
+    BEGIN
+      IF arg_user_ids IS NULL THEN
+        DELETE FROM current_traffic_balance;
+        INSERT INTO current_traffic_balance (user_id, amount)
+        {all_users};
+      ELSE
+        DELETE FROM current_traffic_balance WHERE user_id = ANY(arg_user_ids);
+        INSERT INTO current_traffic_balance (user_id, amount)
+        {some_users};
+      END IF;
+    END;
+    """.format(
+        all_users=_compile_literally(traffic_balance_query()),
+        some_users=_compile_literally(traffic_balance_query(
+            User.id == func.any(literal_column('arg_user_ids')))),
+    ),
+    volatility='volatile', language='plpgsql',
+)
+ddl.add_function(current_traffic_balance,
+                 refresh_current_traffic_balance_function)
+
+current_traffic_balance_add_function = Function(
+    'current_traffic_balance_add',
+    ['arg_user_id integer', 'arg_timestamp timestamptz', 'arg_amount bigint'],
+    'void',
+    """
+    BEGIN
+      IF NOT EXISTS (
+        SELECT 1 FROM traffic_balance
+        WHERE user_id = arg_user_id AND "timestamp" > arg_timestamp
+      ) THEN
+        UPDATE current_traffic_balance SET amount = amount + arg_amount
+        WHERE user_id = arg_user_id;
+      END IF;
+    END;
+    """,
+    volatility='volatile', language='plpgsql',
+)
+ddl.add_function(current_traffic_balance, current_traffic_balance_add_function)
+
+# The only trigger argument is the sign with which the amount of the
+# event enters the balance.
+current_traffic_balance_event_function = Function(
+    'current_traffic_balance_event', [], 'trigger',
+    """
+    DECLARE
+      v_sign bigint := TG_ARGV[0]::bigint;
+    BEGIN
+      IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM current_traffic_balance_add(OLD.user_id, OLD."timestamp",
+                                            -v_sign * OLD.amount);
+      END IF;
+      IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM current_traffic_balance_add(NEW.user_id, NEW."timestamp",
+                                            v_sign * NEW.amount);
+      END IF;
+      RETURN NULL;
+    END;
+    """,
+    volatility='volatile', language='plpgsql',
+)
+current_traffic_balance_volume_trigger = Trigger(
+    'current_traffic_balance_volume_trigger', TrafficVolume.__table__,
+    ('INSERT', 'UPDATE', 'DELETE'), "current_traffic_balance_event('-1')",
+)
+current_traffic_balance_credit_trigger = Trigger(
+    'current_traffic_balance_credit_trigger', TrafficCredit.__table__,
+    ('INSERT', 'UPDATE', 'DELETE'), "current_traffic_balance_event('1')",
+)
+ddl.add_function(current_traffic_balance,
+                 current_traffic_balance_event_function)
+ddl.add_trigger(current_traffic_balance,
+                current_traffic_balance_volume_trigger)
+ddl.add_trigger(current_traffic_balance,
+                current_traffic_balance_credit_trigger)
+
+current_traffic_balance_checkpoint_function = Function(
+    'current_traffic_balance_checkpoint', [], 'trigger',
+    """
+    BEGIN
+      IF TG_OP = 'INSERT' THEN
+        PERFORM refresh_current_traffic_balance(ARRAY[NEW.user_id]);
+      ELSIF TG_OP = 'DELETE' THEN
+        PERFORM refresh_current_traffic_balance(ARRAY[OLD.user_id]);
+      ELSE
+        PERFORM refresh_current_traffic_balance(ARRAY[OLD.user_id, NEW.user_id]);
+      END IF;
+      RETURN NULL;
+    END;
+    """,
+    volatility='volatile', language='plpgsql',
+)
+current_traffic_balance_checkpoint_trigger = Trigger(
+    'current_traffic_balance_checkpoint_trigger', TrafficBalance.__table__,
+    ('INSERT', 'UPDATE', 'DELETE'), "current_traffic_balance_checkpoint()",
+)
+ddl.add_function(current_traffic_balance,
+                 current_traffic_balance_checkpoint_function)
+ddl.add_trigger(current_traffic_balance,
+                current_traffic_balance_checkpoint_trigger)
+
+current_traffic_balance_user_function = Function(
+    'current_traffic_balance_user_insert', [], 'trigger',
+    """
+    BEGIN
+      INSERT INTO current_traffic_balance (user_id, amount)
+      VALUES (NEW.id, 0);
+      RETURN NULL;
+    END;
+    """,
+    volatility='volatile', language='plpgsql',
+)
+current_traffic_balance_user_trigger = Trigger(
+    'current_traffic_balance_user_insert_trigger', User.__table__,
+    ('INSERT',), "current_traffic_balance_user_insert()",
+)
+ddl.add_function(current_traffic_balance,
+                 current_traffic_balance_user_function)
+ddl.add_trigger(current_traffic_balance,
+                current_traffic_balance_user_trigger)
 
 
-def traffic_history_query():
-    timestamptz = TIMESTAMP(timezone=True)
+class DailyTraffic(ModelBase):
+    """The traffic credit, ingress and egress of a user per day
 
-    events = union_all(
-        select([TrafficCredit.amount,
-                TrafficCredit.timestamp,
-                literal("Credit").label('type')]
-               ).where(TrafficCredit.user_id == literal_column('arg_user_id')),
+    Days are aligned to the unix epoch, i.e. they start at midnight UTC.
+    The rows are kept up to date by triggers on the traffic volumes and
+    credits, so that the traffic history of whole days does not have to
+    be computed from the individual events.
+    """
+    __table_args__ = (
+        PrimaryKeyConstraint('user_id', 'day'),
+        Index('ix_daily_traffic_day', 'day'),
+    )
+    user_id = Column(Integer, ForeignKey(User.id, ondelete='CASCADE'),
+                     nullable=False)
+    day = Column(DateTimeTz, nullable=False)
+    credit = Column(BigInteger, nullable=False, server_default='0')
+    ingress = Column(BigInteger, nullable=False, server_default='0')
+    egress = Column(BigInteger, nullable=False, server_default='0')
+
+
+daily_traffic = DailyTraffic.__table__
+daily_traffic.add_is_dependent_on(TrafficVolume.__table__)
+daily_traffic.add_is_dependent_on(TrafficCredit.__table__)
+daily_traffic.add_is_dependent_on(TrafficBalance.__table__)
+
+
+def day_of(time_expr):
+    """The beginning of the (epoch aligned) day of a timestamp"""
+    return func.to_timestamp(
+        func.floor(func.extract('epoch', time_expr) / 86400) * 86400)
+
+
+daily_traffic_add_function = Function(
+    'daily_traffic_add',
+    ['arg_user_id integer', 'arg_timestamp timestamptz', 'arg_type text',
+     'arg_amount bigint'],
+    'void',
+    """
+    BEGIN
+      IF arg_user_id IS NULL THEN
+        RETURN;
+      END IF;
+      INSERT INTO daily_traffic AS d (user_id, day, credit, ingress, egress)
+      VALUES (
+        arg_user_id,
+        {day},
+        CASE WHEN arg_type = 'Credit' THEN arg_amount ELSE 0 END,
+        CASE WHEN arg_type = 'Ingress' THEN arg_amount ELSE 0 END,
+        CASE WHEN arg_type = 'Egress' THEN arg_amount ELSE 0 END
+      )
+      ON CONFLICT (user_id, day) DO UPDATE SET
+        credit = d.credit + EXCLUDED.credit,
+        ingress = d.ingress + EXCLUDED.ingress,
+        egress = d.egress + EXCLUDED.egress;
+    END;
+    """.format(day=_compile_literally(day_of(literal_column('arg_timestamp')))),
+    volatility='volatile', language='plpgsql',
+)
+ddl.add_function(daily_traffic, daily_traffic_add_function)
+
+#: A transaction local setting which is ``'on'`` while old volumes are
+#: deleted by :py:func:`pycroft.lib.traffic.fold_traffic_volumes`.  They
+#: stay in ``daily_traffic``, like the volumes of dropped partitions.
+folding_traffic_volumes_setting = 'pycroft.folding_traffic_volumes'
+
+# The only trigger argument tells whether the trigger is defined on the
+# credits (``'credit'``) or the volumes (``'volume'``).
+daily_traffic_event_function = Function(
+    'daily_traffic_event', [], 'trigger',
+    """
+    BEGIN
+      IF TG_OP = 'DELETE' AND TG_ARGV[0] = 'volume'
+         AND current_setting('{setting}', true) = 'on' THEN
+        RETURN NULL;
+      END IF;
+      IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        IF TG_ARGV[0] = 'credit' THEN
+          PERFORM daily_traffic_add(OLD.user_id, OLD."timestamp", 'Credit',
+                                    -OLD.amount);
+        ELSE
+          PERFORM daily_traffic_add(OLD.user_id, OLD."timestamp",
+                                    OLD.type::text, -OLD.amount);
+        END IF;
+      END IF;
+      IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        IF TG_ARGV[0] = 'credit' THEN
+          PERFORM daily_traffic_add(NEW.user_id, NEW."timestamp", 'Credit',
+                                    NEW.amount);
+        ELSE
+          PERFORM daily_traffic_add(NEW.user_id, NEW."timestamp",
+                                    NEW.type::text, NEW.amount);
+        END IF;
+      END IF;
+      RETURN NULL;
+    END;
+    """.format(setting=folding_traffic_volumes_setting),
+    volatility='volatile', language='plpgsql',
+)
+daily_traffic_volume_trigger = Trigger(
+    'daily_traffic_volume_trigger', TrafficVolume.__table__,
+    ('INSERT', 'UPDATE', 'DELETE'), "daily_traffic_event('volume')",
+)
+daily_traffic_credit_trigger = Trigger(
+    'daily_traffic_credit_trigger', TrafficCredit.__table__,
+    ('INSERT', 'UPDATE', 'DELETE'), "daily_traffic_event('credit')",
+)
+ddl.add_function(daily_traffic, daily_traffic_event_function)
+ddl.add_trigger(daily_traffic, daily_traffic_volume_trigger)
+ddl.add_trigger(daily_traffic, daily_traffic_credit_trigger)
+
+
+refresh_daily_traffic_function = Function(
+    'refresh_daily_traffic', ['arg_user_ids integer[]'], 'void',
+    """
+    BEGIN
+      DELETE FROM daily_traffic
+      WHERE arg_user_ids IS NULL OR user_id = ANY(arg_user_ids);
+      INSERT INTO daily_traffic (user_id, day, credit, ingress, egress)
+      SELECT user_id, day, sum(credit), sum(ingress), sum(egress)
+      FROM (
+        SELECT user_id, {credit_day} AS day, amount AS credit,
+               0 AS ingress, 0 AS egress
+        FROM traffic_credit
+        UNION ALL
+        SELECT user_id, {volume_day} AS day, 0 AS credit,
+               CASE WHEN type = 'Ingress' THEN amount ELSE 0 END AS ingress,
+               CASE WHEN type = 'Egress' THEN amount ELSE 0 END AS egress
+        FROM traffic_volume
+        WHERE user_id IS NOT NULL
+      ) AS events
+      WHERE arg_user_ids IS NULL OR user_id = ANY(arg_user_ids)
+      GROUP BY user_id, day;
+    END;
+    """.format(
+        credit_day=_compile_literally(day_of(literal_column('traffic_credit."timestamp"'))),
+        volume_day=_compile_literally(day_of(literal_column('traffic_volume."timestamp"'))),
+    ),
+    volatility='volatile', language='plpgsql',
+)
+ddl.add_function(daily_traffic, refresh_daily_traffic_function)
 
-        select([(-TrafficVolume.amount).label('amount'),
-                TrafficVolume.timestamp,
-                cast(TrafficVolume.type, TEXT).label('type')]
-               ).where(TrafficVolume.user_id == literal_column('arg_user_id'))
-    ).cte('traffic_events')
+
+def traffic_history_query():
+    timestamptz = TIMESTAMP(timezone=True)
 
     def round_time(time_expr, ceil=False):
         round_func = func.ceil if ceil else func.trunc
         step_epoch = func.extract('epoch', literal_column('arg_step'))
         return cast(func.to_timestamp(round_func(func.extract('epoch', time_expr) / step_epoch) * step_epoch), timestamptz)
 
-    balance = select([TrafficBalance.amount, TrafficBalance.timestamp])\
+    balance = select([User.id.label('user_id'),
+                      TrafficBalance.amount,
+                      TrafficBalance.timestamp])\
         .select_from(User.__table__.outerjoin(TrafficBalance))\
-        .where(User.id == literal_column('arg_user_id'))\
+        .where(User.id == func.any(literal_column('arg_user_ids')))\
         .cte('balance')
 
-    balance_amount = select([balance.c.amount]).as_scalar()
-    balance_timestamp = select([balance.c.timestamp]).as_scalar()
+    # Events older than both the first bucket and the balance do not
+    # contribute to any of the returned entries
+    window_start = round_time(cast(literal_column('arg_start'), timestamptz)) - literal_column('arg_step')
+
+    def is_relevant(timestamp):
+        return or_(balance.c.timestamp == None,
+                   timestamp >= func.least(balance.c.timestamp, window_start))
+
+    def is_whole_days(time_expr):
+        return func.mod(cast(func.extract('epoch', time_expr), Numeric), 86400) == 0
+
+    # If the buckets and the balance are aligned to whole days, the
+    # events can be read from the daily rollup instead
+    use_daily = and_(is_whole_days(literal_column('arg_step')),
+                     or_(balance.c.timestamp == None,
+                         is_whole_days(balance.c.timestamp)))
+
+    def daily_events(column, type_, sign=1):
+        return select([DailyTraffic.user_id,
+                       (sign * column).label('amount'),
+                       DailyTraffic.day.label('timestamp'),
+                       literal(type_).label('type')]
+               ).select_from(daily_traffic.join(
+                   balance, balance.c.user_id == DailyTraffic.user_id)
+               ).where(and_(use_daily,
+                            column != 0,
+                            is_relevant(DailyTraffic.day)))
+
+    events = union_all(
+        select([TrafficCredit.user_id,
+                TrafficCredit.amount,
+                TrafficCredit.timestamp,
+                literal("Credit").label('type')]
+               ).select_from(TrafficCredit.__table__.join(
+                   balance, balance.c.user_id == TrafficCredit.user_id)
+               ).where(and_(not_(use_daily),
+                            is_relevant(TrafficCredit.timestamp))),
+
+        select([TrafficVolume.user_id,
+                (-TrafficVolume.amount).label('amount'),
+                TrafficVolume.timestamp,
+                cast(TrafficVolume.type, TEXT).label('type')]
+               ).select_from(TrafficVolume.__table__.join(
+                   balance, balance.c.user_id == TrafficVolume.user_id)
+               ).where(and_(not_(use_daily),
+                            is_relevant(TrafficVolume.timestamp))),
+
+        daily_events(DailyTraffic.credit, "Credit"),
+        daily_events(DailyTraffic.ingress, "Ingress", sign=-1),
+        daily_events(DailyTraffic.egress, "Egress", sign=-1),
+    ).cte('traffic_events')
 
     # Bucket layout
     # n = interval / step
@@ -263,7 +818,7 @@ def traffic_history_query():
             (func.row_number().over(order_by=literal_column('bucket')) - 1).label('index')]
     ).select_from(
         func.generate_series(
-            round_time(cast(literal_column('arg_start'), timestamptz)) - literal_column('arg_step'),
+            window_start,
             round_time(cast(literal_column('arg_start'), timestamptz) + literal_column('arg_interval')),
             literal_column('arg_step')
         ).alias('bucket')
@@ -277,31 +832,39 @@ def traffic_history_query():
             else_=None)).label(label)
 
 
-    hist = select([buckets.c.bucket,
+    # Every user gets the same buckets
+    hist = select([balance.c.user_id,
+                   balance.c.amount.label('balance_amount'),
+                   balance.c.timestamp.label('balance_timestamp'),
+                   buckets.c.bucket,
                    cond_sum(events.c.type == 'Credit', 'credit'),
                    cond_sum(events.c.type == 'Ingress', 'ingress', invert=True),
                    cond_sum(events.c.type == 'Egress', 'egress', invert=True),
                    func.sum(events.c.amount).label('amount'),
-                   cond_sum(and_(balance_timestamp != None, events.c.timestamp < balance_timestamp), 'before_balance'),
-                   cond_sum(or_(balance_timestamp == None, events.c.timestamp >= balance_timestamp), 'after_balance')]
-    ).select_from(buckets.outerjoin(
-        events, func.width_bucket(
+                   cond_sum(and_(balance.c.timestamp != None, events.c.timestamp < balance.c.timestamp), 'before_balance'),
+                   cond_sum(or_(balance.c.timestamp == None, events.c.timestamp >= balance.c.timestamp), 'after_balance')]
+    ).select_from(balance.join(buckets, true()).outerjoin(
+        events, and_(events.c.user_id == balance.c.user_id, func.width_bucket(
             events.c.timestamp, select([func.array(select([buckets.c.bucket]).select_from(buckets).where(buckets.c.index != 0).label('dummy'))])
-        ) == buckets.c.index
+        ) == buckets.c.index)
     )).where(
         # Discard bucket n+1
         buckets.c.index < select([func.max(buckets.c.index)])
     ).group_by(
-        buckets.c.bucket
-    ).order_by(
+        balance.c.user_id, balance.c.amount, balance.c.timestamp,
         buckets.c.bucket
     ).cte('traffic_hist')
 
 
     # Bucket is located before the balance and no traffic_events exist before it
-    first_event_timestamp = select([func.min(events.c.timestamp)]).as_scalar()
+    first_event_timestamp = func.least(
+        select([func.min(TrafficCredit.timestamp)])
+        .where(TrafficCredit.user_id == hist.c.user_id).as_scalar(),
+        select([func.min(TrafficVolume.timestamp)])
+        .where(TrafficVolume.user_id == hist.c.user_id).as_scalar()
+    )
     case_before_balance_no_data = (
-        and_(balance_timestamp != None, hist.c.bucket < balance_timestamp,
+        and_(hist.c.balance_timestamp != None, hist.c.bucket < hist.c.balance_timestamp,
         or_(first_event_timestamp == None,
             hist.c.bucket < first_event_timestamp
             )),
@@ -310,49 +873,61 @@ def traffic_history_query():
 
     # Bucket is located after the balance
     case_after_balance = (
-        or_(balance_timestamp == None, hist.c.bucket >= balance_timestamp),
-        func.coalesce(balance_amount, 0) + func.coalesce(
+        or_(hist.c.balance_timestamp == None, hist.c.bucket >= hist.c.balance_timestamp),
+        func.coalesce(hist.c.balance_amount, 0) + func.coalesce(
             func.sum(hist.c.after_balance).over(
+                partition_by=hist.c.user_id,
                 order_by=hist.c.bucket.asc(), rows=(None, 0)),
             0)
     )
 
     # Bucket is located before the balance, but there still exist traffic_events before it
     else_before_balance = (
-            func.coalesce(balance_amount, 0) +
+            func.coalesce(hist.c.balance_amount, 0) +
             func.coalesce(hist.c.after_balance, 0) -
             func.coalesce(
                 func.sum(hist.c.before_balance).over(
+                    partition_by=hist.c.user_id,
                     order_by=hist.c.bucket.desc(), rows=(None, -1)
                 ), 0)
     )
 
     agg_hist = select(
-            [hist.c.bucket, hist.c.credit, hist.c.ingress, hist.c.egress, case(
+            [hist.c.user_id, hist.c.bucket, hist.c.credit, hist.c.ingress, hist.c.egress, case(
             [case_before_balance_no_data, case_after_balance],
             else_=else_before_balance
         ).label('balance')]).alias('agg_hist')
 
     # Remove bucket 0
-    result = select([agg_hist]).order_by(agg_hist.c.bucket).offset(1)
+    result = select([agg_hist]).where(
+        agg_hist.c.bucket > window_start
+    ).order_by(agg_hist.c.user_id, agg_hist.c.bucket)
 
     return result
 
 
+traffic_histories_function = Function(
+    'traffic_histories', ['arg_user_ids int[]', 'arg_start timestamptz', 'arg_interval interval', 'arg_step interval'],
+    'TABLE (user_id int, "timestamp" timestamptz, credit numeric, ingress numeric, egress numeric, balance numeric)',
+    _compile_literally(traffic_history_query()),
+    volatility='stable',
+)
+
 traffic_history_function = Function(
     'traffic_history', ['arg_user_id int', 'arg_start timestamptz', 'arg_interval interval', 'arg_step interval'],
     'TABLE ("timestamp" timestamptz, credit numeric, ingress numeric, egress numeric, balance numeric)',
-    str(
-        traffic_history_query().compile(
-            dialect=postgresql.dialect(),
-            compile_kwargs={'literal_binds': True}
-        )
-    ),
+    'SELECT "timestamp", credit, ingress, egress, balance '
+    'FROM traffic_histories(ARRAY[arg_user_id], arg_start, arg_interval, arg_step)',
     volatility='stable',
 )
 
 ddl.add_function(
-    TrafficBalance.__table__,
+    daily_traffic,
+    traffic_histories_function
+)
+
+ddl.add_function(
+    daily_traffic,
     traffic_history_function
 )
 
@@ -93,6 +93,8 @@ class Money(TypeDecorator):
 
     @staticmethod
     def process_result_value(value, dialect):
+        if value is None:
+            return None
         return Decimal(value).scaleb(-2)
 
 
@@ -14,9 +14,10 @@ import re
 
 from flask_login import UserMixin
 from sqlalchemy import (
-    Boolean, BigInteger, CheckConstraint, Column, ForeignKey, Integer,
-    String, and_, exists, join, literal, not_, null, or_, select, Sequence,
-    Interval, Date, func)
+    DDL, Boolean, BigInteger, CheckConstraint, Column, ForeignKey, Index, Integer,
+    String, and_, exists, join, literal, literal_column, not_, null, or_,
+    select, Sequence, Interval, Date, Text, cast, event, func)
+from sqlalchemy.dialects.postgresql import ARRAY, TSTZRANGE, array_agg
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.ext.hybrid import hybrid_method, hybrid_property
 from sqlalchemy.orm import backref, object_session, relationship, validates
@@ -81,7 +82,7 @@ class User(IntegerIdModel, UserMixin):
     def current_credit(self):
         return self._current_traffic_balance.amount
 
-    #: This is a relationship to the `current_property` view filtering out
+    #: This is a relationship to the `current_property` table filtering out
     #: the entries with `denied=True`.
     current_properties = relationship(
         'CurrentProperty',
@@ -89,7 +90,7 @@ class User(IntegerIdModel, UserMixin):
                     '~CurrentProperty.denied)',
         viewonly=True
     )
-    #: This is a relationship to the `current_property` view ignoring the
+    #: This is a relationship to the `current_property` table ignoring the
     #: `denied` attribute.
     current_properties_maybe_denied = relationship(
         'CurrentProperty',
@@ -97,6 +98,47 @@ class User(IntegerIdModel, UserMixin):
         viewonly=True
     )
 
+    @hybrid_property
+    def property_set(self):
+        """The names of the properties the user currently has
+
+        This is read from the ``current_property`` table.  As an SQL
+        expression, it is an array of all properties aggregated in a
+        single subquery, which can be tested with the array operators,
+        e.g. ``User.property_set.contains(['ldap'])`` or
+        ``User.property_set.overlap(admin_properties)``.  To use it
+        several times in a query, join :py:meth:`property_set_lateral`
+        instead.
+        """
+        return frozenset(p.property_name for p in self.current_properties)
+
+    @property_set.expression
+    def property_set(cls):
+        return cls._property_set_select().as_scalar()
+
+    @classmethod
+    def property_set_lateral(cls, name='property_set'):
+        """Return a LATERAL subquery with the property set of a user.
+
+        The subquery has a single column ``property_set`` holding the
+        same array as :py:attr:`property_set`.  Join it with
+        ``true()`` as the ``ON`` clause.
+
+        :param str name: the name of the subquery
+        """
+        return cls._property_set_select().lateral(name)
+
+    @classmethod
+    def _property_set_select(cls):
+        from pycroft.model.property import CurrentProperty
+        return select([func.coalesce(
+            array_agg(cast(CurrentProperty.property_name, Text)),
+            cast(literal_column("'{}'"), ARRAY(Text))
+        ).label('property_set')]).where(and_(
+            CurrentProperty.user_id == cls.id,
+            ~CurrentProperty.denied,
+        ))
+
     login_regex = re.compile(r"""
         ^
         # Must begin with a lowercase character
@@ -214,8 +256,24 @@ class User(IntegerIdModel, UserMixin):
             Membership.active(when)
         )
 
+    def _active_groups(self, group_type, when=None):
+        """Return the groups of a type the user is a member of in ``when``
+
+        The groups are taken from the loaded memberships, which is what
+        the instance methods fall back to for users not attached to a
+        session.
+        """
+        groups = []
+        for membership in self.active_memberships(when):
+            group = membership.group
+            if isinstance(group, group_type) and group not in groups:
+                groups.append(group)
+        return groups
+
     @hybrid_method
     def active_property_groups(self, when=None):
+        if object_session(self) is None:
+            return self._active_groups(PropertyGroup, when)
         return object_session(self).query(
             PropertyGroup
         ).join(
@@ -236,6 +294,8 @@ class User(IntegerIdModel, UserMixin):
 
     @hybrid_method
     def active_traffic_groups(self, when=None):
+        if object_session(self) is None:
+            return self._active_groups(TrafficGroup, when)
         return object_session(self).query(
             TrafficGroup
         ).join(
@@ -276,15 +336,70 @@ class User(IntegerIdModel, UserMixin):
             )
         )
 
+    @staticmethod
+    def _evaluation_time(when):
+        """Return the point in time of ``when`` as SQL expression
+
+        If ``when`` is ``None``, this is the current transaction
+        timestamp.  If ``when`` does not consist of a single point in
+        time, ``None`` is returned.
+
+        :param Interval|None when:
+        """
+        if when is None:
+            return func.current_timestamp()
+        if when.begin is None or when.begin != when.end or when.empty:
+            return None
+        return literal(when.begin, DateTimeTz)
+
+    def effective_properties(self, when=None):
+        """Return the names of all properties the user has at a point in
+        time.
+
+        In contrast to calling :py:meth:`has_property` for every property,
+        this needs a single query.
+
+        :param Interval when: a single point in time, defaults to the
+            current transaction timestamp
+        :rtype: frozenset[str]
+        :raises ValueError: if ``when`` is not a single point in time
+        """
+        evaluation_time = self._evaluation_time(when)
+        if evaluation_time is None:
+            raise ValueError("Properties can only be evaluated at a single "
+                             "point in time, not {}".format(when))
+        if object_session(self) is None:
+            grants = {}
+            for group in self.active_property_groups(when):
+                for name, granted in group.property_grants.items():
+                    grants.setdefault(name, []).append(granted)
+            return frozenset(name for name, flags in grants.items()
+                             if all(flags))
+        properties = func.evaluate_properties_for_user(
+            self.id, evaluation_time).alias('properties')
+        rows = object_session(self).query(
+            literal_column('properties.property_name')
+        ).select_from(properties).filter(
+            ~literal_column('properties.denied'))
+        return frozenset(name for name, in rows)
+
     @hybrid_method
     def has_property(self, property_name, when=None):
         """
         :param str property_name: name of a property
         :param Interval when:
         """
-        if when is None:
-            now = session.utcnow()
-            when = single(now)
+        evaluation_time = self._evaluation_time(when)
+        if evaluation_time is not None and object_session(self) is not None:
+            properties = func.evaluate_properties_for_user(
+                self.id, evaluation_time).alias('properties')
+            return object_session(self).query(exists(
+                select([null()]).select_from(properties).where(and_(
+                    literal_column('properties.property_name') == property_name,
+                    ~literal_column('properties.denied'),
+                ))
+            )).scalar()
+
         prop_granted_flags = [
             group.property_grants[property_name]
             for group in self.active_property_groups(when)
@@ -294,6 +409,17 @@ class User(IntegerIdModel, UserMixin):
 
     @has_property.expression
     def has_property(cls, prop, when=None):
+        evaluation_time = cls._evaluation_time(when)
+        if evaluation_time is not None:
+            properties = func.evaluate_properties_for_user(
+                cls.id, evaluation_time).alias('properties')
+            return exists(
+                select([null()]).select_from(properties).where(and_(
+                    literal_column('properties.property_name') == prop,
+                    ~literal_column('properties.denied'),
+                ))
+            ).label("has_property_" + prop)
+
         # TODO Use joins
         property_granted_select = select(
             [null()],
@@ -337,16 +463,25 @@ class User(IntegerIdModel, UserMixin):
         property
         :rtype: IntervalSet
         """
-        property_assignments = object_session(self).query(
-            Property.granted,
-            Membership.begins_at,
-            Membership.ends_at
-        ).filter(
-            Property.name == name,
-            Property.property_group_id == PropertyGroup.id,
-            PropertyGroup.id == Membership.group_id,
-            Membership.user_id == self.id
-        ).all()
+        if object_session(self) is None:
+            property_assignments = [
+                (prop.granted, membership.begins_at, membership.ends_at)
+                for membership in self.memberships
+                if isinstance(membership.group, PropertyGroup)
+                for prop in membership.group.properties
+                if prop.name == name
+            ]
+        else:
+            property_assignments = object_session(self).query(
+                Property.granted,
+                Membership.begins_at,
+                Membership.ends_at
+            ).filter(
+                Property.name == name,
+                Property.property_group_id == PropertyGroup.id,
+                PropertyGroup.id == Membership.group_id,
+                Membership.user_id == self.id
+            ).all()
         granted_intervals = IntervalSet(
             closed(begins_at, ends_at)
             for granted, begins_at, ends_at in property_assignments
@@ -407,10 +542,10 @@ class Membership(IntegerIdModel):
     user = relationship(User, backref=backref("memberships",
                                               cascade="all, delete-orphan"))
 
-    __table_args = (
+    __table_args__ = (
         CheckConstraint("begins_at IS NULL OR "
                         "ends_at IS NULL OR "
-                        "begins_at <= ends_at")
+                        "begins_at <= ends_at"),
     )
 
     @hybrid_method
@@ -439,12 +574,27 @@ class Membership(IntegerIdModel):
             now = session.utcnow()
             when = single(now)
 
-        return and_(
-            or_(cls.begins_at == null(), literal(when.end) == null(),
-                cls.begins_at <= literal(when.end)),
-            or_(literal(when.begin) == null(), cls.ends_at == null(),
-                literal(when.begin) <= cls.ends_at)
-        ).label("active")
+        if when.begin is not None and when.begin == when.end:
+            return cls.active_during.contains(
+                literal(when.begin, DateTimeTz)).label("active")
+        return cls.active_during.overlaps(func.tstzrange(
+            literal(when.begin, DateTimeTz), literal(when.end, DateTimeTz),
+            '[]', type_=TSTZRANGE
+        )).label("active")
+
+    @hybrid_property
+    def active_during(self):
+        """The closed interval the membership is active in
+
+        As SQL expression, this is the corresponding ``tstzrange``,
+        which is backed by a GiST index.
+        """
+        return closed(self.begins_at, self.ends_at)
+
+    @active_during.expression
+    def active_during(cls):
+        return func.tstzrange(cls.begins_at, cls.ends_at, '[]',
+                              type_=TSTZRANGE)
 
     @validates('ends_at')
     def validate_ends_at(self, _, value):
@@ -474,6 +624,30 @@ class Membership(IntegerIdModel):
             self.ends_at = ends_at
 
 
+Index('ix_membership_active_during', Membership.active_during,
+      postgresql_using='gist')
+
+# The exclusion constraint needs btree_gist for the equality on the ids.
+# It is deferred, as memberships are usually replaced by merged ones
+# within a transaction (see :py:func:`pycroft.lib.membership.make_member_of`)
+# and new rows are flushed before old ones are deleted.
+event.listen(
+    Membership.__table__,
+    "before_create",
+    DDL("CREATE EXTENSION IF NOT EXISTS btree_gist")
+    .execute_if(dialect='postgresql')
+)
+event.listen(
+    Membership.__table__,
+    "after_create",
+    DDL("ALTER TABLE membership ADD CONSTRAINT membership_exclusive_excl "
+        "EXCLUDE USING gist (user_id WITH =, group_id WITH =, "
+        "tstzrange(begins_at, ends_at, '[]') WITH &&) "
+        "DEFERRABLE INITIALLY DEFERRED")
+    .execute_if(dialect='postgresql')
+)
+
+
 class PropertyGroup(Group):
     __mapper_args__ = {'polymorphic_identity': 'property_group'}
     id = Column(Integer, ForeignKey(Group.id), primary_key=True,
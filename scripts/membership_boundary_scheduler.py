@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# Copyright (c) 2017 The Pycroft Authors. See the AUTHORS file.
+# This file is part of the Pycroft project and licensed under the terms of
+# the Apache License, Version 2.0. See the LICENSE file for details.
+
+import os
+import time
+from datetime import timedelta
+
+from flask import _request_ctx_stack
+from sqlalchemy import create_engine
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+from pycroft.lib.membership import (
+    next_membership_boundary, process_membership_boundaries,
+    refresh_all_membership_boundaries)
+from pycroft.model import session
+from pycroft.model.session import set_scoped_session
+from scripts.schema import AlembicHelper, SchemaStrategist
+
+#: Upper bound for the time to wait for the next boundary, so that
+#: memberships created in the meantime are picked up eventually.
+MAX_WAIT = timedelta(minutes=5)
+
+
+def wait_for_next_boundary(after):
+    """Sleep until the next membership boundary or at most
+    :data:`MAX_WAIT`."""
+    boundary = next_membership_boundary(after)
+    now = session.utcnow()
+    session.session.commit()
+    if boundary is None:
+        delay = MAX_WAIT
+    else:
+        delay = max(min(boundary - now, MAX_WAIT), timedelta(0))
+    time.sleep(delay.total_seconds())
+
+
+def main():
+    try:
+        connection_string = os.environ['PYCROFT_DB_URI']
+    except KeyError:
+        raise RuntimeError("Environment variable PYCROFT_DB_URI must be "
+                           "set to an SQLAlchemy connection string.")
+
+    engine = create_engine(connection_string)
+    connection = engine.connect()
+    state = AlembicHelper(connection)
+    if not SchemaStrategist(state).is_up_to_date:
+        print("Schema is not up to date!")
+        return
+
+    set_scoped_session(scoped_session(sessionmaker(bind=engine),
+                                      scopefunc=lambda: _request_ctx_stack.top))
+
+    print("Refreshing membership dependent state of all users.")
+    last = session.utcnow()
+    refresh_all_membership_boundaries()
+    session.session.commit()
+
+    print("Waiting for membership boundaries.")
+    while True:
+        wait_for_next_boundary(last)
+        now = session.utcnow()
+        user_ids = process_membership_boundaries(last, now)
+        session.session.commit()
+        if user_ids:
+            print("Processed membership boundaries of {} users up to {}."
+                  .format(len(user_ids), now))
+        last = now
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# Copyright (c) 2018 The Pycroft Authors. See the AUTHORS file.
+# This file is part of the Pycroft project and licensed under the terms of
+# the Apache License, Version 2.0. See the LICENSE file for details.
+
+import argparse
+import asyncio
+import logging
+import os
+import sys
+
+from flask import _request_ctx_stack
+from sqlalchemy import create_engine
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+from pycroft.lib.traffic_collector import TrafficCollector
+from pycroft.model.session import set_scoped_session
+from scripts.schema import AlembicHelper, SchemaStrategist
+
+parser = argparse.ArgumentParser(
+    description="Collect pmacct records (JSON lines) from stdin or a unix "
+                "socket and write them to the traffic volumes in bulk")
+parser.add_argument('-s', '--socket', dest='socket', default=None,
+                    help="Listen on this unix socket instead of reading stdin")
+parser.add_argument('-i', '--flush-interval', dest='flush_interval',
+                    type=float, default=60,
+                    help="Maximum time between two flushes in seconds")
+parser.add_argument('-b', '--max-buffer-size', dest='max_buffer_size',
+                    type=int, default=10000,
+                    help="Maximum number of aggregated volumes to buffer")
+
+
+async def read_stdin(collector, loop):
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(
+        lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    await collector.consume(reader)
+
+
+def main():
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    try:
+        connection_string = os.environ['PYCROFT_DB_URI']
+    except KeyError:
+        raise RuntimeError("Environment variable PYCROFT_DB_URI must be "
+                           "set to an SQLAlchemy connection string.")
+
+    engine = create_engine(connection_string)
+    connection = engine.connect()
+    state = AlembicHelper(connection)
+    if not SchemaStrategist(state).is_up_to_date:
+        print("Schema is not up to date!")
+        return
+
+    set_scoped_session(scoped_session(sessionmaker(bind=engine),
+                                      scopefunc=lambda: _request_ctx_stack.top))
+
+    loop = asyncio.get_event_loop()
+    collector = TrafficCollector(flush_interval=args.flush_interval,
+                                 max_buffer_size=args.max_buffer_size,
+                                 loop=loop)
+    flusher = loop.create_task(collector.flush_periodically())
+    try:
+        if args.socket is not None:
+            server = loop.run_until_complete(asyncio.start_unix_server(
+                collector.handle_connection, path=args.socket))
+            try:
+                loop.run_forever()
+            finally:
+                server.close()
+        else:
+            loop.run_until_complete(read_stdin(collector, loop))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        flusher.cancel()
+        loop.run_until_complete(collector.flush())
+        print("Collector statistics: {}".format(collector.stats()))
+        loop.close()
+
+
+if __name__ == "__main__":
+    main()
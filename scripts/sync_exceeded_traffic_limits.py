@@ -33,8 +33,11 @@ def main():
                                       scopefunc=lambda: _request_ctx_stack.top))
 
     print("Starting synchronization of exceeded traffic limits.")
-    traffic.sync_exceeded_traffic_limits()
+    result = traffic.sync_exceeded_traffic_limits()
     session.session.commit()
+    print("Added {added} memberships in {timings[add]:.3f}s, "
+          "ended {ended} memberships in {timings[end]:.3f}s."
+          .format(**result))
     print("Finished synchronization.")
 
 
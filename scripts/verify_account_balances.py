@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# Copyright (c) 2018 The Pycroft Authors. See the AUTHORS file.
+# This file is part of the Pycroft project and licensed under the terms of
+# the Apache License, Version 2.0. See the LICENSE file for details.
+
+import argparse
+import os
+import sys
+
+from flask import _request_ctx_stack
+from sqlalchemy import create_engine
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+from pycroft.lib import finance
+from pycroft.model import session
+from pycroft.model.session import set_scoped_session
+from scripts.schema import AlembicHelper, SchemaStrategist
+
+parser = argparse.ArgumentParser(
+    description="Recompute the balances of all accounts from their splits "
+                "and report the accounts whose stored balance drifted")
+parser.add_argument('-r', '--repair', dest='repair', action='store_true',
+                    help="Recompute the stored balances that drifted")
+
+
+def main():
+    args = parser.parse_args()
+    try:
+        connection_string = os.environ['PYCROFT_DB_URI']
+    except KeyError:
+        raise RuntimeError("Environment variable PYCROFT_DB_URI must be "
+                           "set to an SQLAlchemy connection string.")
+
+    engine = create_engine(connection_string)
+    connection = engine.connect()
+    state = AlembicHelper(connection)
+    if not SchemaStrategist(state).is_up_to_date:
+        print("Schema is not up to date!")
+        return
+
+    set_scoped_session(scoped_session(sessionmaker(bind=engine),
+                                      scopefunc=lambda: _request_ctx_stack.top))
+
+    drifts = finance.verify_account_balances(repair=args.repair)
+    session.session.commit()
+    for drift in drifts:
+        print("Account {}: stored balance {}, actual balance {}".format(
+            drift.account_id, drift.stored, drift.actual))
+    if not drifts:
+        print("All account balances are correct.")
+        return
+    if args.repair:
+        print("Repaired {} account balances.".format(len(drifts)))
+    else:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -68,6 +68,11 @@ setup(
             'pycroft = scripts.server_run:main',
             'pycroft_ldap_sync = ldap_sync.__main__:main',
             'pycroft_sync_exceeded_traffic_limits = scripts.sync_exceeded_traffic_limits:main',
+            'pycroft_grant_regular_credits = scripts.grant_regular_credits:main',
+            'pycroft_membership_boundary_scheduler = scripts.membership_boundary_scheduler:main',
+            'pycroft_maintain_traffic_volumes = scripts.maintain_traffic_volumes:main',
+            'pycroft_pmacct_collector = scripts.pmacct_collector:main',
+            'pycroft_verify_account_balances = scripts.verify_account_balances:main',
         ]
     },
     license="Apache Software License",
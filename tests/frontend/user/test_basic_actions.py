@@ -22,6 +22,19 @@ class UserViewingPagesTestCase(UserFrontendTestBase):
     def test_user_search_access(self):
         self.assert200(self.client.get(url_for('user.search')))
 
+    def test_traffic_report_access(self):
+        self.assert200(self.client.get(url_for('user.traffic_report')))
+
+    def test_traffic_report_json(self):
+        response = self.client.get(url_for('user.json_traffic_report',
+                                           by='host', type='Ingress'))
+        self.assert200(response)
+        self.assertEqual(response.json['items'], [])
+
+    def test_traffic_report_json_invalid(self):
+        self.assert400(self.client.get(url_for('user.json_traffic_report',
+                                               by='room')))
+
 
 class UserBlockingTestCase(LegacyUserFrontendTestBase):
     def setUp(self):
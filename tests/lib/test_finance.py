@@ -7,7 +7,9 @@ import unittest
 from datetime import date, datetime, time, timedelta
 from decimal import Decimal
 from io import StringIO
+from types import SimpleNamespace
 
+from sqlalchemy import func
 from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
 
 from pycroft.helpers.interval import closed, closedopen, openclosed, single
@@ -17,13 +19,18 @@ from pycroft.lib.finance import (
     transferred_amount,
     is_ordered, get_last_applied_membership_fee,
     get_membership_fee_for_date, handle_payments_in_default,
-    end_payment_in_default_memberships, membership_fee_description)
+    end_payment_in_default_memberships, membership_fee_description,
+    process_transactions, verify_account_balances)
 from pycroft.lib.membership import make_member_of
 from pycroft.model import session
 from pycroft.model.finance import (
-    Account, BankAccount, BankAccountActivity, Transaction)
+    Account, AccountBalance, BankAccount, BankAccountActivity, MembershipFee,
+    Transaction)
+from pycroft.model.logging import UserLogEntry
 from pycroft.model.user import PropertyGroup, User, Membership
-from tests import FixtureDataTestBase
+from tests import FactoryDataTestBase, FixtureDataTestBase
+from tests.factories import (
+    ConfigFactory, MembershipFactory, PropertyGroupFactory, UserFactory)
 from tests.fixtures.config import ConfigData, PropertyGroupData, PropertyData
 from tests.lib.finance_fixtures import (
     AccountData, BankAccountData, MembershipData, UserData,
@@ -94,6 +101,19 @@ class Test_010_BankAccount(FixtureDataTestBase):
         BankAccountActivity.q.delete()
         session.session.commit()
 
+    def test_0015_reimport_bank_account_csv(self):
+        data = pkgutil.get_data(__package__, "data_test_finance.csv")
+
+        import_bank_account_activities_csv(
+            StringIO(data.decode('utf-8')), Decimal('43.42'), date(2015, 1, 1))
+        count = BankAccountActivity.q.count()
+        import_bank_account_activities_csv(
+            StringIO(data.decode('utf-8')), Decimal('43.42'), date(2015, 1, 2))
+        self.assertEqual(BankAccountActivity.q.count(), count)
+
+        BankAccountActivity.q.delete()
+        session.session.commit()
+
     def test_0020_get_last_applied_membership_fee(self):
         try:
             get_last_applied_membership_fee()
@@ -153,6 +173,53 @@ class Test_010_BankAccount(FixtureDataTestBase):
         Transaction.q.delete()
         session.session.commit()
 
+    def test_0040_verify_account_balances(self):
+        simple_transaction(
+            u"transaction", self.fee_account, self.user_account,
+            Decimal(90), self.author
+        )
+        self.assertEqual(verify_account_balances(), [])
+        AccountBalance.q.filter_by(account_id=self.user_account.id).update(
+            {'balance': Decimal(0)})
+        drifts = verify_account_balances(repair=True)
+        self.assertEqual([(d.account_id, d.stored, d.actual) for d in drifts],
+                         [(self.user_account.id, 0, 90)])
+        self.assertEqual(verify_account_balances(), [])
+        self.assertEqual(self.user_account.balance, 90)
+        Transaction.q.delete()
+        session.session.commit()
+
+    def test_0045_process_transactions(self):
+        bank_account = BankAccount.q.filter_by(
+            iban=BankAccountData.dummy.iban).one()
+
+        def statement_line(amount, purpose, date):
+            return SimpleNamespace(data={
+                'applicant_iban': None, 'applicant_bin': None,
+                'applicant_name': u"Name", 'purpose': purpose,
+                'amount': SimpleNamespace(amount=amount),
+                'entry_date': date, 'date': date,
+            })
+
+        statement = [statement_line(Decimal('10.00'), u"first",
+                                    date(2018, 1, 1)),
+                     statement_line(Decimal('20.00'), u"second",
+                                    date(2018, 1, 2))]
+        self.assertEqual(process_transactions(bank_account, []), ([], []))
+        new, old = process_transactions(bank_account, statement)
+        self.assertEqual([a.reference for a in new], [u"first", u"second"])
+        self.assertEqual(old, [])
+
+        session.session.add(new[0])
+        session.session.flush()
+        new, old = process_transactions(bank_account, statement)
+        self.assertEqual([a.reference for a in new], [u"second"])
+        self.assertEqual([a.reference for a in old], [u"first"])
+        self.assertEqual(new[0].imported_at, old[0].imported_at)
+
+        BankAccountActivity.q.delete()
+        session.session.commit()
+
     def test_0050_cleanup_non_sepa_description(self):
         non_sepa_description = u"1234-0 Dummy, User, with " \
                                u"a- space at postition 28"
@@ -168,6 +235,67 @@ class Test_010_BankAccount(FixtureDataTestBase):
         self.assertEqual(cleanup_description(sepa_description), clean_sepa_description)
 
 
+class HandlePaymentsInDefaultTestCase(FactoryDataTestBase):
+    def create_factories(self):
+        self.processor = UserFactory(id=0)
+        self.config = ConfigFactory(
+            member_group=PropertyGroupFactory(granted={'membership_fee'}),
+            payment_in_default_group=PropertyGroupFactory(
+                granted={'payment_in_default'}),
+        )
+        today = session.session.query(func.current_date()).scalar()
+        self.fee = MembershipFee(
+            name=u"Fee", regular_fee=Decimal(5),
+            grace_period=timedelta(days=14),
+            payment_deadline=timedelta(days=14),
+            payment_deadline_final=timedelta(days=30),
+            begins_on=today - timedelta(days=60),
+            ends_on=today - timedelta(days=1),
+        )
+        session.session.add(self.fee)
+        # users with debts since 5, 20 and 40 days
+        self.users = UserFactory.create_batch(3)
+        for user, days in zip(self.users, (5, 20, 40)):
+            MembershipFactory(user=user, group=self.config.member_group)
+            simple_transaction(
+                u"Fee", self.config.membership_fee_account, user.account,
+                Decimal(5), self.processor, today - timedelta(days=days))
+
+    def test_dry_run(self):
+        _, in_default, terminated = self.users
+        self.assertEqual(handle_payments_in_default(dry_run=True),
+                         ([in_default, terminated], [terminated]))
+        self.assertFalse(in_default.has_property('payment_in_default'))
+        self.assertEqual(UserLogEntry.q.filter_by(user=terminated).count(), 0)
+
+    def test_handle_payments_in_default(self):
+        not_yet, in_default, terminated = self.users
+        now = session.utcnow()
+        handle_payments_in_default()
+        self.assertFalse(not_yet.has_property('payment_in_default'))
+        self.assertTrue(in_default.has_property('payment_in_default'))
+        self.assertTrue(terminated.has_property('payment_in_default'))
+        self.assertEqual([m.ends_at for m in Membership.q.filter_by(
+            user=terminated, group=self.config.member_group)], [now])
+        # added, removed and the termination itself
+        self.assertEqual(UserLogEntry.q.filter_by(user=terminated).count(), 3)
+        # users already in default are not added again
+        self.assertEqual(handle_payments_in_default(dry_run=True),
+                         ([], [terminated]))
+
+    def test_end_payment_in_default_memberships(self):
+        _, in_default, _ = self.users
+        handle_payments_in_default()
+        simple_transaction(
+            u"Payment", in_default.account,
+            self.config.membership_fee_account, Decimal(5), self.processor)
+        self.assertEqual(end_payment_in_default_memberships(dry_run=True),
+                         [in_default])
+        self.assertTrue(in_default.has_property('payment_in_default'))
+        end_payment_in_default_memberships()
+        self.assertFalse(in_default.has_property('payment_in_default'))
+
+
 # TODO: Rework tests for new membership fee implementation
 '''
 class FeeTestBase(FixtureDataTestBase):
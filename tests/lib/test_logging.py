@@ -3,10 +3,10 @@
 # the Apache License, Version 2.0. See the LICENSE file for details.
 from datetime import timedelta
 
-from pycroft.lib.logging import log_user_event, log_room_event
+from pycroft.lib.logging import log_user_event, log_user_events, log_room_event
 from pycroft.model import session
 from pycroft.model.facilities import Room
-from pycroft.model.logging import RoomLogEntry, LogEntry
+from pycroft.model.logging import RoomLogEntry, LogEntry, UserLogEntry
 from pycroft.model.user import User
 from tests import FixtureDataTestBase
 from tests.fixtures.dummy.facilities import RoomData
@@ -66,3 +66,17 @@ class Test_020_RoomLogEntry(LogTestBase):
         session.session.delete(db_room_log_entry)
         session.session.commit()
         self.assertIsNone(LogEntry.q.get(db_room_log_entry.id))
+
+
+class Test_030_BulkUserLogEntries(LogTestBase):
+    datasets = [UserData]
+
+    def test_0010_create_user_log_entries(self):
+        users = User.q.all()
+        count = log_user_events(message=self.message, author=self.user,
+                                user_ids=[u.id for u in users])
+        self.assertEqual(count, len(users))
+        for user in users:
+            [entry] = UserLogEntry.q.filter_by(user=user).all()
+            self.assertEqual(entry.message, self.message)
+            self.assertEqual(entry.author, self.user)
@@ -3,12 +3,22 @@
 # the Apache License, Version 2.0. See the LICENSE file for details.
 from datetime import timedelta
 
-from pycroft.helpers.interval import IntervalSet ,UnboundedInterval, closed
+from sqlalchemy import select
+
+from pycroft.helpers.interval import IntervalSet ,UnboundedInterval, closed, \
+    closedopen
 from pycroft.lib.membership import grant_property, deny_property, \
-    remove_property, make_member_of, remove_member_of
+    remove_property, make_member_of, remove_member_of, make_members_of, \
+    remove_members_of, overlapping_memberships, \
+    membership_boundary_hooks, next_membership_boundary, \
+    process_membership_boundaries, users_with_membership_boundaries
+from pycroft.model.property import current_property
+from pycroft.model.logging import UserLogEntry
 from pycroft.model.user import Membership, Property, PropertyGroup, User
 from pycroft.model import session
-from tests import FixtureDataTestBase
+from tests import FactoryDataTestBase, FixtureDataTestBase
+from tests.factories.property import MembershipFactory, PropertyGroupFactory
+from tests.factories.user import UserFactory
 from tests.fixtures.dummy.property import PropertyGroupData, PropertyData
 from tests.fixtures.dummy.user import UserData
 
@@ -86,6 +96,86 @@ class Test_030_Membership(FixtureDataTestBase):
             (closed(t0, t1), closed(t4, t5))))
 
 
+class BulkMembershipTestCase(FactoryDataTestBase):
+    def create_factories(self):
+        self.t0 = session.utcnow()
+        self.t = [self.t0 + timedelta(hours=i) for i in range(6)]
+        self.group = PropertyGroupFactory()
+        self.processor = UserFactory()
+        self.users = UserFactory.create_batch(3)
+        first, second, _ = self.users
+        MembershipFactory(user=first, group=self.group,
+                          begins_at=self.t[0], ends_at=self.t[2])
+        MembershipFactory(user=first, group=self.group,
+                          begins_at=self.t[3], ends_at=self.t[5])
+        MembershipFactory(user=second, group=self.group,
+                          begins_at=self.t[1], ends_at=None)
+
+    def membership_intervals(self, user):
+        return IntervalSet(
+            closed(m.begins_at, m.ends_at) for m in
+            Membership.q.filter_by(user=user, group=self.group))
+
+    def log_entry_count(self, user):
+        return UserLogEntry.q.filter_by(user=user).count()
+
+    def test_make_members_of(self):
+        make_members_of(self.users, self.group, self.processor,
+                        closed(self.t[1], self.t[4]))
+        first, second, third = self.users
+        self.assertEqual(self.membership_intervals(first),
+                         IntervalSet(closed(self.t[0], self.t[5])))
+        self.assertEqual(self.membership_intervals(second),
+                         IntervalSet(closed(self.t[1], None)))
+        self.assertEqual(self.membership_intervals(third),
+                         IntervalSet(closed(self.t[1], self.t[4])))
+        self.assertEqual(Membership.q.filter_by(user=first).count(), 1)
+        for user in self.users:
+            self.assertEqual(self.log_entry_count(user), 1)
+
+    def test_make_members_of_unbounded(self):
+        make_members_of(self.users[:1], self.group, self.processor)
+        self.assertEqual(self.membership_intervals(self.users[0]),
+                         IntervalSet(UnboundedInterval))
+
+    def test_remove_members_of(self):
+        remove_members_of(self.users, self.group, self.processor,
+                          closed(self.t[1], self.t[4]))
+        first, second, third = self.users
+        self.assertEqual(self.membership_intervals(first), IntervalSet(
+            (closed(self.t[0], self.t[1]), closed(self.t[4], self.t[5]))))
+        self.assertEqual(self.membership_intervals(second),
+                         IntervalSet(closed(self.t[4], None)))
+        self.assertEqual(self.membership_intervals(third), IntervalSet())
+        for user in self.users:
+            self.assertEqual(self.log_entry_count(user), 1)
+
+    def test_terminate_memberships(self):
+        remove_members_of(self.users, self.group, self.processor,
+                          closedopen(self.t[2], None))
+        first, second, _ = self.users
+        self.assertEqual(self.membership_intervals(first),
+                         IntervalSet(closed(self.t[0], self.t[2])))
+        self.assertEqual(self.membership_intervals(second),
+                         IntervalSet(closed(self.t[1], self.t[2])))
+
+    def test_remove_all_memberships(self):
+        remove_members_of(self.users, self.group, self.processor)
+        for user in self.users:
+            self.assertEqual(self.membership_intervals(user), IntervalSet())
+
+    def test_overlapping_memberships(self):
+        first = self.users[0]
+        earlier, later = Membership.q.filter_by(
+            user=first, group=self.group).order_by(Membership.begins_at)
+        self.assertEqual(
+            overlapping_memberships(earlier, closed(self.t[0], self.t[3])),
+            [later])
+        self.assertEqual(
+            overlapping_memberships(earlier, closed(self.t[0], self.t[2])),
+            [])
+
+
 class Test_040_Property(FixtureDataTestBase):
     datasets = [PropertyGroupData, PropertyData]
 
@@ -134,3 +224,67 @@ class Test_040_Property(FixtureDataTestBase):
     def test_0035_remove_wrong_property(self):
         self.assertRaises(ValueError, remove_property, self.group,
                           "non_existent_property")
+
+
+class MembershipBoundaryTestCase(FactoryDataTestBase):
+    def create_factories(self):
+        self.now = session.utcnow()
+        self.group = PropertyGroupFactory(granted={'mail'})
+        self.beginning = MembershipFactory(
+            group=self.group, begins_at=self.now + timedelta(hours=1))
+        self.ending = MembershipFactory(
+            group=self.group, begins_at=self.now - timedelta(days=1),
+            ends_at=self.now + timedelta(hours=2))
+        self.unbounded = MembershipFactory(group=self.group)
+
+    def test_users_with_boundaries(self):
+        after = self.now
+        self.assertEqual(users_with_membership_boundaries(
+            after, after + timedelta(minutes=30)), set())
+        self.assertEqual(users_with_membership_boundaries(
+            after, after + timedelta(hours=1)), {self.beginning.user_id})
+        self.assertEqual(users_with_membership_boundaries(
+            after, after + timedelta(hours=3)),
+            {self.beginning.user_id, self.ending.user_id})
+
+    def test_ending_reported_once_passed(self):
+        ends_at = self.ending.ends_at
+        self.assertEqual(users_with_membership_boundaries(
+            self.now + timedelta(hours=1), ends_at), set())
+        self.assertEqual(users_with_membership_boundaries(
+            ends_at, ends_at + timedelta(seconds=1)), {self.ending.user_id})
+
+    def test_next_boundary(self):
+        self.assertEqual(next_membership_boundary(self.now),
+                         self.beginning.begins_at)
+        self.assertEqual(next_membership_boundary(self.beginning.begins_at),
+                         self.ending.ends_at)
+        self.assertIsNone(next_membership_boundary(
+            self.now + timedelta(hours=3)))
+
+    def test_hooks_called_with_affected_users(self):
+        calls = []
+        membership_boundary_hooks.append(calls.append)
+        try:
+            user_ids = process_membership_boundaries(
+                self.now, self.now + timedelta(hours=1))
+        finally:
+            membership_boundary_hooks.remove(calls.append)
+        self.assertEqual(user_ids, {self.beginning.user_id})
+        self.assertEqual(calls, [{self.beginning.user_id}])
+
+    def test_properties_refreshed(self):
+        user = self.ending.user
+        # simulate state that went stale while the membership was active
+        session.session.execute(current_property.delete()
+                                .where(current_property.c.user_id == user.id))
+        process_membership_boundaries(self.now, self.now + timedelta(hours=1))
+        self.assertEqual(self.current_property_names(user), set())
+        process_membership_boundaries(self.now - timedelta(days=2), self.now)
+        self.assertEqual(self.current_property_names(user), {'mail'})
+
+    @staticmethod
+    def current_property_names(user):
+        return {name for name, in session.session.execute(
+            select([current_property.c.property_name])
+            .where(current_property.c.user_id == user.id))}
@@ -2,16 +2,23 @@
 # This file is part of the Pycroft project and licensed under the terms of
 # the Apache License, Version 2.0. See the LICENSE file for details.
 import unittest
-from datetime import datetime
+from datetime import datetime, timezone
 
-from sqlalchemy import not_, or_
+from sqlalchemy import and_, func, literal, literal_column, not_, or_, select
 
 from pycroft import config
-from pycroft.lib.traffic import sync_exceeded_traffic_limits
+from pycroft.lib.traffic import checkpoint_traffic_balances, \
+    create_traffic_volume_partitions, fold_traffic_volumes, \
+    grant_regular_credits, ingest_pmacct_records, sync_exceeded_traffic_limits, PmacctRecord, \
+    top_traffic_consumers
 from pycroft.model.host import IP
 from pycroft.model.traffic import TrafficBalance, TrafficCredit, TrafficVolume, \
-    CurrentTrafficBalance
-from tests import FixtureDataTestBase
+    CurrentTrafficBalance, MonthlyTrafficVolume, DailyTraffic
+from tests import FactoryDataTestBase, FixtureDataTestBase
+from tests.factories import UserFactory, UserWithHostFactory
+from tests.factories.property import MembershipFactory
+from tests.factories.traffic import TrafficCreditFactory, TrafficGroupFactory, \
+    TrafficVolumeFactory
 from tests.fixtures.config import ConfigData, PropertyGroupData, PropertyData
 from tests.fixtures.dummy.traffic import (TrafficVolumeData, TrafficBalanceData,
                                           TrafficCreditData)
@@ -19,8 +26,10 @@ from tests.fixtures.dummy.host import IPData, HostData, InterfaceData
 from tests.fixtures.dummy.user import UserData
 
 from pycroft.model import session
-from pycroft.model.user import User
-from pycroft.lib.user import traffic_history
+from pycroft.model.logging import UserLogEntry
+from pycroft.model.types import DateTimeTz
+from pycroft.model.user import Membership, TrafficGroup, User
+from pycroft.lib.user import traffic_history, traffic_histories
 
 from datetime import timedelta
 
@@ -68,6 +77,32 @@ class Test_010_BalanceCalculation(FixtureDataTestBase):
                           self.correct_balance.items()]
         self.assertEqual(set(correct_values), set(expr_values))
 
+    def test_0020_expr_users(self):
+        args = (session.utcnow(), timedelta(hours=2), timedelta(minutes=30))
+        rows = session.session.execute(
+            select([literal_column('user_id'), literal_column('balance')])
+            .select_from(func.traffic_histories(
+                [u.id for u in self.users], *args))
+        ).fetchall()
+        self.assertEqual(
+            sorted(rows),
+            sorted((user.id, e.balance) for user in self.users
+                   for e in traffic_history(user.id, *args)))
+
+    def test_0030_users_wrapper(self):
+        args = (session.utcnow(), timedelta(hours=2), timedelta(minutes=30))
+        histories = dict(traffic_histories([u.id for u in self.users], *args))
+        self.assertEqual(set(histories), {u.id for u in self.users})
+        for user in self.users:
+            self.assertEqual(
+                [e.__dict__ for e in histories[user.id]],
+                [e.__dict__ for e in traffic_history(user.id, *args)])
+
+    def test_0040_no_users(self):
+        self.assertEqual(list(traffic_histories([], session.utcnow(),
+                                                timedelta(hours=2),
+                                                timedelta(minutes=30))), [])
+
 
 class Test_020_TrafficLimitExceeded(FixtureDataTestBase):
     datasets = [UserData, ConfigData, TrafficVolumeData, TrafficBalanceData,
@@ -101,3 +136,270 @@ class Test_020_TrafficLimitExceeded(FixtureDataTestBase):
 
         sync_exceeded_traffic_limits()
         self.assertFalse(self.user.has_property('traffic_limit_exceeded'))
+
+    def test_0030_traffic_limit_exceeded_counts(self):
+        session.session.add(TrafficVolume(
+            ip=IP.q.filter(IP.address == '192.168.0.42').one(),
+            user=self.user,
+            type="Ingress",
+            amount=int(500 * 1024 ** 3),
+            packets=int(7600),
+            timestamp=datetime.utcnow()
+        ))
+        result = sync_exceeded_traffic_limits()
+        self.assertEqual((result['added'], result['ended']), (1, 0))
+        self.assertEqual(set(result['timings']), {'add', 'end'})
+        self.assertEqual(UserLogEntry.q.filter_by(user=self.user).count(), 1)
+
+        self.assertEqual(sync_exceeded_traffic_limits()['added'], 0)
+
+    def test_0040_overlapping_membership_not_duplicated(self):
+        group = config.traffic_limit_exceeded_group
+        MembershipFactory.create(
+            user=self.user, group=group,
+            begins_at=session.utcnow() + timedelta(days=1))
+        session.session.add(TrafficVolume(
+            ip=IP.q.filter(IP.address == '192.168.0.42').one(),
+            user=self.user,
+            type="Ingress",
+            amount=int(500 * 1024 ** 3),
+            packets=int(7600),
+            timestamp=datetime.utcnow()
+        ))
+        self.assertEqual(sync_exceeded_traffic_limits()['added'], 0)
+        self.assertEqual(Membership.q.filter_by(user=self.user,
+                                                group=group).count(), 1)
+
+    def test_0050_future_memberships_removed(self):
+        group = config.traffic_limit_exceeded_group
+        now = session.utcnow()
+        MembershipFactory.create(user=self.user, group=group,
+                                 begins_at=now - timedelta(days=1),
+                                 ends_at=now + timedelta(hours=1))
+        MembershipFactory.create(user=self.user, group=group,
+                                 begins_at=now + timedelta(days=2))
+        self.assertEqual(sync_exceeded_traffic_limits()['ended'], 1)
+        [membership] = Membership.q.filter_by(user=self.user,
+                                              group=group).all()
+        self.assertEqual(membership.ends_at, now)
+
+
+class CheckpointTrafficBalancesTestCase(FactoryDataTestBase):
+    def create_factories(self):
+        self.now = session.utcnow()
+        self.user = UserWithHostFactory()
+        ip = self.user.hosts[0].interfaces[0].ips[0]
+        for delta in range(4):
+            TrafficCreditFactory.create(timestamp=self.now - timedelta(delta),
+                                        amount=3*1024**3, user=self.user)
+            TrafficVolumeFactory.create(timestamp=self.now - timedelta(delta),
+                                        amount=1024**3, user=self.user, ip=ip)
+        self.idle_user = UserFactory()
+
+    def history(self):
+        return [(e.timestamp, e.balance) for e in traffic_history(
+            self.user.id, self.now - timedelta(3), timedelta(4), timedelta(1))]
+
+    def test_balances_rolled_forward(self):
+        history = self.history()
+        cutoff = self.now - timedelta(1)
+
+        self.assertEqual(checkpoint_traffic_balances(cutoff), 1)
+
+        balance = TrafficBalance.q.get(self.user.id)
+        self.assertEqual(balance.timestamp, cutoff)
+        self.assertEqual(balance.amount, 2 * 2*1024**3)
+        self.assertIsNone(TrafficBalance.q.get(self.idle_user.id))
+        self.assertEqual(self.user.current_credit, 8*1024**3)
+        self.assertEqual(self.history(), history)
+
+    def test_newer_balances_are_kept(self):
+        checkpoint_traffic_balances(self.now)
+        self.assertEqual(checkpoint_traffic_balances(self.now - timedelta(2)), 0)
+        self.assertEqual(TrafficBalance.q.get(self.user.id).timestamp, self.now)
+
+
+class TrafficVolumePartitionTestCase(FactoryDataTestBase):
+    def create_factories(self):
+        self.now = session.utcnow()
+        self.user = UserWithHostFactory()
+        ip = self.user.hosts[0].interfaces[0].ips[0]
+        self.recent = TrafficVolumeFactory.create(
+            timestamp=self.now, amount=1024, user=self.user, ip=ip)
+        self.old = TrafficVolumeFactory.create(
+            timestamp=self.now - timedelta(days=500), amount=2048,
+            packets=10, type='Egress', user=self.user, ip=ip)
+
+    def partition_of(self, volume):
+        return session.session.execute(
+            select([literal_column('tableoid::regclass::text')])
+            .select_from(TrafficVolume.__table__)
+            .where(and_(TrafficVolume.ip_id == volume.ip_id,
+                        TrafficVolume.type == volume.type,
+                        TrafficVolume.timestamp == volume.timestamp))
+        ).scalar()
+
+    def test_partition_creation_moves_volumes(self):
+        self.assertEqual(self.partition_of(self.recent),
+                         'traffic_volume_default')
+        create_traffic_volume_partitions()
+        self.assertEqual(self.partition_of(self.recent),
+                         'traffic_volume_{:%Y_%m}'.format(self.now))
+        self.assertEqual(self.user.current_credit, -3072)
+
+    def test_fold_old_volumes(self):
+        fold_traffic_volumes(12)
+        self.assertIsNone(self.partition_of(self.old))
+        self.assertIsNotNone(self.partition_of(self.recent))
+        monthly = MonthlyTrafficVolume.q.filter_by(user=self.user).one()
+        self.assertEqual((monthly.type, monthly.amount, monthly.packets),
+                         ('Egress', 2048, 10))
+        self.assertEqual(self.user.current_credit, -3072)
+
+    def test_fold_keeps_daily_traffic(self):
+        cutoff = fold_traffic_volumes(12)
+        daily = DailyTraffic.q.filter(DailyTraffic.user_id == self.user.id,
+                                      DailyTraffic.day < cutoff).one()
+        self.assertEqual((daily.ingress, daily.egress), (0, 2048))
+
+
+class PmacctIngestionTestCase(FactoryDataTestBase):
+    ip = '141.30.228.39'
+
+    def create_factories(self):
+        self.user = UserWithHostFactory(host__interface__ip__str_address=self.ip)
+
+    def test_records_aggregated(self):
+        day = datetime(2018, 3, 15)
+        records = [
+            PmacctRecord('Egress', self.ip, day.replace(hour=0, minute=15), 1024, 200),
+            PmacctRecord('Egress', self.ip, day.replace(hour=23, minute=59), 7055, 12),
+            PmacctRecord('Ingress', self.ip, day.replace(hour=10), 500, 324),
+            PmacctRecord('Ingress', '1.1.1.1', day, 500, 324),
+        ]
+        self.assertEqual(ingest_pmacct_records(records), 3)
+
+        volumes = {v.type: v for v in TrafficVolume.q.all()}
+        self.assertEqual(set(volumes), {'Egress', 'Ingress'})
+        self.assertEqual((volumes['Egress'].amount, volumes['Egress'].packets),
+                         (8079, 212))
+        self.assertEqual((volumes['Ingress'].amount, volumes['Ingress'].packets),
+                         (500, 324))
+        self.assertEqual(volumes['Egress'].user, self.user)
+
+    def test_batches_upserted(self):
+        record = PmacctRecord('Egress', self.ip, datetime(2018, 3, 15), 1024, 20)
+        ingest_pmacct_records([record])
+        ingest_pmacct_records([record, record])
+        volume = TrafficVolume.q.one()
+        self.assertEqual((volume.amount, volume.packets), (3072, 60))
+
+
+class GrantRegularCreditsTestCase(FactoryDataTestBase):
+    def create_factories(self):
+        self.small_group = TrafficGroupFactory(credit_amount=1024)
+        self.big_group = TrafficGroupFactory(credit_amount=4096)
+        self.user = UserFactory()
+        for group in (self.small_group, self.big_group):
+            MembershipFactory(user=self.user, group=group)
+        self.other_user = UserFactory()
+        MembershipFactory(user=self.other_user, group=self.small_group)
+        self.user_without_group = UserFactory()
+
+    def credits_of(self, user):
+        return [c.amount for c in TrafficCredit.q.filter_by(user=user)]
+
+    def test_effective_group_credited(self):
+        self.assertEqual(grant_regular_credits(), 2)
+        self.assertEqual(self.credits_of(self.user), [4096])
+        self.assertEqual(self.credits_of(self.other_user), [1024])
+        self.assertEqual(self.credits_of(self.user_without_group), [])
+
+    def test_idempotent_within_period(self):
+        now = session.utcnow()
+        grant_regular_credits(now)
+        self.assertEqual(grant_regular_credits(now), 0)
+        self.assertEqual(self.credits_of(self.user), [4096])
+        self.assertEqual(grant_regular_credits(now + timedelta(days=1)), 2)
+        self.assertEqual(self.credits_of(self.user), [4096, 4096])
+
+    def credit_timestamps_of(self, user):
+        return [c.timestamp for c in TrafficCredit.q.filter_by(user=user)]
+
+    def test_weekly_periods_start_on_monday(self):
+        self.big_group.credit_interval = timedelta(weeks=1)
+        session.session.flush()
+        # a Thursday
+        grant_regular_credits(datetime(2018, 3, 15, 12, tzinfo=timezone.utc))
+        self.assertEqual(self.credit_timestamps_of(self.user),
+                         [datetime(2018, 3, 12, tzinfo=timezone.utc)])
+
+    def test_monthly_periods_start_on_first_day(self):
+        session.session.execute(TrafficGroup.__table__.update().where(
+            TrafficGroup.id == self.big_group.id
+        ).values(credit_interval=literal_column("interval '1 month'")))
+        when = datetime(2018, 3, 15, 12, tzinfo=timezone.utc)
+        grant_regular_credits(when)
+        month_start = session.session.query(
+            func.date_trunc('month', literal(when, DateTimeTz))).scalar()
+        self.assertEqual(self.credit_timestamps_of(self.user), [month_start])
+
+
+class TopTrafficConsumersTestCase(FactoryDataTestBase):
+    def create_factories(self):
+        self.day = datetime(2018, 3, 15, tzinfo=timezone.utc)
+        self.users = UserWithHostFactory.create_batch(3)
+        self.ips = [u.hosts[0].interfaces[0].ips[0] for u in self.users]
+        for amount, user, ip in zip([3000, 1000, 2000], self.users, self.ips):
+            TrafficVolumeFactory.create(timestamp=self.day, amount=amount,
+                                        type='Egress', user=user, ip=ip)
+        # Outside of the window or of the other direction
+        TrafficVolumeFactory.create(timestamp=self.day - timedelta(days=7),
+                                    amount=10000, type='Egress',
+                                    user=self.users[1], ip=self.ips[1])
+        TrafficVolumeFactory.create(timestamp=self.day, amount=10000,
+                                    type='Ingress', user=self.users[1],
+                                    ip=self.ips[1])
+
+    def top(self, **kwargs):
+        kwargs.setdefault('limit', 2)
+        return top_traffic_consumers(self.day - timedelta(days=1),
+                                     self.day + timedelta(days=1), **kwargs)
+
+    def test_by_user(self):
+        self.assertEqual(self.top(),
+                         [(self.users[0], 3000), (self.users[2], 2000)])
+
+    def test_by_host(self):
+        self.assertEqual(self.top(by='host'),
+                         [(self.users[0].hosts[0], 3000),
+                          (self.users[2].hosts[0], 2000)])
+
+    def test_by_ip(self):
+        self.assertEqual(self.top(by='ip', type='Ingress'),
+                         [(self.ips[1], 10000)])
+
+    def test_by_building(self):
+        building = self.users[1].room.building
+        self.assertEqual(self.top(building=building),
+                         [(self.users[1], 1000)])
+
+    def test_by_subnet(self):
+        subnet = self.ips[2].subnet
+        self.assertEqual(self.top(subnet=subnet), [(self.users[2], 2000)])
+
+    def test_window_extended_to_days(self):
+        start = self.day + timedelta(hours=12)
+        end = start + timedelta(hours=1)
+        self.assertEqual(
+            top_traffic_consumers(start, end, limit=1),
+            [(self.users[0], 3000)])
+        self.assertEqual(
+            top_traffic_consumers(start, end, by='host', limit=1),
+            [(self.users[0].hosts[0], 3000)])
+
+    def test_invalid_arguments(self):
+        with self.assertRaises(ValueError):
+            self.top(type='Both')
+        with self.assertRaises(ValueError):
+            self.top(by='room')
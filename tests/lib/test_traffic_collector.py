@@ -0,0 +1,87 @@
+# Copyright (c) 2018 The Pycroft Authors. See the AUTHORS file.
+# This file is part of the Pycroft project and licensed under the terms of
+# the Apache License, Version 2.0. See the LICENSE file for details.
+import asyncio
+import json
+import unittest
+from datetime import datetime, timezone
+
+from pycroft.lib.traffic import PmacctRecord
+from pycroft.lib.traffic_collector import TrafficCollector, parse_pmacct_line
+
+
+class ParsePmacctLineTestCase(unittest.TestCase):
+    def test_egress_record(self):
+        line = ('{"ip_src": "141.30.228.39", "packets": 20, "bytes": 1024, '
+                '"stamp_inserted": "2018-03-15 10:15:00"}')
+        self.assertEqual(parse_pmacct_line(line), [PmacctRecord(
+            'Egress', '141.30.228.39',
+            datetime(2018, 3, 15, 10, 15).astimezone(timezone.utc), 1024, 20
+        )])
+
+    def test_ingress_record(self):
+        line = '{"ip_dst": "141.30.228.39", "packets": 20, "bytes": 1024}'
+        [record] = parse_pmacct_line(line)
+        self.assertEqual((record.type, record.address), ('Ingress', '141.30.228.39'))
+        self.assertEqual(record.stamp.tzinfo, timezone.utc)
+
+    def test_invalid_record(self):
+        for line in ('{"ip_dst": "141.30.228.39"}', 'not json'):
+            with self.assertRaises(ValueError):
+                parse_pmacct_line(line)
+
+    def test_invalid_address(self):
+        for address in ('141.30.228.390', 'localhost', ''):
+            line = json.dumps({'ip_src': '141.30.228.39', 'ip_dst': address,
+                               'packets': 20, 'bytes': 1024})
+            with self.assertRaises(ValueError):
+                parse_pmacct_line(line)
+
+
+class TrafficCollectorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.collector = TrafficCollector(max_buffer_size=10, loop=self.loop)
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    def test_records_aggregated(self):
+        stamp = datetime(2018, 3, 15, 10, 15)
+        self.collector.add([
+            PmacctRecord('Egress', '141.30.228.39', stamp, 1024, 20),
+            PmacctRecord('Egress', '141.30.228.39', stamp.replace(hour=23), 1024, 20),
+            PmacctRecord('Ingress', '141.30.228.39', stamp, 1024, 20),
+        ])
+        self.assertEqual(self.collector.records_received, 3)
+        self.assertEqual(self.collector.buffer_size, 2)
+        self.assertEqual(
+            self.collector.aggregate[('Egress', '141.30.228.39',
+                                      datetime(2018, 3, 15))],
+            [2048, 40])
+
+    def test_consume_skips_invalid_lines(self):
+        reader = asyncio.StreamReader()
+        reader.feed_data(b'{"ip_src": "10.0.0.1", "packets": 1, "bytes": 2}\n'
+                         b'garbage\n\n')
+        reader.feed_eof()
+        self.loop.run_until_complete(self.collector.consume(reader))
+        self.assertEqual(self.collector.records_received, 1)
+
+    def test_buffer_size_bounded(self):
+        stamp = datetime(2018, 3, 15, 10, 15, tzinfo=timezone.utc)
+        written = []
+        self.collector._write = written.append
+        self.collector.add(PmacctRecord('Egress', '10.0.0.{}'.format(i),
+                                        stamp, 1, 1)
+                           for i in range(12))
+        self.assertEqual(self.collector.buffer_size, 10)
+        self.assertEqual(self.collector.volumes_dropped, 2)
+        pending_flush = self.collector._pending_flush
+        self.collector.add([PmacctRecord('Egress', '10.0.0.1', stamp, 1, 1)])
+        self.assertIs(self.collector._pending_flush, pending_flush)
+        self.loop.run_until_complete(pending_flush)
+        self.assertEqual(len(written), 1)
+        self.assertEqual(self.collector.buffer_size, 0)
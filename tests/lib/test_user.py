@@ -14,7 +14,8 @@ from pycroft.lib import user as UserHelper, traffic, membership
 from pycroft.model import (
     user, facilities, session, logging, finance, host)
 from tests import FactoryDataTestBase
-from tests.factories import UserFactory, MembershipFactory, TrafficGroupFactory
+from tests.factories import UserFactory, MembershipFactory, TrafficGroupFactory, \
+    PropertyGroupFactory
 from tests.fixtures import network_access
 from tests.fixtures.config import ConfigData, PropertyData
 from tests.fixtures.dummy.facilities import BuildingData, RoomData
@@ -449,3 +450,60 @@ class GrantingTestCase(FactoryDataTestBase):
         self.assertEqual(len(user.traffic_credits), 1)
         credit = user.traffic_credits[0]
         self.assertEqual(credit.amount, self.traffic_groups[0].credit_amount)
+
+
+class StatusQueryTestCase(FactoryDataTestBase):
+    def create_factories(self):
+        self.group = PropertyGroupFactory(granted={'network_access', 'ldap'},
+                                          denied={'violation'})
+        self.user = UserFactory()
+        MembershipFactory.create(
+            user=self.user, group=self.group,
+            begins_at=session.utcnow() - timedelta(days=1))
+        self.other_user = UserFactory()
+        self.user_ids = [self.user.id, self.other_user.id]
+
+    def test_property_set(self):
+        self.assertEqual(self.user.property_set,
+                         frozenset({'network_access', 'ldap'}))
+        self.assertEqual(self.other_user.property_set, frozenset())
+
+    def test_property_set_expression(self):
+        query = session.session.query(user.User.id).filter(
+            user.User.id.in_(self.user_ids))
+        self.assertEqual(
+            query.filter(user.User.property_set.contains(['ldap'])).all(),
+            [(self.user.id,)])
+        self.assertEqual(
+            query.filter(user.User.property_set.overlap(['violation'])).all(),
+            [])
+
+    def test_status_query(self):
+        rows = {row.User.id: row for row in UserHelper.status_query()
+                .filter(user.User.id.in_(self.user_ids))}
+        self.assertEqual(set(rows), set(self.user_ids))
+        status = rows[self.user.id]
+        self.assertTrue(status.network_access)
+        self.assertTrue(status.ldap)
+        self.assertFalse(status.violation)
+        self.assertFalse(status.admin)
+        status = rows[self.other_user.id]
+        self.assertFalse(status.network_access)
+        self.assertFalse(status.ldap)
+
+    def test_statuses(self):
+        statuses = UserHelper.statuses(self.user_ids)
+        self.assertEqual(set(statuses), set(self.user_ids))
+        self.assertEqual(set(statuses[self.user.id]),
+                         set(UserHelper.status_flags))
+        self.assertEqual(UserHelper.status(self.user),
+                         statuses[self.user.id])
+        self.assertFalse(statuses[self.user.id].traffic_exceeded)
+
+    def test_status_after_membership_ended_now(self):
+        membership.remove_member_of(self.user, self.group, self.other_user,
+                                    closedopen(session.utcnow(), None))
+        session.session.flush()
+        status = UserHelper.status(self.user)
+        self.assertFalse(status.network_access)
+        self.assertFalse(status.ldap)
@@ -3,10 +3,12 @@ import unittest
 from sqlalchemy import PrimaryKeyConstraint, Table, Column, Integer, MetaData, \
     select, text, util
 from sqlalchemy.dialects import postgresql
+from sqlalchemy.schema import CreateTable
 
 from pycroft.model.ddl import DropConstraint, CreateFunction, DropFunction, \
     Function, View, CreateView, DropView, Rule, CreateRule, ConstraintTrigger, \
-    CreateConstraintTrigger, Trigger, CreateTrigger
+    CreateConstraintTrigger, Trigger, CreateTrigger, Partition, \
+    CreatePartition, DropPartition
 
 from sqlalchemy.sql import sqltypes
 import sqlalchemy.dialects.postgresql.base as postgresql_base
@@ -255,3 +257,38 @@ class ViewTest(DDLTest):
         stmt = DropView(view, cascade=True)
         self.assertEqual('DROP VIEW view CASCADE',
                          literal_compile(stmt))
+
+
+class PartitionTest(DDLTest):
+    def test_create_partitioned_table(self):
+        table = Table("test", MetaData(), Column("id", Integer),
+                      info={'partition_by': 'RANGE (id)'})
+        stmt = CreateTable(table)
+        self.assertEqual('CREATE TABLE test (id INTEGER) PARTITION BY RANGE (id)',
+                         ' '.join(literal_compile(stmt).split()))
+
+    def test_create_plain_table(self):
+        stmt = CreateTable(create_table("test"))
+        self.assertEqual('CREATE TABLE test (id INTEGER)',
+                         ' '.join(literal_compile(stmt).split()))
+
+    def test_create_partition(self):
+        partition = Partition("test_1", create_table("test"),
+                              "FROM (0) TO (10)")
+        stmt = CreatePartition(partition)
+        self.assertEqual('CREATE TABLE test_1 PARTITION OF test '
+                         'FOR VALUES FROM (0) TO (10)',
+                         literal_compile(stmt))
+
+    def test_create_default_partition_if_not_exists(self):
+        partition = Partition("test_default", create_table("test"))
+        stmt = CreatePartition(partition, if_not_exists=True)
+        self.assertEqual('CREATE TABLE IF NOT EXISTS test_default '
+                         'PARTITION OF test DEFAULT',
+                         literal_compile(stmt))
+
+    def test_drop_partition(self):
+        partition = Partition("test_1", create_table("test"))
+        stmt = DropPartition(partition, if_exists=True)
+        self.assertEqual('DROP TABLE IF EXISTS test_1',
+                         literal_compile(stmt))
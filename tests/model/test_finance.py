@@ -1,12 +1,14 @@
 # Copyright (c) 2015 The Pycroft Authors. See the AUTHORS file.
 # This file is part of the Pycroft project and licensed under the terms of
 # the Apache License, Version 2.0. See the LICENSE file for details.
-from datetime import datetime
+from datetime import datetime, timedelta
 
+from sqlalchemy import func
 from sqlalchemy.exc import IntegrityError
 
 from pycroft.model.finance import (
-    Account, BankAccount, BankAccountActivity, IllegalTransactionError)
+    Account, BankAccount, BankAccountActivity, IllegalTransactionError,
+    in_default_days_query)
 from pycroft.model.user import User
 from tests import FixtureDataTestBase, PostgreSQLTestCase
 from pycroft.model import finance, session
@@ -125,6 +127,109 @@ class TestTransactionSplits(FinanceModelTest):
         self.assertRaises(IllegalTransactionError, session.session.commit)
 
 
+class TestAccountBalance(FinanceModelTest):
+    datasets = (AccountData, UserData)
+
+    def create_balanced_transaction(self, amount):
+        t = self.create_transaction()
+        session.session.add_all([
+            t, self.create_split(t, self.asset_account, amount),
+            self.create_split(t, self.revenue_account, -amount)
+        ])
+        return t
+
+    def test_balance_follows_splits(self):
+        self.assertEqual(self.asset_account.balance, 0)
+        t = self.create_balanced_transaction(100)
+        self.create_balanced_transaction(20)
+        self.assertEqual(self.asset_account.balance, 120)
+        self.assertEqual(self.revenue_account.balance, -120)
+        session.session.delete(t)
+        self.assertEqual(self.asset_account.balance, 20)
+        self.assertEqual(self.revenue_account.balance, -20)
+
+    def test_balance_moved_with_split(self):
+        t = self.create_transaction()
+        split = self.create_split(t, self.asset_account, 100)
+        session.session.add_all([
+            t, split, self.create_split(t, self.revenue_account, -100)])
+        session.session.flush()
+        split.account = self.liability_account
+        self.assertEqual(self.asset_account.balance, 0)
+        self.assertEqual(self.liability_account.balance, 100)
+
+    def test_balance_expression(self):
+        self.create_balanced_transaction(100)
+        session.session.flush()
+        self.assertEqual(
+            Account.q.filter(Account.balance > 0).all(), [self.asset_account])
+
+    def test_balance_of_pending_account(self):
+        account = Account(name=u"pending", type="ASSET")
+        t = finance.Transaction(description=u"Transaction")
+        self.create_split(t, account, 100)
+        self.assertEqual(account.balance, 100)
+
+
+class TestInDefaultDays(FinanceModelTest):
+    datasets = (AccountData, UserData)
+
+    def setUp(self):
+        super(TestInDefaultDays, self).setUp()
+        self.today = session.session.query(func.current_date()).scalar()
+        # The asset account is in default from 30 to 20 days ago and
+        # again since 10 days ago
+        for days, amount in ((30, 100), (20, -100), (10, 50)):
+            t = self.create_transaction()
+            t.valid_on = self.today - timedelta(days=days)
+            session.session.add_all([
+                t, self.create_split(t, self.asset_account, amount),
+                self.create_split(t, self.revenue_account, -amount)
+            ])
+        session.session.flush()
+
+    def test_in_default_days(self):
+        self.assertEqual(self.asset_account.in_default_days, 10)
+        self.assertEqual(self.revenue_account.in_default_days, 0)
+        self.assertEqual(self.liability_account.in_default_days, 0)
+
+    def test_in_default_days_expression(self):
+        self.assertEqual(
+            Account.q.filter(Account.in_default_days > 0).all(),
+            [self.asset_account])
+
+    def test_in_default_days_query(self):
+        self.assertEqual(dict(session.session.execute(in_default_days_query())),
+                         {self.asset_account.id: 10,
+                          self.revenue_account.id: 0})
+
+    def test_in_default_days_of_pending_account(self):
+        account = Account(name=u"pending", type="ASSET")
+        for days, amount in ((5, 100), (3, -50)):
+            t = finance.Transaction(description=u"Transaction",
+                                    valid_on=self.today - timedelta(days=days))
+            self.create_split(t, account, amount)
+        self.assertEqual(account.in_default_days, 5)
+
+    def test_same_day_splits_ordered_by_id(self):
+        # The balance only drops to zero if the splits of the second day
+        # are summed up in the wrong order
+        for days, amount in ((8, 100), (4, 50), (4, -100)):
+            t = self.create_transaction()
+            t.valid_on = self.today - timedelta(days=days)
+            session.session.add_all([
+                t, self.create_split(t, self.liability_account, amount),
+                self.create_split(t, self.revenue_account, -amount)
+            ])
+            session.session.flush()
+        account = self.liability_account
+        self.assertEqual(account.in_default_days, 8)
+        for split in account.splits:
+            split.transaction
+        session.session.expunge(account)
+        self.assertEqual(account.in_default_days, 8)
+
+
 class TestBankAccountActivity(FinanceModelTest, PostgreSQLTestCase):
     datasets = (AccountData, BankAccountData, UserData)
 
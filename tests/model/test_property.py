@@ -3,6 +3,11 @@
 # the Apache License, Version 2.0. See the LICENSE file for details.
 from datetime import datetime, timedelta
 
+from sqlalchemy import func, literal_column, select
+from sqlalchemy.dialects.postgresql import array
+
+from pycroft.helpers.interval import closed, single
+from pycroft.lib.membership import refresh_current_properties
 from pycroft.model.user import Group, Membership, PropertyGroup, TrafficGroup
 from tests import FixtureDataTestBase, FactoryDataTestBase
 from pycroft.model import session, user
@@ -534,7 +539,7 @@ class CurrentPropertyViewTest(FactoryDataTestBase):
         session.session.commit()
 
     def test_current_properties_of_user(self):
-        rows = (session.session.query(current_property.table.c.property_name)
+        rows = (session.session.query(current_property.c.property_name)
                 .add_columns(user.User.login.label('login'))
                 .join(user.User.current_properties)
                 .all())
@@ -555,10 +560,128 @@ class CurrentPropertyViewTest(FactoryDataTestBase):
                     self.assertNotIn((denied_prop, login), rows)
 
     def test_current_granted_or_denied_properties_of_user(self):
-        rows = (session.session.query(current_property.table.c.property_name)
+        rows = (session.session.query(current_property.c.property_name)
                 .add_columns(user.User.login.label('login'))
                 .join(user.User.current_properties_maybe_denied)
                 .all())
         # This checks that the violator's 'login' property is in the view as well
         # when ignoring the `denied` column
         self.assertIn(('login', self.users['violator'].login), rows)
+
+
+class CurrentPropertyMaintenanceTest(FactoryDataTestBase):
+    def create_factories(self):
+        self.user = UserFactory()
+        self.group = PropertyGroupFactory(granted={'mail'}, denied={'login'})
+        self.other_group = PropertyGroupFactory(granted={'login'})
+
+    def current_properties(self):
+        session.session.flush()
+        return set(session.session.query(current_property.c.property_name,
+                                         current_property.c.denied)
+                   .filter(current_property.c.user_id == self.user.id)
+                   .all())
+
+    def test_membership_insert_adds_properties(self):
+        self.assertEqual(self.current_properties(), set())
+        MembershipFactory.create(user=self.user, group=self.group)
+        self.assertEqual(self.current_properties(), {('mail', False)})
+
+    def test_membership_delete_removes_properties(self):
+        membership = MembershipFactory.create(user=self.user, group=self.group)
+        self.assertEqual(self.current_properties(), {('mail', False)})
+        session.session.delete(membership)
+        self.assertEqual(self.current_properties(), set())
+
+    def test_membership_end_removes_properties(self):
+        membership = MembershipFactory.create(user=self.user, group=self.group)
+        membership.disable(session.utcnow() - timedelta(hours=1))
+        self.assertEqual(self.current_properties(), set())
+
+    def test_membership_ending_now_removes_properties(self):
+        membership = MembershipFactory.create(
+            user=self.user, group=self.group,
+            begins_at=session.utcnow() - timedelta(hours=1))
+        self.assertEqual(self.current_properties(), {('mail', False)})
+        membership.disable(session.utcnow())
+        self.assertEqual(self.current_properties(), set())
+
+    def test_denial_is_recorded(self):
+        MembershipFactory.create(user=self.user, group=self.group)
+        MembershipFactory.create(user=self.user, group=self.other_group)
+        self.assertEqual(self.current_properties(),
+                         {('mail', False), ('login', True)})
+
+    def test_property_change_updates_members(self):
+        MembershipFactory.create(user=self.user, group=self.group)
+        self.group.property_grants['login'] = True
+        self.assertEqual(self.current_properties(),
+                         {('mail', False), ('login', False)})
+        del self.group.properties['mail']
+        self.assertEqual(self.current_properties(), {('login', False)})
+
+    def test_refresh_restores_properties(self):
+        MembershipFactory.create(user=self.user, group=self.group)
+        session.session.flush()
+        session.session.execute(current_property.delete())
+        self.assertEqual(self.current_properties(), set())
+        refresh_current_properties([self.user.id])
+        self.assertEqual(self.current_properties(), {('mail', False)})
+
+
+class EvaluatePropertiesForUsersTest(FactoryDataTestBase):
+    def create_factories(self):
+        self.group = PropertyGroupFactory(granted={'mail'}, denied={'login'})
+        self.users = UserFactory.create_batch(3)
+        for u in self.users:
+            MembershipFactory.create(user=u, group=self.group)
+
+    def evaluate(self, function, *args):
+        return set(session.session.execute(
+            select([literal_column('user_id'), literal_column('property_name'),
+                    literal_column('denied')])
+            .select_from(function(*args, func.current_timestamp()))
+        ).fetchall())
+
+    def test_single_user(self):
+        user_id = self.users[0].id
+        self.assertEqual(
+            self.evaluate(func.evaluate_properties_for_user, user_id),
+            {(user_id, 'mail', False)})
+
+    def test_multiple_users(self):
+        user_ids = [u.id for u in self.users[:2]]
+        self.assertEqual(
+            self.evaluate(func.evaluate_properties_for_users,
+                          array(user_ids)),
+            {(user_id, 'mail', False) for user_id in user_ids})
+
+    def test_has_property_at_point_in_time(self):
+        user = self.users[0]
+        past = single(session.utcnow() - timedelta(days=1))
+        group = PropertyGroupFactory(granted={'mail'}, denied={'login'})
+        MembershipFactory.create(user=user, group=group,
+                                 begins_at=past.begin - timedelta(days=1),
+                                 ends_at=past.begin + timedelta(hours=1))
+        self.assertTrue(user.has_property('mail', past))
+        self.assertFalse(user.has_property('login', past))
+
+    def test_effective_properties(self):
+        self.assertEqual(self.users[0].effective_properties(),
+                         frozenset({'mail'}))
+
+    def test_effective_properties_of_interval(self):
+        now = session.utcnow()
+        with self.assertRaises(ValueError):
+            self.users[0].effective_properties(closed(now, None))
+
+    def test_detached_user(self):
+        user = self.users[0]
+        # load everything needed before detaching the user
+        for membership in user.memberships:
+            membership.group.property_grants
+        session.session.expunge(user)
+        self.assertTrue(user.has_property('mail'))
+        self.assertFalse(user.has_property('login'))
+        self.assertEqual(user.effective_properties(), frozenset({'mail'}))
+        self.assertEqual(user.active_property_groups(), [self.group])
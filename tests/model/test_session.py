@@ -0,0 +1,35 @@
+# Copyright (c) 2018 The Pycroft Authors. See the AUTHORS file.
+# This file is part of the Pycroft project and licensed under the terms of
+# the Apache License, Version 2.0. See the LICENSE file for details.
+from datetime import datetime, timezone
+
+from pycroft.model import session
+from tests import SQLAlchemyTestCase
+
+
+class UtcNowTestCase(SQLAlchemyTestCase):
+    def test_fetched_once_per_transaction(self):
+        now = session.utcnow()
+        self.assertEqual(session.session.info['utcnow'], now)
+        self.assertIs(session.utcnow(), now)
+
+    def test_forgotten_after_transaction(self):
+        session.utcnow()
+        session.session.commit()
+        self.assertNotIn('utcnow', session.session.info)
+
+    def test_kept_after_subtransaction(self):
+        now = session.utcnow()
+        session.session.begin(subtransactions=True).commit()
+        self.assertIs(session.utcnow(), now)
+
+    def test_override(self):
+        when = datetime(2018, 3, 15, tzinfo=timezone.utc)
+        later = datetime(2018, 3, 16, tzinfo=timezone.utc)
+        with session.override_utcnow(when):
+            self.assertEqual(session.utcnow(), when)
+            with session.override_utcnow(later):
+                self.assertEqual(session.utcnow(), later)
+            session.session.commit()
+            self.assertEqual(session.utcnow(), when)
+        self.assertNotEqual(session.utcnow(), when)
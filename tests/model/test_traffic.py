@@ -1,7 +1,14 @@
-from datetime import timedelta, datetime
+from datetime import timedelta, datetime, timezone
+from ipaddr import IPv4Address
 
+from sqlalchemy import func, select
+
+from pycroft.lib.traffic import refresh_current_traffic_balances, \
+    refresh_daily_traffic
+from pycroft.lib.user import traffic_history
 from pycroft.model import session
-from pycroft.model.traffic import TrafficVolume, pmacct_traffic_egress, pmacct_traffic_ingress
+from pycroft.model.traffic import TrafficVolume, pmacct_traffic_egress, pmacct_traffic_ingress, \
+    CurrentTrafficBalance, DailyTraffic, IPOwner
 from tests import FactoryDataTestBase
 from tests.factories import UserWithHostFactory, IPFactory
 from tests.factories.traffic import TrafficCreditFactory, TrafficVolumeFactory, \
@@ -66,6 +73,13 @@ class PMAcctViewTest(FactoryDataTestBase):
         self.assertEqual(vol.packets, sum(x[1] for x in data))
         self.assertEqual(vol.amount, sum(x[2] for x in data))
 
+    def test_upserts_update_current_credit(self):
+        for _ in range(3):
+            session.session.execute(self.build_insert(type='Egress'))
+        amount = session.session.query(CurrentTrafficBalance.amount).filter_by(
+            user_id=self.user.id).scalar()
+        self.assertEqual(amount, -3*1024)
+
 
     def test_ingress_insert(self):
         session.session.execute(self.build_insert(type='Ingress'))
@@ -131,3 +145,125 @@ class CurrentBalanceTest(FactoryDataTestBase):
         user = UserWithHostFactory()
         session.session.commit()
         self.assertEqual(user.current_credit, 0)
+
+    def test_volume_update_changes_credit(self):
+        volume = TrafficVolumeFactory.create(timestamp=self.now + timedelta(1),
+                                             amount=1024,
+                                             user=self.user, ip=self.ip)
+        session.session.flush()
+        volume.amount = 4096
+        session.session.flush()
+        self.assertEqual(self.current_amount(), 28*1024**3 - 4096)
+
+    def test_credit_delete_changes_credit(self):
+        credit = self.user.traffic_credits[0]
+        session.session.delete(credit)
+        session.session.flush()
+        self.assertEqual(self.current_amount(), 25*1024**3)
+
+    def test_events_before_balance_are_ignored(self):
+        TrafficBalanceFactory(timestamp=self.now, user=self.user, amount=0)
+        session.session.flush()
+        TrafficVolumeFactory.create(timestamp=self.now + timedelta(-3),
+                                    amount=1024, user=self.user, ip=self.ip)
+        session.session.flush()
+        self.assertEqual(self.current_amount(), 2*1024**3)
+
+    def test_refresh_recomputes_credit(self):
+        session.session.execute(
+            CurrentTrafficBalance.__table__.update().values(amount=0))
+        refresh_current_traffic_balances([self.user.id])
+        self.assertEqual(self.current_amount(), 28*1024**3)
+
+    def current_amount(self):
+        return session.session.query(CurrentTrafficBalance.amount).filter_by(
+            user_id=self.user.id).scalar()
+
+
+class DailyTrafficTest(FactoryDataTestBase):
+    def create_factories(self):
+        self.user = UserWithHostFactory()
+        self.ip = self.user.hosts[0].interfaces[0].ips[0]
+        self.day = datetime(2018, 3, 15, tzinfo=timezone.utc)
+        TrafficCreditFactory.create(timestamp=self.day + timedelta(hours=1),
+                                    amount=3000, user=self.user)
+        TrafficVolumeFactory.create(timestamp=self.day + timedelta(hours=2),
+                                    amount=1000, type='Ingress',
+                                    user=self.user, ip=self.ip)
+        TrafficVolumeFactory.create(timestamp=self.day + timedelta(hours=3),
+                                    amount=500, type='Egress',
+                                    user=self.user, ip=self.ip)
+        self.volume = TrafficVolumeFactory.create(
+            timestamp=self.day + timedelta(days=1), amount=200,
+            type='Egress', user=self.user, ip=self.ip)
+
+    def rollup(self):
+        return {(d.day, d.credit, d.ingress, d.egress)
+                for d in DailyTraffic.q.filter_by(user_id=self.user.id)}
+
+    def test_rollup_maintained(self):
+        self.assertEqual(self.rollup(), {
+            (self.day, 3000, 1000, 500),
+            (self.day + timedelta(days=1), 0, 0, 200),
+        })
+        session.session.delete(self.volume)
+        session.session.flush()
+        self.assertEqual(self.rollup(), {
+            (self.day, 3000, 1000, 500),
+            (self.day + timedelta(days=1), 0, 0, 0),
+        })
+
+    def test_refresh(self):
+        session.session.execute(DailyTraffic.__table__.delete())
+        refresh_daily_traffic([self.user.id])
+        self.assertEqual(len(self.rollup()), 2)
+
+    def test_history_of_whole_days(self):
+        history = traffic_history(self.user.id, self.day, timedelta(days=2),
+                                  timedelta(days=1))
+        self.assertEqual([(e.egress, e.balance) for e in history],
+                         [(500, 1500), (200, 1300)])
+
+
+class IPOwnerTest(FactoryDataTestBase):
+    def create_factories(self):
+        self.user = UserWithHostFactory(
+            host__interface__ip__str_address='141.30.228.39')
+        self.host = self.user.hosts[0]
+        self.ip = self.host.interfaces[0].ips[0]
+        self.other_user = UserWithHostFactory()
+
+    def owner_of(self, address):
+        owner = IPOwner.q.get(address)
+        return owner.user_id if owner is not None else None
+
+    def test_ip_insert(self):
+        self.assertEqual(self.owner_of(self.ip.address), self.user.id)
+
+    def test_ip_address_change(self):
+        old_address = self.ip.address
+        self.ip.address = IPv4Address('141.30.228.40')
+        session.session.flush()
+        self.assertIsNone(self.owner_of(old_address))
+        self.assertEqual(self.owner_of(self.ip.address), self.user.id)
+
+    def test_ip_delete(self):
+        address = self.ip.address
+        session.session.delete(self.ip)
+        session.session.flush()
+        self.assertIsNone(self.owner_of(address))
+
+    def test_host_owner_change(self):
+        self.host.owner = self.other_user
+        session.session.flush()
+        self.assertEqual(self.owner_of(self.ip.address), self.other_user.id)
+
+    def test_interface_host_change(self):
+        self.host.interfaces[0].host = self.other_user.hosts[0]
+        session.session.flush()
+        self.assertEqual(self.owner_of(self.ip.address), self.other_user.id)
+
+    def test_refresh(self):
+        session.session.execute(IPOwner.__table__.delete())
+        session.session.execute(select([func.ip_owner_refresh(None)]))
+        self.assertEqual(self.owner_of(self.ip.address), self.user.id)
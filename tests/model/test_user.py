@@ -3,15 +3,18 @@
 # the Apache License, Version 2.0. See the LICENSE file for details.
 from datetime import timedelta
 
+from sqlalchemy.exc import IntegrityError
+
 from tests.fixtures.dummy import unixaccount
 from pycroft.model import facilities, session, user
-from pycroft.helpers.interval import single, closed
+from pycroft.helpers.interval import single, closed, closedopen
 from pycroft.helpers.user import (
     generate_password, hash_password)
 from pycroft.model.finance import Account
 from pycroft.model.user import (
     IllegalLoginError, Membership, PropertyGroup, TrafficGroup)
-from tests import FixtureDataTestBase
+from tests import FactoryDataTestBase, FixtureDataTestBase
+from tests.factories import MembershipFactory, PropertyGroupFactory, UserFactory
 from tests.fixtures.dummy.facilities import BuildingData, RoomData
 from tests.fixtures.dummy.property import (
     MembershipData, PropertyData, PropertyGroupData, TrafficGroupData)
@@ -314,3 +317,55 @@ class Test_has_property(FixtureDataTestBase):
                 user.User.login == self.user.login,
                 user.User.has_property(PropertyData.granted.name, interval)
             ).first())
+
+
+class MembershipActiveDuringTestCase(FactoryDataTestBase):
+    def create_factories(self):
+        self.now = session.utcnow()
+        self.group = PropertyGroupFactory()
+        self.user = UserFactory()
+        self.membership = MembershipFactory.create(
+            user=self.user, group=self.group,
+            begins_at=self.now - timedelta(days=2),
+            ends_at=self.now - timedelta(days=1))
+
+    def active_memberships(self, when):
+        return Membership.q.filter(Membership.user == self.user,
+                                   Membership.active(when)).all()
+
+    def test_active_during(self):
+        self.assertEqual(self.membership.active_during,
+                         closed(self.membership.begins_at,
+                                self.membership.ends_at))
+
+    def test_active_expression(self):
+        self.assertEqual(self.active_memberships(
+            single(self.membership.ends_at)), [self.membership])
+        self.assertEqual(self.active_memberships(
+            closed(self.now - timedelta(days=3), self.now)),
+            [self.membership])
+        self.assertEqual(self.active_memberships(single(self.now)), [])
+        self.assertEqual(self.active_memberships(
+            closedopen(self.now - timedelta(hours=1), None)), [])
+
+    def test_disjoint_membership(self):
+        MembershipFactory.create(user=self.user, group=self.group,
+                                 begins_at=self.now, ends_at=None)
+        session.session.execute(
+            "SET CONSTRAINTS membership_exclusive_excl IMMEDIATE")
+        session.session.flush()
+
+    def test_overlapping_membership(self):
+        session.session.execute(
+            "SET CONSTRAINTS membership_exclusive_excl IMMEDIATE")
+        with self.assertRaises(IntegrityError):
+            MembershipFactory.create(user=self.user, group=self.group,
+                                     begins_at=None, ends_at=self.now)
+            session.session.flush()
+
+    def test_inverted_membership(self):
+        with self.assertRaises(IntegrityError):
+            session.session.execute(
+                Membership.__table__.update()
+                .where(Membership.id == self.membership.id)
+                .values(ends_at=self.now - timedelta(days=3)))
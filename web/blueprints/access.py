@@ -3,13 +3,44 @@
 # the Apache License, Version 2.0. See the LICENSE file for details.
 from itertools import chain
 from flask.globals import current_app
-from flask import abort, request
+from flask import abort, g, request
 from flask_login import current_user
 from web.blueprints import bake_endpoint
 
 
+def user_properties(user=None):
+    """Return the properties a user currently has.
+
+    The properties of a user are fetched only once per request, so that
+    access checks, navigation rendering and templates can test as many
+    properties as they like.
+
+    :param User user: the user, defaults to the current user
+    :rtype: frozenset[str]
+    """
+    if user is None:
+        user = current_user
+    if not user.is_authenticated:
+        return frozenset()
+    cache = g.setdefault('user_properties', {})
+    user_id = user.get_id()
+    if user_id not in cache:
+        cache[user_id] = user.effective_properties()
+    return cache[user_id]
+
+
+def has_property(property_name, user=None):
+    """Check whether a user currently has a property.
+
+    :param str property_name: the name of the property
+    :param User user: the user, defaults to the current user
+    """
+    return property_name in user_properties(user)
+
+
 def _check_properties(properties):
-    return all(current_user.has_property(p) for p in properties)
+    granted = user_properties()
+    return all(p in granted for p in properties)
 
 
 class BlueprintAccess(object):
@@ -15,14 +15,13 @@ from collections import defaultdict
 from flask import (Blueprint, flash, jsonify, render_template, url_for,
                    redirect, request, abort)
 from flask_login import current_user
-from sqlalchemy.sql import and_, select, exists
+from sqlalchemy.sql import and_
 from sqlalchemy.orm import joinedload, aliased
 
 from pycroft import lib, config
 from pycroft.helpers import facilities
 from pycroft.model import session
 from pycroft.model.facilities import Room, Site
-from pycroft.model.property import CurrentProperty
 from pycroft.model.user import User
 from web.blueprints.access import BlueprintAccess
 from web.blueprints.facilities.forms import (
@@ -148,9 +147,7 @@ def building_level_rooms_json(level, building_id=None, building_shortname=None):
     if not all_users:
         user_join_condition = and_(
             user_join_condition,
-            exists(select([CurrentProperty]).where(
-                and_(CurrentProperty.user_id == user.id,
-                     CurrentProperty.property_name == 'network_access')))
+            user.property_set.contains(['network_access'])
         )
 
     rooms_users_q = (session.session.query(Room, user)
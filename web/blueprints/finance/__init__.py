@@ -790,8 +790,13 @@ def membership_fee_edit(fee_id):
 @bp.route('/membership_fees/handle_payments_in_default', methods=("GET", "POST"))
 @access.require('finance_change')
 def handle_payments_in_default():
-    users_pid_membership, users_membership_terminated = finance.handle_payments_in_default()
-    users_no_more_pid = finance.end_payment_in_default_memberships()
+    form = HandlePaymentsInDefaultForm()
+    dry_run = not form.is_submitted()
+
+    users_pid_membership, users_membership_terminated = \
+        finance.handle_payments_in_default(dry_run=dry_run)
+    users_no_more_pid = finance.end_payment_in_default_memberships(
+        dry_run=dry_run)
 
     changes = [('Neue Zugehörigkeiten in Zahlungsrückstands-Gruppe',
                 users_pid_membership),
@@ -799,14 +804,10 @@ def handle_payments_in_default():
                ('Beendete Zugehörigkeiten in Zahlungsrückstands-Gruppe',
                 users_no_more_pid)]
 
-    form = HandlePaymentsInDefaultForm()
-
-    if form.is_submitted():
+    if not dry_run:
         session.commit()
         flash("Zahlungsrückstände behandelt.", "success")
         return redirect(url_for(".membership_fees"))
-    else:
-        session.rollback()
 
     return render_template('finance/handle_payments_in_default.html',
                            changes=changes,
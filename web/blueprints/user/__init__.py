@@ -39,12 +39,15 @@ from pycroft.lib.net import SubnetFullException, MacExistsException, \
 from pycroft.lib.host import change_mac as lib_change_mac
 from pycroft.lib.user import encode_type1_user_id, encode_type2_user_id, \
     traffic_history, generate_user_sheet, migrate_user_host
-from pycroft.lib.membership import make_member_of, remove_member_of
-from pycroft.lib.traffic import effective_traffic_group, NoTrafficGroup
+from pycroft.lib.membership import make_member_of, remove_member_of, \
+    overlapping_memberships
+from pycroft.lib.traffic import effective_traffic_group, NoTrafficGroup, \
+    top_traffic_consumers
 from pycroft.model import session
 from pycroft.model.traffic import TrafficVolume, TrafficCredit, TrafficBalance
-from pycroft.model.facilities import Room
+from pycroft.model.facilities import Building, Room
 from pycroft.model.host import Host, Interface, IP, Interface
+from pycroft.model.net import Subnet
 from pycroft.model.user import User, Membership, PropertyGroup, TrafficGroup
 from pycroft.model.finance import Split
 from pycroft.model.types import InvalidMACAddressException
@@ -57,7 +60,8 @@ from web.blueprints.user.forms import UserSearchForm, UserCreateForm, \
     UserLogEntry, UserAddGroupMembership, UserMoveForm, \
     UserEditForm, UserSuspendForm, UserMoveOutForm, \
     UserEditGroupMembership, UserSelectGroupForm, \
-    UserResetPasswordForm, UserMoveInForm, HostForm, InterfaceForm
+    UserResetPasswordForm, UserMoveInForm, HostForm, InterfaceForm, \
+    TrafficReportForm
 from web.blueprints.access import BlueprintAccess
 from web.blueprints.helpers.api import json_agg
 from datetime import datetime, timedelta
@@ -66,7 +70,8 @@ from ..helpers.log import format_user_log_entry, format_room_log_entry, \
     format_hades_log_entry
 from .log import formatted_user_hades_logs
 from .tables import (LogTableExtended, LogTableSpecific, MembershipTable,
-                     HostTable, SearchTable, InterfaceTable)
+                     HostTable, SearchTable, InterfaceTable,
+                     TrafficReportTable)
 from ..finance.tables import FinanceTable, FinanceTableSplitted
 
 bp = Blueprint('user', __name__)
@@ -754,14 +759,18 @@ def add_membership(user_id):
             ends_at = datetime.combine(form.ends_at.date.data, utc.time_min())
         else:
             ends_at = None
-        make_member_of(user, form.group.data, current_user,
-                       closed(begins_at, ends_at))
-        session.session.commit()
-        flash(u'Nutzer wurde der Gruppe hinzugefügt.', 'success')
+        if ends_at is not None and ends_at < begins_at:
+            form.ends_at.date.errors.append(
+                u"Das Ende liegt vor dem Beginn.")
+        else:
+            make_member_of(user, form.group.data, current_user,
+                           closed(begins_at, ends_at))
+            session.session.commit()
+            flash(u'Nutzer wurde der Gruppe hinzugefügt.', 'success')
 
-        return redirect(url_for(".user_show",
-                                user_id=user_id,
-                                _anchor='groups'))
+            return redirect(url_for(".user_show",
+                                    user_id=user_id,
+                                    _anchor='groups'))
 
     return render_template('user/add_membership.html',
         page_title=u"Neue Gruppenmitgliedschaft für Nutzer {}".format(user_id),
@@ -841,6 +850,72 @@ def json_trafficdata(user_id, days=7):
     )
 
 
+@bp.route('/traffic_report')
+@nav.navigate(u"Traffic-Report")
+def traffic_report():
+    form = TrafficReportForm()
+
+    return render_template(
+        'user/traffic_report.html',
+        form=form,
+        report_table=TrafficReportTable(data_url=url_for(".json_traffic_report"))
+    )
+
+
+def _user_link(user):
+    if user is None:
+        return None
+    return {'href': url_for('.user_show', user_id=user.id),
+            'title': user.name}
+
+
+@bp.route('/json/traffic_report')
+def json_traffic_report():
+    """Generate a JSON file listing the users, hosts or IPs with the most
+    traffic within the last days.
+
+    The parameters are the fields of :py:class:`TrafficReportForm`.
+    """
+    building_id = request.args.get('building_id')
+    subnet_id = request.args.get('subnet_id')
+    try:
+        days = int(request.args.get('days') or 7)
+        limit = int(request.args.get('limit') or 20)
+        building = subnet = None
+        if building_id and building_id != "__None":
+            building = Building.q.get(int(building_id))
+        if subnet_id and subnet_id != "__None":
+            subnet = Subnet.q.get(int(subnet_id))
+        end = session.utcnow()
+        consumers = top_traffic_consumers(
+            start=end - timedelta(days=days), end=end,
+            type=request.args.get('type', 'Egress'),
+            by=request.args.get('by', 'user'),
+            limit=limit, building=building, subnet=subnet)
+    except ValueError:
+        return abort(400)
+
+    items = []
+    for rank, (consumer, amount) in enumerate(consumers, 1):
+        if isinstance(consumer, User):
+            name = _user_link(consumer)
+            owner = name
+        elif isinstance(consumer, Host):
+            owner = _user_link(consumer.owner)
+            name = dict(owner or {}, title=consumer.name or str(consumer.id))
+        else:
+            owner = _user_link(consumer.host.owner)
+            name = dict(owner or {}, title=str(consumer.address))
+        items.append({
+            'rank': rank,
+            'name': name,
+            'owner': owner,
+            'amount': "{:.2f} GiB".format(amount / 1024**3),
+        })
+
+    return jsonify(items=items)
+
+
 def validate_unique_name(form, field):
     if not form.force.data:
         try:
@@ -1010,21 +1085,32 @@ def edit_membership(user_id, membership_id):
     form = UserEditGroupMembership(**membership_data)
 
     if form.validate_on_submit():
-        membership.begins_at = datetime.combine(form.begins_at.data, utc.time_min())
+        begins_at = datetime.combine(form.begins_at.data, utc.time_min())
         if form.ends_at.unlimited.data:
-            membership.ends_at = None
+            ends_at = None
         else:
-            membership.ends_at = datetime.combine(form.ends_at.date.data, utc.time_min())
+            ends_at = datetime.combine(form.ends_at.date.data, utc.time_min())
 
-        message = (u"Edited the membership of group '{group}'. During: {during}"
-                   .format(group=membership.group.name,
-                           during=closed(membership.begins_at, membership.ends_at)))
-        lib.logging.log_user_event(message, current_user, membership.user)
-        session.session.commit()
-        flash(u'Gruppenmitgliedschaft bearbeitet', 'success')
-        return redirect(url_for('.user_show',
-                                user_id=membership.user_id,
-                                _anchor='groups'))
+        if ends_at is not None and ends_at < begins_at:
+            form.ends_at.date.errors.append(
+                u"Das Ende liegt vor dem Beginn.")
+        elif overlapping_memberships(membership, closed(begins_at, ends_at)):
+            form.begins_at.errors.append(
+                u"Überschneidet sich mit einer anderen Mitgliedschaft "
+                u"in dieser Gruppe.")
+        else:
+            membership.begins_at = begins_at
+            membership.ends_at = ends_at
+
+            message = (u"Edited the membership of group '{group}'. During: {during}"
+                       .format(group=membership.group.name,
+                               during=closed(membership.begins_at, membership.ends_at)))
+            lib.logging.log_user_event(message, current_user, membership.user)
+            session.session.commit()
+            flash(u'Gruppenmitgliedschaft bearbeitet', 'success')
+            return redirect(url_for('.user_show',
+                                    user_id=membership.user_id,
+                                    _anchor='groups'))
 
     return render_template('user/user_edit_membership.html',
                            page_title=(u"Mitgliedschaft {} für "
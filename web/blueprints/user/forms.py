@@ -11,13 +11,14 @@ from wtforms.validators import (
     Regexp, NumberRange, ValidationError, DataRequired, Email, Optional)
 
 from pycroft.model.host import Host
+from pycroft.model.net import Subnet
 from pycroft.model.user import PropertyGroup, User
 from web.blueprints.facilities.forms import building_query
 from web.blueprints.properties.forms import traffic_group_query, \
     property_group_query, property_group_user_create_query
 from web.form.fields.core import TextField, TextAreaField, BooleanField, \
     QuerySelectField, DateField, SelectField, FormField, \
-    QuerySelectMultipleField, SelectMultipleField
+    QuerySelectMultipleField, SelectMultipleField, IntegerField
 from web.form.fields.custom import LazyLoadSelectField, MacField, UserIDField
 from web.form.fields.filters import empty_to_none, to_lowercase
 from web.form.fields.validators import OptionalIf, MacAddress
@@ -35,6 +36,10 @@ def group_query():
     return PropertyGroup.q.order_by(PropertyGroup.name)
 
 
+def subnet_query():
+    return Subnet.q.order_by(Subnet.address)
+
+
 def validate_unique_login(form, field):
     if User.q.filter_by(login=field.data).first():
         raise ValidationError(u"Nutzerlogin schon vergeben!")
@@ -63,6 +68,27 @@ class UserSearchForm(Form):
                                 blank_text=u"<Wohnheim>")
 
 
+class TrafficReportForm(Form):
+    days = IntegerField(u"Tage", [NumberRange(min=1)], default=7)
+    type = SelectField(u"Richtung", coerce=str,
+                       choices=[('Egress', u"Ausgehend"),
+                                ('Ingress', u"Eingehend")])
+    by = SelectField(u"Gruppierung", coerce=str,
+                     choices=[('user', u"Nutzer"), ('host', u"Hosts"),
+                              ('ip', u"IPs")])
+    limit = IntegerField(u"Anzahl", [NumberRange(min=1)], default=20)
+    building_id = QuerySelectField(u"Wohnheim",
+                                   get_label='short_name',
+                                   query_factory=building_query,
+                                   allow_blank=True,
+                                   blank_text=u"<Wohnheim>")
+    subnet_id = QuerySelectField(u"Subnetz",
+                                 get_label=lambda s: str(s.address),
+                                 query_factory=subnet_query,
+                                 allow_blank=True,
+                                 blank_text=u"<Subnetz>")
+
+
 class UserResetPasswordForm(Form):
     pass
 
@@ -1,7 +1,7 @@
 from flask import url_for
-from flask_login import current_user
 from wtforms.widgets.core import html_params
 
+from web.blueprints.access import has_property
 from web.blueprints.helpers.table import BootstrapTable, Column
 
 
@@ -58,7 +58,7 @@ class MembershipTable(BootstrapTable):
     def generate_toolbar(self):
         if self.user_id is None:
             return
-        if not current_user.has_property('groups_change_membership'):
+        if not has_property('groups_change_membership'):
             return
         args = {
             'class': "btn btn-primary",
@@ -87,7 +87,7 @@ class HostTable(BootstrapTable):
     def generate_toolbar(self):
         if self.user_id is None:
             return
-        if not current_user.has_property('user_hosts_change'):
+        if not has_property('user_hosts_change'):
             return
         args = {
             'class': "btn btn-primary",
@@ -115,7 +115,7 @@ class InterfaceTable(BootstrapTable):
     def generate_toolbar(self):
         if self.user_id is None:
             return
-        if not current_user.has_property('user_hosts_change'):
+        if not has_property('user_hosts_change'):
             return
         args = {
             'class': "btn btn-primary",
@@ -135,3 +135,14 @@ class SearchTable(BootstrapTable):
             Column('url', 'Name', formatter='table.linkFormatter'),
             Column('login', 'Login'),
         ], **kw)
+
+
+class TrafficReportTable(BootstrapTable):
+    """A table for displaying the biggest traffic consumers"""
+    def __init__(self, *a, **kw):
+        super().__init__(*a, columns=[
+            Column('rank', '#'),
+            Column('name', 'Name', formatter='table.linkFormatter'),
+            Column('owner', 'Besitzer', formatter='table.linkFormatter'),
+            Column('amount', 'Traffic'),
+        ], **kw)
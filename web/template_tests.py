@@ -4,6 +4,7 @@
 # the Apache License, Version 2.0. See the LICENSE file for details.
 
 from pycroft.lib.user import has_positive_balance
+from web.blueprints.access import has_property
 
 _check_registry = {}
 
@@ -26,7 +27,7 @@ def positive_balance_check(user):
 def no_network_access_check(user):
     """Tests if user has network access
     """
-    return not user.has_property("network_access")
+    return not has_property("network_access", user)
 
 
 @template_check("user_with_traffic_exceeded")
@@ -40,10 +41,7 @@ def privilege_check(user, *required_privileges):
     """Tests if the user has one of the required_privileges to view the
     requested component.
     """
-    for perm in required_privileges:
-        if user.has_property(perm):
-            return True
-    return False
+    return any(has_property(perm, user) for perm in required_privileges)
 
 
 @template_check("greater")